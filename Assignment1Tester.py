@@ -11,6 +11,8 @@ USER_ID_COLNAME = 'userid'
 MOVIE_ID_COLNAME = 'movieid'
 RATING_COLNAME = 'rating'
 INPUT_FILE_PATH = './ml-10M100K/ratings.dat'
+TEST_DATA_FILE_PATH = './test_data.dat'
+TEST_DATA_ROWS = 20  # Number of lines in test_data.dat
 ACTUAL_ROWS_IN_INPUT_FILE = 10_000_054  # Number of lines in the input file
 
 import time 
@@ -19,6 +21,11 @@ import psycopg2
 import traceback
 import testHelper
 import Interface as MyAssignment
+import Query
+import Metrics
+import Placement
+import Cache
+from AsyncInterface import AsyncInterface
 
 exe_time = []
 
@@ -31,6 +38,12 @@ def execution_time(start, end, func):
 
 if __name__ == '__main__':
     try:
+        [result, e] = testHelper.testtransformequivalence(MyAssignment, TEST_DATA_FILE_PATH)
+        if result :
+            print("transform equivalence pass!")
+        else:
+            print("transform equivalence fail!")
+
         testHelper.createdb(DATABASE_NAME)
 
         with testHelper.getopenconnection(dbname=DATABASE_NAME) as conn:
@@ -38,6 +51,70 @@ if __name__ == '__main__':
 
             testHelper.deleteAllPublicTables(conn)
 
+            [result, e] = testHelper.testloadratingsformats(MyAssignment, TEST_DATA_FILE_PATH, conn, TEST_DATA_ROWS)
+            if result :
+                print("loadratings text/binary format pass!")
+            else:
+                print("loadratings text/binary format fail!")
+
+            [result, e] = testHelper.testunloggedload(MyAssignment, TEST_DATA_FILE_PATH, conn, TEST_DATA_ROWS)
+            if result :
+                print("unlogged fast load pass!")
+            else:
+                print("unlogged fast load fail!")
+
+            [result, e] = testHelper.testresumableload(MyAssignment, TEST_DATA_FILE_PATH, conn, TEST_DATA_ROWS)
+            if result :
+                print("resumable load pass!")
+            else:
+                print("resumable load fail!")
+
+            [result, e] = testHelper.testloadratings(MyAssignment, 'ratings_pipeline_copy', TEST_DATA_FILE_PATH, conn,
+                                                     TEST_DATA_ROWS, pipeline=True, queue_depth=2, block_size=64)
+            if result :
+                print("pipeline loadratings pass!")
+            else:
+                print("pipeline loadratings fail!")
+
+            [result, e] = testHelper.testpipelinefailures(MyAssignment, TEST_DATA_FILE_PATH, conn)
+            if result :
+                print("pipeline load failures pass!")
+            else:
+                print("pipeline load failures fail!")
+
+            [result, e] = testHelper.testloadandpartition(MyAssignment, TEST_DATA_FILE_PATH, 5, conn, TEST_DATA_ROWS)
+            if result :
+                print("loadandpartition pass!")
+            else:
+                print("loadandpartition fail!")
+
+            [result, e] = testHelper.testroundrobinrebuild(MyAssignment, TEST_DATA_FILE_PATH, 5, conn, TEST_DATA_ROWS)
+            if result :
+                print("roundrobinpartition rebuild pass!")
+            else:
+                print("roundrobinpartition rebuild fail!")
+
+            for scheme in ('range', 'roundrobin'):
+                [result, e] = testHelper.testnativepartition(MyAssignment, scheme, TEST_DATA_FILE_PATH, 5, conn, TEST_DATA_ROWS)
+                if result :
+                    print("native {0} partitioning pass!".format(scheme))
+                else:
+                    print("native {0} partitioning fail!".format(scheme))
+
+            # 64-byte blocks: several COPY blocks in each of the 4 slices
+            [result, e] = testHelper.testloadratings(MyAssignment, 'ratings_parallel_copy', TEST_DATA_FILE_PATH, conn,
+                                                     TEST_DATA_ROWS, workers=4, block_size=64)
+            if result :
+                print("parallel loadratings pass!")
+            else:
+                print("parallel loadratings fail!")
+
+            [result, e] = testHelper.testconnectionpoolstats(MyAssignment, DATABASE_NAME)
+            if result :
+                print("connection pool stats pass!")
+            else:
+                print("connection pool stats fail!")
+
             start = time.time()
             [result, e] = testHelper.testloadratings(MyAssignment, RATINGS_TABLE, INPUT_FILE_PATH, conn, ACTUAL_ROWS_IN_INPUT_FILE)
             end = time.time()
@@ -48,6 +125,18 @@ if __name__ == '__main__':
             
             execution_time(start, end, 'loadratings')
 
+            [result, e] = testHelper.testequidepthpartition(MyAssignment, RATINGS_TABLE, 5, conn, ACTUAL_ROWS_IN_INPUT_FILE)
+            if result :
+                print("equi-depth rangepartition pass!")
+            else:
+                print("equi-depth rangepartition fail!")
+
+            [result, e] = testHelper.testrangepartition(MyAssignment, RATINGS_TABLE, 5, conn, 0, ACTUAL_ROWS_IN_INPUT_FILE, single_pass=True)
+            if result :
+                print("single-pass rangepartition pass!")
+            else:
+                print("single-pass rangepartition fail!")
+
             start = time.time()
             [result, e] = testHelper.testrangepartition(MyAssignment, RATINGS_TABLE, 5, conn, 0, ACTUAL_ROWS_IN_INPUT_FILE)
             end = time.time()
@@ -58,6 +147,18 @@ if __name__ == '__main__':
             
             execution_time(start, end, 'rangepartition')
 
+            [result, e] = testHelper.testrepartition(MyAssignment, RATINGS_TABLE, 'range', 5, 8, conn, ACTUAL_ROWS_IN_INPUT_FILE)
+            if result :
+                print("range repartition pass!")
+            else:
+                print("range repartition fail!")
+
+            [result, e] = testHelper.testrepartitionelsewhere(MyAssignment, RATINGS_TABLE, 5, 8, conn)
+            if result :
+                print("rangeinsert after a repartition elsewhere pass!")
+            else:
+                print("rangeinsert after a repartition elsewhere fail!")
+
 
             
             start = time.time()
@@ -72,9 +173,58 @@ if __name__ == '__main__':
             
             execution_time(start, end, 'rangeinsert')
 
+            [result, e] = testHelper.testinsertmany(MyAssignment, RATINGS_TABLE, 'range', 5, conn)
+            if result:
+                print("rangeinsert_many pass!")
+            else:
+                print("rangeinsert_many fail!")
+
+            [result, e] = testHelper.testinsertmetrics(MyAssignment, Metrics, RATINGS_TABLE, 101, 2, 3, conn)
+            if result:
+                print("insert metrics pass!")
+            else:
+                print("insert metrics fail!")
+
+            [result, e] = testHelper.testratingscache(Cache, MyAssignment, RATINGS_TABLE, conn)
+            if result:
+                print("ratings cache pass!")
+            else:
+                print("ratings cache fail!")
+
+            with Query.FragmentQueryEngine(DATABASE_NAME) as engine:
+                [result, e] = testHelper.testfragmentqueries(engine, RATINGS_TABLE, conn)
+            if result:
+                print("fragment queries pass!")
+            else:
+                print("fragment queries fail!")
+
+            [result, e] = testHelper.testrangequery(MyAssignment, RATINGS_TABLE, 5, conn)
+            if result:
+                print("rangequery pass!")
+            else:
+                print("rangequery fail!")
+
+            [result, e] = testHelper.testasyncinterface(AsyncInterface, MyAssignment, RATINGS_TABLE, TEST_DATA_FILE_PATH, conn, TEST_DATA_ROWS)
+            if result:
+                print("async interface pass!")
+            else:
+                print("async interface fail!")
+
+            [result, e] = testHelper.testpartitionindexes(MyAssignment, RANGE_TABLE_PREFIX, 5, conn)
+            if result:
+                print("partition indexes pass!")
+            else:
+                print("partition indexes fail!")
+
             testHelper.deleteAllPublicTables(conn)
             MyAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH, conn)
             
+            [result, e] = testHelper.testroundrobinpartition(MyAssignment, RATINGS_TABLE, 5, conn, 0, ACTUAL_ROWS_IN_INPUT_FILE, streaming=True)
+            if result :
+                print("streaming roundrobinpartition pass!")
+            else:
+                print("streaming roundrobinpartition fail!")
+
             start = time.time()
             [result, e] = testHelper.testroundrobinpartition(MyAssignment, RATINGS_TABLE, 5, conn, 0, ACTUAL_ROWS_IN_INPUT_FILE)
             end = time.time()
@@ -85,6 +235,12 @@ if __name__ == '__main__':
             
             execution_time(start, end, 'roundrobinpartition')
 
+            [result, e] = testHelper.testrepartition(MyAssignment, RATINGS_TABLE, 'roundrobin', 5, 7, conn, ACTUAL_ROWS_IN_INPUT_FILE)
+            if result :
+                print("roundrobin repartition pass!")
+            else:
+                print("roundrobin repartition fail!")
+
             start = time.time()
             # ALERT:: Change the partition index according to your testing sequence.
             [result, e] = testHelper.testroundrobininsert(MyAssignment, RATINGS_TABLE, 100, 1, 3, conn, '0')
@@ -98,6 +254,40 @@ if __name__ == '__main__':
             
             execution_time(start, end, 'roundrobininsert')
 
+            [result, e] = testHelper.testinsertmany(MyAssignment, RATINGS_TABLE, 'roundrobin', 5, conn)
+            if result :
+                print("roundrobininsert_many pass!")
+            else:
+                print("roundrobininsert_many fail!")
+
+            [result, e] = testHelper.testinsertmany(MyAssignment, RATINGS_TABLE, 'roundrobin', 5, conn, firstuserid=310000,
+                                                    rrblocksize=16)
+            if result :
+                print("roundrobininsert_many with a RoundRobinCursor pass!")
+            else:
+                print("roundrobininsert_many with a RoundRobinCursor fail!")
+
+            [result, e] = testHelper.testconcurrentroundrobininsert(MyAssignment, RATINGS_TABLE, 5, conn)
+            if result :
+                print("concurrent roundrobininsert pass!")
+            else:
+                print("concurrent roundrobininsert fail!")
+
+            [result, e] = testHelper.testlegacyroundrobininsert(MyAssignment, RATINGS_TABLE, 5, conn)
+            if result :
+                print("roundrobininsert without a registry pass!")
+            else:
+                print("roundrobininsert without a registry fail!")
+
+            # NODES="localhost:5433/dds_assgn1,localhost:5434/dds_assgn1" places the fragments on those clusters
+            nodes = Placement.parse_nodes()
+            if nodes:
+                [result, e] = testHelper.testplacement(MyAssignment, Placement, Cache, RATINGS_TABLE, nodes, conn)
+                if result :
+                    print("multi-node placement pass!")
+                else:
+                    print("multi-node placement fail!")
+
             choice = input('Press enter to Delete all tables? ')
             if choice == '':
                 testHelper.deleteAllPublicTables(conn)
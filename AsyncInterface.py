@@ -0,0 +1,261 @@
+#
+# asyncio variants of the Interface load, insert and query paths, on psycopg 3
+#
+import asyncio
+
+from psycopg.conninfo import make_conninfo
+from psycopg.errors import UndefinedTable
+from psycopg.sql import SQL, Identifier
+from psycopg_pool import AsyncConnectionPool
+
+import Interface
+
+INSERT_SQL = SQL("INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s)")
+
+
+class AsyncInterface:
+    '''
+    Async loadratings, insert and range query API over a small pool of
+    connections. Single-row rangeinsert / roundrobininsert calls are queued
+    and one writer task per connection drains the queue: everything waiting
+    is written as one pipelined transaction, so thousands of concurrent
+    submissions share max_size connections and commits. A failing batch
+    fails every call in it.
+    Use as "async with AsyncInterface(dbname) as db:".
+    '''
+    def __init__(self, dbname, min_size=1, max_size=4, batch_size=500):
+        # autocommit outside of explicit conn.transaction() blocks, so reads
+        # never hand a connection back to the pool mid-transaction
+        self.pool = AsyncConnectionPool(make_conninfo(**Interface.connection_params(dbname)),
+                                        min_size=min_size, max_size=max_size, kwargs={'autocommit': True},
+                                        open=False)
+        self.batch_size = batch_size
+        self.pending = None
+        self.writers = []
+        # scheme -> (partition count, boundaries, backend, generation); dropped when a fragment
+        # disappears, the generation moved, or Interface invalidated its own cache
+        self.metadata = {}
+        self.metadata_epoch = Interface.partition_metadata_epoch
+
+    async def open(self):
+        await self.pool.open()
+        self.pending = asyncio.Queue()
+        self.writers = [asyncio.create_task(self.write_pending()) for _ in range(self.pool.max_size)]
+
+    async def close(self):
+        if self.pending is not None:
+            await self.pending.join()
+        for writer in self.writers:
+            writer.cancel()
+        await asyncio.gather(*self.writers, return_exceptions=True)
+        self.writers = []
+        await self.pool.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def partition_metadata(self, conn, scheme):
+        '''
+        (partition count, boundaries, backend, generation) of a scheme, read
+        like Interface.get_partition_metadata, falling back to counting tables
+        (generation None).
+        '''
+        if self.metadata_epoch != Interface.partition_metadata_epoch:
+            # this process rebuilt or repartitioned through Interface
+            self.metadata.clear()
+            self.metadata_epoch = Interface.partition_metadata_epoch
+        if scheme in self.metadata:
+            return self.metadata[scheme]
+        async with conn.cursor() as cur:
+            row = None
+            await cur.execute("SELECT to_regclass(%s)", (Interface.PARTITION_METADATA_TABLE,))
+            if (await cur.fetchone())[0] is not None:
+                await cur.execute(SQL("SELECT partition_count, boundaries, backend, generation FROM {} "
+                                      "WHERE scheme = %s").format(Identifier(Interface.PARTITION_METADATA_TABLE)),
+                                  (scheme,))
+                row = await cur.fetchone()
+            if row is None:
+                await cur.execute("SELECT COUNT(*) FROM pg_stat_user_tables WHERE relname LIKE %s",
+                                  (Interface.SCHEME_PREFIXES[scheme] + '%',))
+                row = ((await cur.fetchone())[0], None, 'tables', None)
+        if row[0] > 0:
+            self.metadata[scheme] = row
+        return row
+
+    async def loadratings(self, ratings_table_name, ratings_file_path, block_size=Interface.BLOCK_SIZE):
+        '''
+        Async COPY of ratings.dat into ratings_table_name; returns the number of rows.
+        Blocks are transformed in a thread so the event loop keeps serving
+        other tasks while the file is read.
+        '''
+        blocks = Interface.iter_ratings_blocks(ratings_file_path, block_size=block_size)
+        rows = 0
+        async with self.pool.connection() as conn:
+            async with conn.transaction(), conn.cursor() as cur:
+                await cur.execute(SQL("CREATE TABLE IF NOT EXISTS {} (userid INTEGER, movieid INTEGER, rating FLOAT)")
+                                  .format(Identifier(ratings_table_name)))
+                async with cur.copy(SQL("COPY {} (userid, movieid, rating) FROM STDIN WITH (FORMAT TEXT, DELIMITER E'\\t')")
+                                    .format(Identifier(ratings_table_name))) as copy:
+                    while True:
+                        block = await asyncio.to_thread(next, blocks, None)
+                        if block is None:
+                            break
+                        await copy.write(block)
+                        rows += block.count(b'\n')
+        return rows
+
+    async def insert_many(self, conn, scheme, ratingstablename, rows):
+        '''
+        Write rows to the ratings table and their fragments inside the caller's
+        transaction, routed like Interface.rangeinsert_many / roundrobininsert_many.
+        Raises Interface.StalePartitionMetadata, with the cache dropped, when
+        the range partitions were rebuilt since their metadata was read; the
+        caller rolls back and retries.
+        '''
+        numberofpartitions, boundaries, backend, generation = await self.partition_metadata(conn, scheme)
+        if backend == 'nodes':
+            raise ValueError(f"{scheme} fragments are placed on other nodes; write them through Placement")
+        if numberofpartitions <= 0:
+            raise ValueError(f"No {scheme} partitions found.")
+
+        prefix = Interface.SCHEME_PREFIXES[scheme]
+        try:
+            async with conn.cursor() as cur:
+                groups = {}
+                if backend != 'native':
+                    if scheme == 'range':
+                        edges = boundaries or Interface.range_edges(Interface.range_bounds(numberofpartitions))
+                        for row in rows:
+                            groups.setdefault(Interface.range_fragment_index(row[2], edges), []).append(row)
+                    else:
+                        await cur.execute(SQL("""
+                            UPDATE {} SET rr_cursor = rr_cursor + %s
+                            WHERE scheme = 'roundrobin'
+                            RETURNING rr_cursor - %s, partition_count
+                        """).format(Identifier(Interface.PARTITION_METADATA_TABLE)), (len(rows), len(rows)))
+                        row = await cur.fetchone()
+                        if row is None:
+                            raise ValueError("Round robin partitions have no metadata; "
+                                             "rebuild them with roundrobinpartition.")
+                        # the registry row is locked now, so its count is the live one
+                        slot, numberofpartitions = row
+                        if numberofpartitions != self.metadata.get(scheme, (None,))[0]:
+                            self.metadata.pop(scheme, None)
+                        groups = {(slot + j) % numberofpartitions: rows[j::numberofpartitions]
+                                  for j in range(min(numberofpartitions, len(rows)))}
+                # executemany runs in pipeline mode: one round trip per batch, not per row
+                await cur.executemany(INSERT_SQL.format(Identifier(ratingstablename)), rows)
+                for index, group in groups.items():
+                    await cur.executemany(INSERT_SQL.format(Identifier(f"{prefix}{index}")), group)
+                if scheme == 'range' and generation is not None:
+                    await cur.execute(SQL("SELECT generation FROM {} WHERE scheme = 'range'")
+                                      .format(Identifier(Interface.PARTITION_METADATA_TABLE)))
+                    row = await cur.fetchone()
+                    if row is None or row[0] != generation:
+                        raise Interface.StalePartitionMetadata("range partitions were rebuilt since their "
+                                                               "metadata was read")
+        except (UndefinedTable, Interface.StalePartitionMetadata):
+            self.metadata.pop(scheme, None)
+            raise
+
+    async def write_groups(self, groups):
+        '''
+        Write {(scheme, ratingstablename): rows} in one transaction, again
+        from the start with fresh metadata while it turns out stale.
+        '''
+        while True:
+            try:
+                async with self.pool.connection() as conn:
+                    async with conn.transaction():
+                        for (scheme, ratingstablename), rows in groups.items():
+                            await self.insert_many(conn, scheme, ratingstablename, rows)
+                return
+            except Interface.StalePartitionMetadata:
+                # repartitioned elsewhere; the transaction was rolled back, route again
+                continue
+
+    async def rangeinsert_many(self, ratingstablename, rows):
+        rows = list(rows)
+        await self.write_groups({('range', ratingstablename): rows})
+        Interface.notify_inserted(ratingstablename, rows)
+        return len(rows)
+
+    async def roundrobininsert_many(self, ratingstablename, rows):
+        rows = list(rows)
+        await self.write_groups({('roundrobin', ratingstablename): rows})
+        Interface.notify_inserted(ratingstablename, rows)
+        return len(rows)
+
+    async def submit(self, scheme, ratingstablename, row):
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((scheme, ratingstablename, row, future))
+        return await future
+
+    async def rangeinsert(self, ratingstablename, userid, itemid, rating):
+        await self.submit('range', ratingstablename, (userid, itemid, rating))
+
+    async def roundrobininsert(self, ratingstablename, userid, itemid, rating):
+        await self.submit('roundrobin', ratingstablename, (userid, itemid, rating))
+
+    async def write_pending(self):
+        '''
+        Writer task: take everything queued (up to batch_size rows) and write
+        it in one transaction on one pooled connection.
+        '''
+        while True:
+            batch = [await self.pending.get()]
+            while len(batch) < self.batch_size and not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+            try:
+                groups = {}
+                for scheme, ratingstablename, row, _ in batch:
+                    groups.setdefault((scheme, ratingstablename), []).append(row)
+                await self.write_groups(groups)
+                for (_, ratingstablename), rows in groups.items():
+                    Interface.notify_inserted(ratingstablename, rows)
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for _ in batch:
+                    self.pending.task_done()
+
+    async def fetch(self, query, params=()):
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                return await cur.fetchall()
+
+    async def scan_range_fragments(self, minRating, maxRating, condition, params):
+        async with self.pool.connection() as conn:
+            numberofpartitions, boundaries, backend, _ = await self.partition_metadata(conn, 'range')
+        if backend == 'nodes':
+            raise ValueError("range fragments are placed on other nodes; query them through Placement")
+        if numberofpartitions <= 0:
+            raise ValueError("No range partitions found.")
+        edges = boundaries or Interface.range_edges(Interface.range_bounds(numberofpartitions))
+        indexes = Interface.overlapping_range_fragments(edges, minRating, maxRating)
+        query = SQL("SELECT userid, movieid, rating FROM {} WHERE ")
+        results = await asyncio.gather(*(
+            self.fetch(query.format(Identifier(f"{Interface.RANGE_TABLE_PREFIX}{i}")) + condition, params)
+            for i in indexes))
+        rows = [row for fragment_rows in results for row in fragment_rows]
+        return Interface.QueryResult(rows, len(indexes), len(edges) - 1 - len(indexes))
+
+    async def rangequery(self, ratingMinValue, ratingMaxValue):
+        '''
+        Async Interface.rangequery: the overlapping range fragments are read concurrently.
+        '''
+        return await self.scan_range_fragments(ratingMinValue, ratingMaxValue,
+                                               SQL("rating >= %s AND rating <= %s"), (ratingMinValue, ratingMaxValue))
+
+    async def pointquery(self, ratingValue):
+        return await self.scan_range_fragments(ratingValue, ratingValue, SQL("rating = %s"), (ratingValue,))
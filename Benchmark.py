@@ -0,0 +1,282 @@
+#
+# Benchmarks for the Interface module
+#
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS comes from psutil there
+    resource = None
+
+import Interface as MyAssignment
+import testHelper
+
+DATABASE_NAME = 'dds_assgn1'
+RATINGS_TABLE = 'ratings'
+INPUT_FILE_PATH = './ml-10M100K/ratings.dat'
+SYNTHETIC_DIR = './synthetic'
+MAX_USER_ID = 71567  # same id ranges as MovieLens 10M
+MAX_MOVIE_ID = 65133
+
+
+def percentile(samples, q):
+    """
+    q-th percentile (0-100) of samples by linear interpolation.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    k = (len(ordered) - 1) * q / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def summarize(seconds):
+    return {
+        'count': len(seconds),
+        'p50_ms': percentile(seconds, 50) * 1000,
+        'p95_ms': percentile(seconds, 95) * 1000,
+        'p99_ms': percentile(seconds, 99) * 1000,
+        'max_ms': max(seconds) * 1000,
+    }
+
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident set size of this process in MB, or None when it cannot be read.
+    children=True gives the largest peak among the child processes that have
+    exited instead; it needs the resource module. The worker pool of
+    rangepartition and parallel loads lives until it is closed, so call
+    MyAssignment.close_worker_pool() first for its workers to count.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+    if children:
+        return None
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().peak_wset / 2**20
+
+
+def generate_ratings_file(rows, directory=SYNTHETIC_DIR, seed=0, chunk_rows=1_000_000):
+    """
+    Write a ratings.dat-style file of rows random UserID::MovieID::Rating::Timestamp
+    lines and return its path. Files are named after their size and seed and
+    reused when they already exist.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'ratings_{0}_{1}.dat'.format(rows, seed))
+    if os.path.exists(path):
+        return path
+
+    rng = random.Random(seed)
+    ratings = [k / 2 for k in range(1, 11)]
+    with open(path + '.tmp', 'w') as file:
+        for start in range(0, rows, chunk_rows):
+            file.write(''.join(
+                '{0}::{1}::{2}::{3}\n'.format(rng.randint(1, MAX_USER_ID), rng.randint(1, MAX_MOVIE_ID),
+                                               rng.choice(ratings), rng.randint(789_652_009, 1_231_131_736))
+                for _ in range(min(chunk_rows, rows - start))))
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def benchmark_transform(file_path, repeat=3):
+    """
+    Micro-benchmark: the per-line preprocess_line loop against the mmap block transform.
+    Returns the best time of each in seconds; no database is needed.
+    """
+    def line_loop():
+        size = 0
+        with open(file_path, 'r') as file:
+            for line in file:
+                size += len(MyAssignment.preprocess_line(line))
+        return size
+
+    def block_transform():
+        return sum(len(block) for block in MyAssignment.iter_ratings_blocks(file_path))
+
+    results = {}
+    for name, func in (('preprocess_line', line_loop), ('iter_ratings_blocks', block_transform)):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        results[name] = best
+    return results
+
+
+def benchmark_layouts(dbname, file_path, number_of_partitions=5, inserts=200, queries=20):
+    """
+    rangeinsert and range query latency of the standalone-table layout against
+    the native partitioned backend. Each layout is rebuilt from file_path.
+    """
+    results = {}
+    for backend in MyAssignment.PARTITION_BACKENDS:
+        conn = MyAssignment.getopenconnection(dbname=dbname)
+        try:
+            testHelper.deleteAllPublicTables(conn)
+            conn.commit()
+            MyAssignment.loadratings(RATINGS_TABLE, file_path, conn)
+            MyAssignment.rangepartition(RATINGS_TABLE, number_of_partitions, conn, backend=backend)
+
+            insert_times = []
+            for k in range(inserts):
+                start = time.perf_counter()
+                MyAssignment.rangeinsert(RATINGS_TABLE, 1_000_000 + k, k, (k % 10 + 1) / 2, conn)
+                insert_times.append(time.perf_counter() - start)
+
+            query_times = []
+            with conn.cursor() as cur:
+                for k in range(queries):
+                    minRange = (k % 10) / 2
+                    start = time.perf_counter()
+                    cur.execute("SELECT COUNT(*), AVG(rating) FROM {0} WHERE rating > %s AND rating <= %s"
+                                .format(RATINGS_TABLE), (minRange, minRange + 0.5))
+                    cur.fetchone()
+                    query_times.append(time.perf_counter() - start)
+            conn.commit()
+
+            results[backend] = {'rangeinsert': summarize(insert_times), 'range_query': summarize(query_times)}
+        finally:
+            conn.close()
+    return results
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def benchmark_suite(dbname, sizes=(1_000_000,), partition_counts=(5,), repeat=3, inserts=200):
+    """
+    For every synthetic file size and partition count, repeat times: load the
+    file, range and round robin partition it, then time single-row rangeinsert
+    and roundrobininsert calls. Phase results carry the latency percentiles of
+    the repetitions and rows/s at the median; peak RSS is the peak of this
+    process and of its largest child process after each file size (the
+    worker pool is closed for that, and started again by the next size).
+    """
+    results = []
+    for rows in sizes:
+        file_path = generate_ratings_file(rows)
+        for number_of_partitions in partition_counts:
+            phases = {'loadratings': [], 'rangepartition': [], 'roundrobinpartition': []}
+            insert_times = {'rangeinsert': [], 'roundrobininsert': []}
+            for _ in range(repeat):
+                conn = MyAssignment.getopenconnection(dbname=dbname)
+                try:
+                    testHelper.deleteAllPublicTables(conn)
+                    conn.commit()
+                    phases['loadratings'].append(timed(MyAssignment.loadratings, RATINGS_TABLE, file_path, conn))
+                    phases['rangepartition'].append(
+                        timed(MyAssignment.rangepartition, RATINGS_TABLE, number_of_partitions, conn))
+                    phases['roundrobinpartition'].append(
+                        timed(MyAssignment.roundrobinpartition, RATINGS_TABLE, number_of_partitions, conn))
+                    for k in range(inserts):
+                        userid, rating = MAX_USER_ID + 1 + k, (k % 10 + 1) / 2
+                        insert_times['rangeinsert'].append(
+                            timed(MyAssignment.rangeinsert, RATINGS_TABLE, userid, k, rating, conn))
+                        insert_times['roundrobininsert'].append(
+                            timed(MyAssignment.roundrobininsert, RATINGS_TABLE, userid, k, rating, conn))
+                finally:
+                    conn.close()
+
+            result = {'rows': rows, 'partitions': number_of_partitions, 'repeat': repeat}
+            for phase, seconds in phases.items():
+                result[phase] = dict(summarize(seconds), rows_per_s=rows / percentile(seconds, 50))
+            for phase, seconds in insert_times.items():
+                result[phase] = summarize(seconds)
+            result['peak_rss_mb'] = peak_rss_mb()
+            MyAssignment.close_worker_pool()
+            result['peak_rss_children_mb'] = peak_rss_mb(children=True)
+            results.append(result)
+    return results
+
+
+def wal_position(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_current_wal_lsn()")
+        return cur.fetchone()[0]
+
+
+def wal_bytes_since(conn, lsn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)", (lsn,))
+        return int(cur.fetchone()[0])
+
+
+def benchmark_wal(dbname, file_path, number_of_partitions=5):
+    """
+    WAL bytes written and wall time of loadratings + rangepartition +
+    roundrobinpartition in the default logged mode, the unlogged fast-load
+    mode, and the fast-load mode switched back to LOGGED at the end.
+    The WAL counter is server-wide, so run it on an otherwise idle server.
+    """
+    modes = {
+        'logged': {},
+        'unlogged': {'unlogged': True, 'set_logged': False},
+        'unlogged_set_logged': {'unlogged': True, 'set_logged': True},
+    }
+    results = {}
+    for mode, options in modes.items():
+        conn = MyAssignment.getopenconnection(dbname=dbname)
+        try:
+            testHelper.deleteAllPublicTables(conn)
+            conn.commit()
+            lsn = wal_position(conn)
+            conn.commit()
+            start = time.perf_counter()
+            MyAssignment.loadratings(RATINGS_TABLE, file_path, conn, **options)
+            MyAssignment.rangepartition(RATINGS_TABLE, number_of_partitions, conn, **options)
+            MyAssignment.roundrobinpartition(RATINGS_TABLE, number_of_partitions, conn, **options)
+            seconds = time.perf_counter() - start
+            results[mode] = {'seconds': seconds, 'wal_bytes': wal_bytes_since(conn, lsn)}
+            conn.commit()
+        finally:
+            conn.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the Interface module')
+    parser.add_argument('benchmark', choices=['transform', 'layouts', 'wal', 'suite'])
+    parser.add_argument('path', nargs='?', default=INPUT_FILE_PATH)
+    parser.add_argument('--dbname', default=DATABASE_NAME)
+    parser.add_argument('--partitions', type=int, default=5)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000_000],
+                        help='synthetic file sizes for the suite, e.g. 1000000 10000000 50000000')
+    parser.add_argument('--partition-counts', type=int, nargs='+', default=[5, 10, 20])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--inserts', type=int, default=200)
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    args = parser.parse_args()
+
+    if args.benchmark == 'transform':
+        results = benchmark_transform(args.path)
+        results['speedup'] = results['preprocess_line'] / results['iter_ratings_blocks']
+    elif args.benchmark == 'suite':
+        testHelper.createdb(args.dbname)
+        results = benchmark_suite(args.dbname, args.rows, args.partition_counts, args.repeat, args.inserts)
+    elif args.benchmark == 'wal':
+        testHelper.createdb(args.dbname)
+        results = benchmark_wal(args.dbname, args.path, args.partitions)
+    else:
+        testHelper.createdb(args.dbname)
+        results = benchmark_layouts(args.dbname, args.path, args.partitions)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
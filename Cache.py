@@ -0,0 +1,284 @@
+#
+# In-process columnar cache of the ratings for aggregate and per-key reads
+#
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from psycopg2.sql import SQL, Identifier
+
+import Interface
+
+COPY_BINARY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+# one tuple of COPY (SELECT userid, movieid, rating::real ...) TO STDOUT (FORMAT BINARY):
+# field count, then a length word before every field, all big-endian
+COPY_ROW = np.dtype([('fields', '>i2'),
+                     ('userid_size', '>i4'), ('userid', '>i4'),
+                     ('movieid_size', '>i4'), ('movieid', '>i4'),
+                     ('rating_size', '>i4'), ('rating', '>f4')])
+
+
+class BinaryCopyReader:
+    '''
+    File-like target for COPY ... TO STDOUT (FORMAT BINARY) of (int4, int4,
+    float4) tuples. Whole tuples are parsed into int32 / int32 / float32
+    arrays every block_size bytes, so the raw stream is never held in full.
+    '''
+    def __init__(self, block_size=Interface.BLOCK_SIZE):
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.header = False
+        self.blocks = []
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self.parse()
+
+    def parse(self):
+        start = 0
+        if not self.header:
+            # signature, flags word, header extension length, then the extension
+            if len(self.buffer) < 19:
+                return
+            if self.buffer[:11] != COPY_BINARY_SIGNATURE:
+                raise ValueError("not a binary COPY stream")
+            start = 19 + struct.unpack_from('!i', self.buffer, 15)[0]
+            if len(self.buffer) < start:
+                return
+            self.header = True
+        count = (len(self.buffer) - start) // COPY_ROW.itemsize
+        if count == 0:
+            del self.buffer[:start]
+            return
+        rows = np.frombuffer(self.buffer, COPY_ROW, count, start)
+        if ((rows['fields'] != 3) | (rows['userid_size'] != 4) | (rows['movieid_size'] != 4)
+                | (rows['rating_size'] != 4)).any():
+            raise ValueError("unexpected tuple layout in binary COPY stream")
+        self.blocks.append((rows['userid'].astype(np.int32), rows['movieid'].astype(np.int32),
+                            rows['rating'].astype(np.float32)))
+        del rows
+        del self.buffer[:start + count * COPY_ROW.itemsize]
+
+    def columns(self):
+        '''
+        (userid, movieid, rating) arrays of everything read; the 2-byte trailer is all that may be left over.
+        '''
+        self.parse()
+        if bytes(self.buffer) not in (b'', Interface.COPY_BINARY_TRAILER):
+            raise ValueError("truncated binary COPY stream")
+        if not self.blocks:
+            return np.zeros(0, np.int32), np.zeros(0, np.int32), np.zeros(0, np.float32)
+        return tuple(np.concatenate(column) for column in zip(*self.blocks))
+
+
+def copy_columns(cur, table_name):
+    reader = BinaryCopyReader()
+    cur.copy_expert(SQL("COPY (SELECT userid, movieid, rating::real FROM {} "
+                        "WHERE userid IS NOT NULL AND movieid IS NOT NULL AND rating IS NOT NULL) "
+                        "TO STDOUT (FORMAT BINARY)").format(Identifier(table_name)), reader)
+    return reader.columns()
+
+
+class CSRIndex:
+    '''
+    Row numbers grouped by a non-negative integer key: the rows of key k are
+    order[offsets[k]:offsets[k + 1]], in row order.
+    '''
+    __slots__ = ('offsets', 'order')
+
+    def __init__(self, keys):
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(keys)))).astype(np.int64)
+        self.order = np.argsort(keys, kind='stable').astype(np.int32)
+
+    def rows(self, key):
+        if key < 0 or key + 1 >= len(self.offsets):
+            return self.order[:0]
+        return self.order[self.offsets[key]:self.offsets[key + 1]]
+
+    def extend(self, keys, first_row):
+        '''
+        Add rows first_row, first_row + 1, ... with keys; one pass over order.
+        '''
+        size = max(len(self.offsets) - 1, int(keys.max()) + 1)
+        offsets = np.pad(self.offsets, (0, size + 1 - len(self.offsets)), mode='edge')
+        new = np.argsort(keys, kind='stable')
+        # np.insert keeps values given for the same position in order, so groups stay in row order
+        self.order = np.insert(self.order, offsets[1:][keys[new]], (first_row + new).astype(np.int32))
+        self.offsets = np.concatenate(([0], np.cumsum(np.diff(offsets) + np.bincount(keys, minlength=size))))
+
+
+def grow(array, size):
+    return array if len(array) >= size else np.pad(array, (0, size - len(array)))
+
+
+class RatingsCache:
+    '''
+    Ratings held as three NumPy columns (int32 userid, int32 movieid, float32
+    rating; 12 bytes a row), with CSR indexes by movieid and userid and
+    per-movie / per-user totals for vectorized aggregates.
+    Filled by binary COPY from the ratings table or from the fragments of a
+    scheme. While loaded it listens to Interface inserts into that ratings
+    table: totals are updated at once, rows are kept in a small pending list
+    and merged into the columns and indexes merge_rows at a time. Inserts
+    made by other processes are not seen; reload for those.
+    '''
+    def __init__(self, merge_rows=10_000):
+        self.merge_rows = merge_rows
+        self.lock = threading.Lock()
+        self.ratingstablename = None
+        self.listening = False
+        self.reset(np.zeros(0, np.int32), np.zeros(0, np.int32), np.zeros(0, np.float32))
+
+    def reset(self, userid, movieid, rating):
+        self.userid, self.movieid, self.rating = userid, movieid, rating
+        self.by_movie = CSRIndex(movieid)
+        self.by_user = CSRIndex(userid)
+        self.movie_counts = np.bincount(movieid).astype(np.int64)
+        self.movie_sums = np.bincount(movieid, weights=rating)
+        self.user_counts = np.bincount(userid).astype(np.int64)
+        self.pending = []
+
+    def load(self, openconnection, ratingstablename='ratings', scheme=None, workers=8):
+        '''
+        Fill the cache from ratingstablename, or with scheme ('range' or
+        'roundrobin') from its fragments, one pooled connection each, and
+        start following inserts into ratingstablename. Rows with a NULL
+        column are skipped. Returns the number of rows cached.
+        Fragments placed on other nodes by Placement are refused.
+        '''
+        if scheme is None:
+            cur = openconnection.cursor()
+            try:
+                columns = copy_columns(cur, ratingstablename)
+                openconnection.commit()
+            finally:
+                cur.close()
+        else:
+            Interface.check_local_fragments(scheme, openconnection)
+            table_names = [f"{Interface.SCHEME_PREFIXES[scheme]}{i}"
+                           for i in range(Interface.get_partition_count(scheme, openconnection))]
+            pool = Interface.get_connection_pool(openconnection.info.dbname)
+
+            def copy_fragment(table_name):
+                with pool.connection() as conn:
+                    cur = conn.cursor()
+                    try:
+                        part = copy_columns(cur, table_name)
+                        conn.commit()
+                    finally:
+                        cur.close()
+                return part
+
+            if not table_names:
+                raise ValueError(f"No {scheme} partitions found.")
+            with ThreadPoolExecutor(max_workers=min(workers, len(table_names))) as executor:
+                parts = list(executor.map(copy_fragment, table_names))
+            columns = tuple(np.concatenate(column) for column in zip(*parts))
+
+        with self.lock:
+            self.reset(*columns)
+            self.ratingstablename = ratingstablename
+        if not self.listening:
+            Interface.add_insert_listener(self.on_insert)
+            self.listening = True
+        return len(self)
+
+    def close(self):
+        if self.listening:
+            Interface.remove_insert_listener(self.on_insert)
+            self.listening = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.userid) + len(self.pending)
+
+    def on_insert(self, ratingstablename, rows):
+        if ratingstablename != self.ratingstablename or not rows:
+            return
+        userid = np.array([row[0] for row in rows], dtype=np.int32)
+        movieid = np.array([row[1] for row in rows], dtype=np.int32)
+        rating = np.array([row[2] for row in rows], dtype=np.float32)
+        with self.lock:
+            self.movie_counts = grow(self.movie_counts, int(movieid.max()) + 1)
+            self.movie_sums = grow(self.movie_sums, int(movieid.max()) + 1)
+            self.user_counts = grow(self.user_counts, int(userid.max()) + 1)
+            np.add.at(self.movie_counts, movieid, 1)
+            np.add.at(self.movie_sums, movieid, rating)
+            np.add.at(self.user_counts, userid, 1)
+            self.pending.extend(zip(userid.tolist(), movieid.tolist(), rating.tolist()))
+            if len(self.pending) >= self.merge_rows:
+                self.merge()
+
+    def merge(self):
+        '''
+        Append the pending rows to the columns and indexes; the caller holds the lock.
+        '''
+        if not self.pending:
+            return
+        userid, movieid, rating = (np.array(column, dtype=dtype) for column, dtype in
+                                   zip(zip(*self.pending), (np.int32, np.int32, np.float32)))
+        first_row = len(self.userid)
+        self.by_movie.extend(movieid, first_row)
+        self.by_user.extend(userid, first_row)
+        self.userid = np.concatenate((self.userid, userid))
+        self.movieid = np.concatenate((self.movieid, movieid))
+        self.rating = np.concatenate((self.rating, rating))
+        self.pending = []
+
+    def movie_stats(self):
+        '''
+        (movieids, counts, average ratings) of every movie with a rating.
+        '''
+        with self.lock:
+            movieids = np.flatnonzero(self.movie_counts)
+            counts = self.movie_counts[movieids]
+            return movieids, counts, self.movie_sums[movieids] / counts
+
+    def user_stats(self):
+        '''
+        (userids, counts) of every user with a rating.
+        '''
+        with self.lock:
+            userids = np.flatnonzero(self.user_counts)
+            return userids, self.user_counts[userids]
+
+    def movie_average(self, movieid):
+        with self.lock:
+            if 0 <= movieid < len(self.movie_counts) and self.movie_counts[movieid]:
+                return float(self.movie_sums[movieid] / self.movie_counts[movieid])
+            return None
+
+    def user_count(self, userid):
+        with self.lock:
+            return int(self.user_counts[userid]) if 0 <= userid < len(self.user_counts) else 0
+
+    def lookup(self, key, key_column):
+        '''
+        (other id column, ratings) of the rows whose key_column (0: userid, 1: movieid) equals key.
+        '''
+        with self.lock:
+            index, others = (self.by_user, self.movieid) if key_column == 0 else (self.by_movie, self.userid)
+            rows = index.rows(key)
+            pending = [row for row in self.pending if row[key_column] == key]
+            return (np.concatenate((others[rows], np.array([row[1 - key_column] for row in pending], dtype=np.int32))),
+                    np.concatenate((self.rating[rows], np.array([row[2] for row in pending], dtype=np.float32))))
+
+    def movie_ratings(self, movieid):
+        '''
+        (userids, ratings) of one movie, through the movieid index.
+        '''
+        return self.lookup(movieid, 1)
+
+    def user_ratings(self, userid):
+        '''
+        (movieids, ratings) of one user, through the userid index.
+        '''
+        return self.lookup(userid, 0)
@@ -1,35 +1,221 @@
 import psycopg2
+import psycopg2.pool
 
 import os 
-from io import StringIO
+from io import StringIO, BytesIO
 from psycopg2.sql import SQL, Identifier, Literal
+from psycopg2.extras import execute_values
+from psycopg2.errors import UndefinedTable
+from collections import namedtuple
 import multiprocessing
+import queue
+import threading
+import mmap
+import re
+import struct
+import math
+import bisect
+import time
+import atexit
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
+import Metrics
 
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, transform_block falls back to re
+    np = None
 
 
-def getopenconnection(dbname='postgres'):
-    '''
-    Connect to database 'dbname' through unix socket
-    '''
-    return psycopg2.connect(
+
+
+def connection_params(dbname='postgres', host=None, port=None):
+    return dict(
         dbname=dbname,
         user=os.getenv("USER"), 
         password=os.getenv("PASSWORD"),
-        host=os.getenv("HOST"),
-        port=os.getenv("PORT")
+        host=host or os.getenv("HOST"),
+        port=port or os.getenv("PORT")
     )
 
-def create_db(dbname):
+def getopenconnection(dbname='postgres', host=None, port=None):
+    '''
+    Connect to database 'dbname' through unix socket, or on another server
+    when host / port are given
+    '''
+    return psycopg2.connect(**connection_params(dbname, host, port))
+
+
+class ConnectionPool:
+    '''
+    Thread-safe pool of connections to one database, built on
+    psycopg2.pool.ThreadedConnectionPool. getconn() waits for a free
+    connection instead of raising PoolError, and the wait is recorded.
+    '''
+    def __init__(self, dbname, minconn=1, maxconn=8, host=None, port=None):
+        self.dbname = dbname
+        self.host = host
+        self.port = port
+        self.maxconn = maxconn
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **connection_params(dbname, host, port))
+        self.slots = threading.Semaphore(maxconn)
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def getconn(self):
+        start = time.perf_counter()
+        self.slots.acquire()
+        waited = time.perf_counter() - start
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.acquired += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        # psycopg2 rolls back an unfinished transaction before reusing the connection
+        self.pool.putconn(conn, close=close or conn.closed != 0)
+        with self.lock:
+            self.in_use -= 1
+        self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'dbname': self.dbname,
+                'host': self.host,
+                'port': self.port,
+                'pid': os.getpid(),
+                'maxconn': self.maxconn,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'acquired': self.acquired,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
+
+    def grow(self, maxconn):
+        '''
+        Allow up to maxconn connections; a pool never shrinks, since its connections may be in use.
+        '''
+        with self.lock:
+            if maxconn <= self.maxconn:
+                return
+            self.slots.release(maxconn - self.maxconn)
+            self.pool.maxconn = self.maxconn = maxconn
+
+    def closeall(self):
+        self.pool.closeall()
+
+# (pid, dbname, host, port) -> ConnectionPool; keyed by pid so a forked worker never reuses its parent's sockets
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+worker_pool = None
+worker_processes = 0
+# set in every worker process by init_worker; makes worker_pool_stats reach each worker exactly once
+worker_barrier = None
+
+def get_connection_pool(dbname, maxconn=8, host=None, port=None):
+    '''
+    The ConnectionPool of dbname (on host / port, by default the HOST / PORT
+    server) for the current process, created on first use and grown to allow
+    at least maxconn connections.
+    '''
+    key = (os.getpid(), dbname, host, port)
+    with connection_pools_lock:
+        if key not in connection_pools:
+            connection_pools[key] = ConnectionPool(dbname, maxconn=maxconn, host=host, port=port)
+        pool = connection_pools[key]
+    pool.grow(maxconn)
+    return pool
+
+def connection_pool_stats(workers=False):
+    '''
+    Stats of every connection pool of the current process; with workers=True
+    also those of the worker pool processes, see worker_pool_stats.
+    '''
+    pid = os.getpid()
+    stats = [pool.stats() for key, pool in list(connection_pools.items()) if key[0] == pid]
+    return stats + worker_pool_stats() if workers else stats
+
+def init_worker(barrier):
+    global worker_barrier
+    worker_barrier = barrier
+
+def worker_connection_pool_stats(_):
+    # hold this worker until every other one has taken a task too
+    worker_barrier.wait(timeout=60)
+    return connection_pool_stats()
+
+def worker_pool_stats():
+    '''
+    Connection pool stats of every worker process, or [] while there is no
+    worker pool. Runs one task per worker, so call it while the pool is idle.
+    '''
+    if worker_pool is None:
+        return []
+    results = worker_pool.map(worker_connection_pool_stats, range(worker_processes), chunksize=1)
+    return [stats for worker_stats in results for stats in worker_stats]
+
+def get_worker_pool():
+    '''
+    Process pool shared by the partitioning and loading entry points. It stays
+    alive between calls, and so do the connection pools of its workers.
+    '''
+    global worker_pool, worker_processes
+    if worker_pool is None:
+        worker_processes = os.cpu_count() or 1
+        worker_pool = multiprocessing.Pool(worker_processes, init_worker,
+                                           (multiprocessing.Barrier(worker_processes),))
+    return worker_pool
+
+def close_worker_pool():
+    global worker_pool
+    if worker_pool is not None:
+        worker_pool.close()
+        worker_pool.join()
+        worker_pool = None
+
+def close_connection_pools():
+    pid = os.getpid()
+    with connection_pools_lock:
+        for key in [key for key in connection_pools if key[0] == pid]:
+            connection_pools.pop(key).closeall()
+
+atexit.register(close_connection_pools)
+atexit.register(close_worker_pool)
+
+def create_db(dbname, host=None, port=None):
     """
     We create a DB by connecting to the default user and database of Postgres
     The function first checks if an existing database exists for a given name, else creates it.
+    host / port select another server than HOST / PORT.
     :return:None
     """
     conn = None
     cur = None 
     try:
-        conn = getopenconnection(dbname='postgres') 
+        conn = getopenconnection(dbname='postgres', host=host, port=port) 
         conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         cur = conn.cursor()
 
@@ -49,43 +235,376 @@ def create_db(dbname):
         if cur: cur.close() 
         if conn: conn.close() 
 
+RANGE_TABLE_PREFIX = 'range_part'
+RROBIN_TABLE_PREFIX = 'rrobin_part'
+# partitioning scheme -> prefix of its fragment tables
+SCHEME_PREFIXES = {
+    'range': RANGE_TABLE_PREFIX,
+    'roundrobin': RROBIN_TABLE_PREFIX,
+}
+MAX_RATING_SCALE = 5.0
+PARTITION_METADATA_TABLE = 'partition_metadata'
+
+BLOCK_SIZE = 16 * 1024 * 1024
+# "::timestamp" at the end of a line, including an optional \r
+TIMESTAMP_FIELD = re.compile(rb'::[^:\n]*\n')
+
+# PostgreSQL binary COPY: signature, flags, header extension length ... tuples ... -1
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('!h', -1)
+# field count, then (length, value) for int4 userid, int4 movieid, float8 rating
+BINARY_ROW = struct.Struct('!hiiiiid')
+COPY_FORMATS = ('text', 'binary')
+if np is not None:
+    BINARY_ROW_DTYPE = np.dtype([
+        ('fields', '>i2'),
+        ('userid_len', '>i4'), ('userid', '>i4'),
+        ('movieid_len', '>i4'), ('movieid', '>i4'),
+        ('rating_len', '>i4'), ('rating', '>f8'),
+    ])
+
 # helper func
 def preprocess_line(line):
     parts = line.strip().split("::")
     return f"{parts[0]}\t{parts[1]}\t{parts[2]}\n"
 
+def create_ratings_table(cur, ratings_table_name, unlogged=False):
+    cur.execute(SQL("""
+        CREATE {}TABLE IF NOT EXISTS {} (
+            userid INTEGER,
+            movieid INTEGER,
+            rating FLOAT
+        );
+    """).format(SQL("UNLOGGED ") if unlogged else SQL(""), Identifier(ratings_table_name)))
+
+def finish_fast_load(table_names, openconnection, set_logged=True):
+    '''
+    End of an unlogged load: ANALYZE the tables so the planner sees their new
+    contents and, with set_logged=True, make them crash-safe again. SET LOGGED
+    rewrites each table once, and that rewrite goes to the WAL unless
+    wal_level is minimal; leave the tables UNLOGGED when they can be rebuilt
+    from the file after a crash.
+    '''
+    cur = openconnection.cursor()
+    try:
+        for table_name in table_names:
+            if set_logged:
+                cur.execute(SQL("ALTER TABLE {} SET LOGGED;").format(Identifier(table_name)))
+            cur.execute(SQL("ANALYZE {};").format(Identifier(table_name)))
+        openconnection.commit()
+    except Exception:
+        openconnection.rollback()
+        raise
+    finally:
+        cur.close()
+
+def copy_ratings_sql(ratings_table_name, format='text'):
+    if format == 'binary':
+        return SQL("""
+            COPY {} (userid, movieid, rating)
+            FROM STDIN WITH (FORMAT BINARY)
+        """).format(Identifier(ratings_table_name))
+    return SQL("""
+        COPY {} (userid, movieid, rating) 
+        FROM STDIN WITH (FORMAT TEXT, DELIMITER E'\t')
+    """).format(Identifier(ratings_table_name))
+
+def split_file_offsets(file_path, number_of_chunks):
+    '''
+    Split a file into at most number_of_chunks (start, end) byte ranges.
+    Every boundary is moved forward to the next newline so no line is cut in two.
+    '''
+    size = os.path.getsize(file_path)
+    offsets = [0]
+    with open(file_path, 'rb') as f:
+        for i in range(1, number_of_chunks):
+            f.seek(max(size * i // number_of_chunks, offsets[-1]))
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > offsets[-1]:
+                offsets.append(pos)
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if end > start]
+
+def transform_block(block):
+    '''
+    Turn a block of complete '::'-delimited lines into tab-delimited userid/movieid/rating bytes.
+    Uses a vectorized NumPy scan when available, otherwise one regex pass for the
+    timestamp (plus any \\r) and bytes.replace for the separators, so no
+    per-line Python work is done either way.
+    '''
+    if block and not block.endswith(b'\n'):
+        block += b'\n'
+    if np is not None:
+        out = transform_block_numpy(block)
+        if out is not None:
+            return out
+    return TIMESTAMP_FIELD.sub(b'\n', block).replace(b'::', b'\t')
+
+def transform_block_numpy(block):
+    '''
+    NumPy version of transform_block for blocks where every line has exactly three
+    '::' separators. Returns None for anything else so the caller falls back.
+    '''
+    data = np.frombuffer(block, dtype=np.uint8)
+    colons = np.flatnonzero(data == ord(':'))
+    newlines = np.flatnonzero(data == ord('\n'))
+    if len(colons) != 6 * len(newlines):
+        return None
+    if len(newlines):
+        per_line = colons.reshape(-1, 6)
+        if (np.any(per_line[:, 1::2] != per_line[:, 0::2] + 1)
+                or np.any(per_line[:, 5] > newlines)
+                or np.any(per_line[1:, 0] < newlines[:-1])):
+            return None
+
+    # Drop everything from the third '::' up to (not including) the newline
+    marks = np.zeros(len(data) + 1, dtype=np.int8)
+    marks[colons[4::6]] = 1
+    marks[newlines] = -1
+    keep = np.cumsum(marks[:-1], dtype=np.int8) == 0
+    keep[colons[1::6]] = False
+    keep[colons[3::6]] = False
+
+    out = data.copy()
+    out[colons[0::6]] = ord('\t')
+    out[colons[2::6]] = ord('\t')
+    return out[keep].tobytes()
+
+def iter_ratings_blocks(ratings_file_path, start=0, end=None, block_size=BLOCK_SIZE):
+    '''
+    mmap ratings_file_path and yield bytes [start, end) as ready-to-COPY blocks of
+    about block_size bytes, each cut at a newline.
+    '''
+    with open(ratings_file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for pos, stop in iter_block_ranges(mm, start, end, block_size):
+                yield transform_block(mm[pos:stop])
+
+def iter_block_ranges(mm, start, end, block_size):
+    '''
+    (start, stop) byte ranges of about block_size bytes covering [start, end)
+    of mm, each cut right after a newline.
+    '''
+    pos = start
+    while pos < end:
+        stop = min(pos + block_size, end)
+        if stop < end:
+            newline = mm.rfind(b'\n', pos, stop)
+            if newline < 0:
+                newline = mm.find(b'\n', stop, end)
+            stop = end if newline < 0 else newline + 1
+        yield pos, stop
+        pos = stop
+
+def encode_binary_block(block):
+    '''
+    Encode a tab-delimited block from transform_block as binary COPY tuples
+    (int4 userid, int4 movieid, float8 rating), without header or trailer.
+    '''
+    fields = block.split()
+    if np is not None:
+        values = np.array(fields, dtype=np.float64).reshape(-1, 3)
+        rows = np.empty(len(values), dtype=BINARY_ROW_DTYPE)
+        rows['fields'] = 3
+        rows['userid_len'] = 4
+        rows['userid'] = values[:, 0]
+        rows['movieid_len'] = 4
+        rows['movieid'] = values[:, 1]
+        rows['rating_len'] = 8
+        rows['rating'] = values[:, 2]
+        return rows.tobytes()
+
+    pack = BINARY_ROW.pack
+    return b''.join(pack(3, 4, int(userid), 4, int(movieid), 8, float(rating))
+                    for userid, movieid, rating in zip(*[iter(fields)] * 3))
+
+def iter_copy_blocks(ratings_file_path, start=0, end=None, block_size=BLOCK_SIZE, format='text'):
+    '''
+    Blocks for one complete COPY FROM STDIN stream of bytes [start, end) in the given format.
+    '''
+    blocks = iter_ratings_blocks(ratings_file_path, start, end, block_size)
+    if format != 'binary':
+        yield from blocks
+        return
+
+    yield COPY_BINARY_HEADER
+    for block in blocks:
+        yield encode_binary_block(block)
+    yield COPY_BINARY_TRAILER
+
+class BlockStream:
+    '''
+    Read-only file-like object that feeds COPY FROM STDIN from an iterator of byte blocks.
+    An exception yielded by the iterator is re-raised here so the COPY fails
+    instead of hanging. Rows are counted by newlines, or by row_size for
+    fixed-size binary tuples (the binary header and trailer are shorter than
+    a row, so they count as zero); bytes counts everything handed to COPY.
+    '''
+    def __init__(self, blocks, row_size=None):
+        self.blocks = blocks
+        self.row_size = row_size
+        self.chunk = memoryview(b'')
+        self.pos = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def read(self, size=-1):
+        while self.pos >= len(self.chunk):
+            item = next(self.blocks, None)
+            if item is None:
+                return b''
+            if isinstance(item, BaseException):
+                raise item
+            self.chunk = memoryview(item)
+            self.pos = 0
+            self.rows += len(item) // self.row_size if self.row_size else item.count(b'\n')
+            self.bytes += len(item)
+
+        end = len(self.chunk) if size is None or size < 0 else self.pos + size
+        data = self.chunk[self.pos:end].tobytes()
+        self.pos += len(data)
+        return data
+
+def copy_stream(blocks, format='text'):
+    return BlockStream(blocks, BINARY_ROW.size if format == 'binary' else None)
+
+def load_chunk(args):
+    '''
+    Helper func for parallel loadratings: transform bytes [start, end) of the file
+    and COPY them over a dedicated connection. Returns (rows loaded, bytes sent, seconds).
+    '''
+    ratings_table_name, ratings_file_path, start, end, dbname, block_size, format = args
+    started = time.perf_counter()
+    stream = copy_stream(iter_copy_blocks(ratings_file_path, start, end, block_size, format), format)
+
+    with get_connection_pool(dbname).connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.copy_expert(copy_ratings_sql(ratings_table_name, format), stream)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+    return stream.rows, stream.bytes, time.perf_counter() - started
+
+
+def put_until_stopped(buffers, item, stop):
+    '''
+    Block while the queue is full, but give up once stop is set so a producer
+    never hangs on a consumer that has died. Returns False if it gave up.
+    '''
+    while not stop.is_set():
+        try:
+            buffers.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def produce_ratings_buffers(ratings_file_path, buffers, block_size, stop, format='text'):
+    '''
+    Producer side of the loadratings pipeline: transform the file block by block
+    into ready-to-COPY bytes. put() blocks while the queue is full, which keeps
+    peak memory at roughly (queue depth + 2) blocks. None marks the end.
+    '''
+    try:
+        for block in iter_copy_blocks(ratings_file_path, block_size=block_size, format=format):
+            put_until_stopped(buffers, block, stop)
+        put_until_stopped(buffers, None, stop)
+    except Exception as e:
+        put_until_stopped(buffers, e, stop)
+
+
 # best time: 7.82s
-def loadratings(ratings_table_name, ratings_file_path, open_connection):
+def loadratings(ratings_table_name, ratings_file_path, open_connection, workers=1,
+                pipeline=False, queue_depth=8, block_size=BLOCK_SIZE, fast=False, format='text',
+                indexes=False, maintenance_work_mem='256MB', unlogged=False, set_logged=True,
+                resume=False, append=False, replace=False):
+    '''
+    Load ratings.dat into ratings_table_name and return the number of rows loaded.
+    With workers > 1 the file is split into that many slices at newline-aligned
+    byte offsets; processes of the shared worker pool transform the slices and
+    COPY them over their pooled connections. Each slice commits separately, so
+    a failed parallel load can leave partial data.
+    With pipeline=True a reader thread transforms block_size-byte blocks into a
+    queue of at most queue_depth blocks while a single COPY stream drains it.
+    With fast=True the mmap block transform is used without the extra thread.
+    format='binary' sends PostgreSQL binary COPY tuples instead of text, which
+    saves the server from parsing every number; it implies the block transform.
+    indexes=True builds the (userid), (movieid) and BRIN (rating) indexes once
+    the rows are in; see build_indexes.
+    unlogged=True creates the table UNLOGGED so the COPY writes no WAL, then
+    hands it to finish_fast_load (ANALYZE, and SET LOGGED unless set_logged=False).
+    An existing table keeps its persistence.
+    resume=True commits after every block and checkpoints the byte offset in
+    load_progress, so a rerun after a failure continues where the last one
+    stopped; append=True also ingests lines added to the file since; see
+    load_ratings_resumable. Both load text blocks over open_connection, so
+    they cannot be combined with workers, pipeline or format='binary'.
+    replace=True lets them truncate a table that holds rows of other loads.
+    Every phase is reported to the Metrics listeners, if any.
+    '''
+    if (resume or append) and (workers > 1 or pipeline or format != 'text'):
+        raise ValueError("resume / append loads do not support workers, pipeline or format='binary'")
+    with Metrics.span('loadratings', table=ratings_table_name) as span:
+        if resume or append:
+            rows = load_ratings_resumable(ratings_table_name, ratings_file_path, open_connection, block_size, append,
+                                          unlogged, replace)
+        else:
+            rows = load_ratings_file(ratings_table_name, ratings_file_path, open_connection, workers,
+                                     pipeline, queue_depth, block_size, fast, format, unlogged)
+        if unlogged:
+            finish_fast_load([ratings_table_name], open_connection, set_logged)
+        if indexes:
+            build_indexes([ratings_table_name], open_connection, maintenance_work_mem)
+        span.rows = rows
+    return rows
+
+def load_ratings_file(ratings_table_name, ratings_file_path, open_connection, workers,
+                      pipeline, queue_depth, block_size, fast, format, unlogged=False):
     conn = open_connection
     cur = None
 
+    if format not in COPY_FORMATS:
+        raise ValueError(f"Unknown COPY format: {format}")
+    if workers > 1:
+        return load_ratings_parallel(ratings_table_name, ratings_file_path, open_connection, workers, block_size, format,
+                                     unlogged)
+    if pipeline or fast or format != 'text':
+        return load_ratings_stream(ratings_table_name, ratings_file_path, open_connection,
+                                   queue_depth if pipeline else 0, block_size, format, unlogged)
+
     try:
         cur = conn.cursor()
 
         # Tạo bảng nếu chưa tồn tại
-        cur.execute(SQL("""
-            CREATE TABLE IF NOT EXISTS {} (
-                userid INTEGER,
-                movieid INTEGER,
-                rating FLOAT
-            );
-        """).format(Identifier(ratings_table_name)))
+        create_ratings_table(cur, ratings_table_name, unlogged)
         conn.commit()
 
         # Load dữ liệu theo batch
         batch_size = 200_000
         buffer = StringIO()
+        copy_sql = copy_ratings_sql(ratings_table_name)
+        rows = 0
+        copy_bytes = 0
 
-        with open(ratings_file_path, 'r') as file:
-            for i, line in enumerate(file, 1):
+        with Metrics.span('copy', table=ratings_table_name) as span, open(ratings_file_path, 'r') as file:
+            for rows, line in enumerate(file, 1):
                 buffer.write(preprocess_line(line))
 
-                if i % batch_size == 0:
+                if rows % batch_size == 0:
+                    copy_bytes += buffer.tell()
                     buffer.seek(0)
-                    copy_sql = SQL("""
-                        COPY {} (userid, movieid, rating) 
-                        FROM STDIN WITH (FORMAT TEXT, DELIMITER E'\t')
-                    """).format(Identifier(ratings_table_name))
                     cur.copy_expert(copy_sql, buffer)
 
                     buffer.seek(0)
@@ -93,14 +612,13 @@ def loadratings(ratings_table_name, ratings_file_path, open_connection):
 
             # Insert phần còn lại chưa đến batch
             if buffer.tell():
+                copy_bytes += buffer.tell()
                 buffer.seek(0)
-                copy_sql = SQL("""
-                    COPY {} (userid, movieid, rating) 
-                    FROM STDIN WITH (FORMAT TEXT, DELIMITER E'\t')
-                """).format(Identifier(ratings_table_name))
                 cur.copy_expert(copy_sql, buffer)
 
-        conn.commit()
+            conn.commit()
+            span.rows, span.bytes = rows, copy_bytes
+        return rows
 
     except (psycopg2.Error, IOError, Exception) as e:
         print("Error:", e)
@@ -111,6 +629,165 @@ def loadratings(ratings_table_name, ratings_file_path, open_connection):
     finally:
         if cur:
             cur.close() 
+
+def load_ratings_parallel(ratings_table_name, ratings_file_path, open_connection, workers, block_size=BLOCK_SIZE,
+                          format='text', unlogged=False):
+    cur = open_connection.cursor()
+    create_ratings_table(cur, ratings_table_name, unlogged)
+    open_connection.commit()
+    cur.close()
+
+    dbname = open_connection.info.dbname
+    args = [(ratings_table_name, ratings_file_path, start, end, dbname, block_size, format)
+            for start, end in split_file_offsets(ratings_file_path, workers)]
+    with Metrics.span('pool_startup'):
+        pool = get_worker_pool()
+    rows = 0
+    for chunk, (chunk_rows, chunk_bytes, seconds) in enumerate(pool.map(load_chunk, args)):
+        Metrics.emit('copy', seconds, chunk_rows, chunk_bytes, data={'chunk': chunk}, table=ratings_table_name)
+        rows += chunk_rows
+    return rows
+
+def load_ratings_stream(ratings_table_name, ratings_file_path, open_connection, queue_depth, block_size,
+                        format='text', unlogged=False):
+    '''
+    Single-COPY load fed by the mmap block transform. With queue_depth > 0 the
+    blocks are produced by a reader thread through a bounded queue.
+    '''
+    stop = threading.Event()
+    producer = None
+    if queue_depth > 0:
+        buffers = queue.Queue(maxsize=queue_depth)
+        producer = threading.Thread(target=produce_ratings_buffers,
+                                    args=(ratings_file_path, buffers, block_size, stop, format),
+                                    daemon=True)
+        stream = copy_stream(iter(buffers.get, None), format)
+    else:
+        stream = copy_stream(iter_copy_blocks(ratings_file_path, block_size=block_size, format=format), format)
+    cur = open_connection.cursor()
+
+    try:
+        create_ratings_table(cur, ratings_table_name, unlogged)
+        open_connection.commit()
+
+        if producer:
+            producer.start()
+        # One COPY for the whole file: psycopg2 releases the GIL while sending,
+        # so the producer keeps transforming the next blocks in the meantime.
+        with Metrics.span('copy', table=ratings_table_name) as span:
+            cur.copy_expert(copy_ratings_sql(ratings_table_name, format), stream)
+            open_connection.commit()
+            span.rows, span.bytes = stream.rows, stream.bytes
+        return stream.rows
+
+    except Exception as e:
+        print("Error:", e)
+        open_connection.rollback()
+        raise
+
+    finally:
+        stop.set()
+        if producer and producer.is_alive():
+            producer.join()
+        cur.close()
+
+LOAD_PROGRESS_TABLE = 'load_progress'
+
+def create_load_progress_table(cur):
+    cur.execute(SQL("""
+        CREATE TABLE IF NOT EXISTS {} (
+            table_name TEXT,
+            file_path TEXT,
+            byte_offset BIGINT NOT NULL DEFAULT 0,
+            rows BIGINT NOT NULL DEFAULT 0,
+            completed BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (table_name, file_path)
+        );
+    """).format(Identifier(LOAD_PROGRESS_TABLE)))
+
+def load_ratings_resumable(ratings_table_name, ratings_file_path, open_connection, block_size=BLOCK_SIZE,
+                           append=False, unlogged=False, replace=False):
+    '''
+    Load ratings_file_path block by block, committing each block together with
+    the byte offset it ends at in load_progress. Returns the rows loaded by this call.
+    Files are identified by their real path (symlinks resolved). A table can
+    take several files, each with its own checkpoint; the first run for a
+    file starts at byte 0 without touching rows loaded from the others, and
+    later runs continue from the checkpoint and do nothing once the file is
+    completed. A table holding rows that no resumable load accounts for
+    (e.g. from a plain loadratings) is refused, since those rows would be
+    duplicated, unless replace=True, which truncates it and forgets its
+    other checkpoints.
+    append=True always continues from the checkpoint, for a file that keeps
+    growing; it only takes complete lines, so a final line still being written
+    waits for the next run.
+    A checkpoint that moved under us (a second loader) aborts the block.
+    '''
+    file_path = os.path.realpath(ratings_file_path)
+    key = (ratings_table_name, file_path)
+    progress_table = Identifier(LOAD_PROGRESS_TABLE)
+    cur = open_connection.cursor()
+    rows = 0
+    try:
+        create_load_progress_table(cur)
+        create_ratings_table(cur, ratings_table_name, unlogged)
+        cur.execute(SQL("SELECT byte_offset, completed FROM {} WHERE table_name = %s AND file_path = %s;")
+                    .format(progress_table), key)
+        progress = cur.fetchone()
+        if progress is None or replace:
+            if replace:
+                cur.execute(SQL("TRUNCATE {};").format(Identifier(ratings_table_name)))
+                cur.execute(SQL("DELETE FROM {} WHERE table_name = %s;").format(progress_table), (ratings_table_name,))
+            else:
+                cur.execute(SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE table_name = %s), EXISTS (SELECT 1 FROM {});")
+                            .format(progress_table, Identifier(ratings_table_name)), (ratings_table_name,))
+                tracked, has_rows = cur.fetchone()
+                if has_rows and not tracked:
+                    raise ValueError(f"{ratings_table_name} holds rows of a load that was not resumable; "
+                                     "pass replace=True to truncate it")
+            cur.execute(SQL("INSERT INTO {} (table_name, file_path) VALUES (%s, %s);").format(progress_table), key)
+            offset, completed = 0, False
+        else:
+            offset, completed = progress
+        open_connection.commit()
+        if completed and not append:
+            return 0
+
+        with open(file_path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if offset > size:
+                raise ValueError(f"{file_path} is shorter than its checkpoint ({size} < {offset} bytes)")
+            if size > offset:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    end = mm.rfind(b'\n') + 1 if append else size
+                    for pos, stop in iter_block_ranges(mm, offset, end, block_size):
+                        with Metrics.span('copy', data={'offset': pos}, table=ratings_table_name) as span:
+                            block = transform_block(mm[pos:stop])
+                            cur.copy_expert(copy_ratings_sql(ratings_table_name), BytesIO(block))
+                            count = block.count(b'\n')
+                            cur.execute(SQL("""
+                                UPDATE {} SET byte_offset = %s, rows = rows + %s
+                                WHERE table_name = %s AND file_path = %s AND byte_offset = %s;
+                            """).format(progress_table), (stop, count) + key + (pos,))
+                            if cur.rowcount != 1:
+                                raise RuntimeError(f"load_progress of {ratings_table_name} moved during the load")
+                            open_connection.commit()
+                            span.rows, span.bytes = count, len(block)
+                        rows += count
+
+        cur.execute(SQL("UPDATE {} SET completed = TRUE WHERE table_name = %s AND file_path = %s;")
+                    .format(progress_table), key)
+        open_connection.commit()
+        return rows
+
+    except Exception as e:
+        print("Error:", e)
+        open_connection.rollback()
+        raise
+
+    finally:
+        cur.close()
+
 # def loadratings(ratingstablename, ratingsfilepath, openconnection):
 #     con = openconnection
 #     cur = con.cursor()
@@ -121,70 +798,632 @@ def loadratings(ratings_table_name, ratings_file_path, open_connection):
 #     con.commit()
 
 
+PartitionMetadata = namedtuple('PartitionMetadata', 'scheme partition_count boundaries rr_cursor backend generation')
+PARTITION_BACKENDS = ('tables', 'native')
+
+# (connection dsn, scheme) -> PartitionMetadata, dropped whenever this process rebuilds partitions.
+# Rebuilds by other processes bump the recorded generation, which inserts check (see check_partition_generation).
+# rr_cursor in a cached entry is only a snapshot; reserve_rr_slots reads the live value.
+partition_metadata_cache = {}
+
+# bumped by every invalidate_partition_metadata call, so caches kept elsewhere (AsyncInterface) can follow it
+partition_metadata_epoch = 0
+
+class StalePartitionMetadata(Exception):
+    '''
+    The partitioning was rebuilt or repartitioned since its metadata was
+    cached; the insert that found out is rolled back and retried.
+    '''
+
+def create_partition_metadata_table(cur):
+    cur.execute(SQL("""
+        CREATE TABLE IF NOT EXISTS {} (
+            scheme TEXT PRIMARY KEY,
+            partition_count INTEGER NOT NULL,
+            boundaries FLOAT[],
+            rr_cursor BIGINT NOT NULL DEFAULT 0,
+            backend TEXT NOT NULL DEFAULT 'tables',
+            generation BIGINT NOT NULL DEFAULT 0
+        );
+        ALTER TABLE {} ADD COLUMN IF NOT EXISTS backend TEXT NOT NULL DEFAULT 'tables';
+        ALTER TABLE {} ADD COLUMN IF NOT EXISTS generation BIGINT NOT NULL DEFAULT 0;
+    """).format(Identifier(PARTITION_METADATA_TABLE), Identifier(PARTITION_METADATA_TABLE),
+                Identifier(PARTITION_METADATA_TABLE)))
+
+def save_partition_metadata(cur, scheme, partition_count, boundaries=None, backend='tables'):
+    '''
+    Record the scheme ('range' or 'roundrobin'), partition count, range
+    boundaries and backend ('tables', 'native', or 'nodes' for fragments
+    placed on other servers by Placement) of a (re)built partitioning,
+    inside the caller's transaction, and bump its generation so that other
+    processes drop their cached copy on their next insert.
+    Call invalidate_partition_metadata() once that transaction commits.
+    '''
+    create_partition_metadata_table(cur)
+    cur.execute(SQL("""
+        INSERT INTO {} AS m (scheme, partition_count, boundaries, rr_cursor, backend)
+        VALUES (%s, %s, %s, 0, %s)
+        ON CONFLICT (scheme) DO UPDATE
+        SET partition_count = EXCLUDED.partition_count,
+            boundaries = EXCLUDED.boundaries,
+            rr_cursor = 0,
+            backend = EXCLUDED.backend,
+            generation = m.generation + 1;
+    """).format(Identifier(PARTITION_METADATA_TABLE)), (scheme, partition_count, boundaries, backend))
+
+def invalidate_partition_metadata(openconnection=None):
+    '''
+    Forget cached metadata, for one connection's database or for all of them.
+    '''
+    global partition_metadata_epoch
+    partition_metadata_epoch += 1
+    if openconnection is None:
+        partition_metadata_cache.clear()
+        return
+    for key in [key for key in partition_metadata_cache if key[0] == openconnection.dsn]:
+        del partition_metadata_cache[key]
+
+def get_partition_metadata(scheme, openconnection):
+    '''
+    Cached PartitionMetadata of scheme, or None if no partitioning was recorded.
+    Misses are not cached, so a later rebuild is picked up.
+    '''
+    key = (openconnection.dsn, scheme)
+    if key in partition_metadata_cache:
+        return partition_metadata_cache[key]
+
+    cur = openconnection.cursor()
+    try:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (PARTITION_METADATA_TABLE,))
+        row = None
+        if cur.fetchone()[0]:
+            cur.execute(SQL("SELECT scheme, partition_count, boundaries, rr_cursor, backend, generation FROM {} "
+                            "WHERE scheme = %s").format(Identifier(PARTITION_METADATA_TABLE)), (scheme,))
+            row = cur.fetchone()
+    finally:
+        cur.close()
+
+    if row is None:
+        return None
+    metadata = PartitionMetadata(*row)
+    partition_metadata_cache[key] = metadata
+    return metadata
+
+def check_partition_generation(cur, scheme, metadata):
+    '''
+    Raise StalePartitionMetadata unless scheme is still partitioned the way
+    metadata (None: no registry) says. Run it after the fragment writes of
+    a transaction: they lock their fragments, so no rebuild can commit under
+    them any more, and one that committed earlier shows up here.
+    '''
+    if metadata is None:
+        return
+    cur.execute(SQL("SELECT generation FROM {} WHERE scheme = %s").format(Identifier(PARTITION_METADATA_TABLE)),
+                (scheme,))
+    row = cur.fetchone()
+    if row is None or row[0] != metadata.generation:
+        raise StalePartitionMetadata(f"{scheme} partitions were rebuilt since their metadata was read")
+
+def get_partition_count(scheme, openconnection):
+    '''
+    Number of partitions of scheme, from the metadata registry; partitions built
+    without it (e.g. by an older version) fall back to counting catalog tables.
+    '''
+    metadata = get_partition_metadata(scheme, openconnection)
+    if metadata is not None:
+        return metadata.partition_count
+    return count_partitions(SCHEME_PREFIXES[scheme], openconnection)
+
+def is_native(scheme, openconnection):
+    '''
+    True if scheme is served by a native partitioned parent, whose rows must be
+    inserted once into the parent instead of into both tables. Fragments
+    placed on other nodes are not local tables at all, so writing them here
+    is refused.
+    '''
+    metadata = get_partition_metadata(scheme, openconnection)
+    if metadata is not None and metadata.backend == 'nodes':
+        raise ValueError(f"{scheme} fragments are placed on other nodes; write them through Placement")
+    return metadata is not None and metadata.backend == 'native'
+
+def range_edges(bounds):
+    return [bounds[0][0]] + [maxRange for _, maxRange in bounds]
+
+def range_fragment_index(rating, edges):
+    '''
+    Index of the range fragment that owns rating, by binary search over the
+    boundaries: fragment i holds (edges[i], edges[i + 1]], and out-of-scale
+    ratings are clamped into the first and last fragments.
+    '''
+    return bisect.bisect_left(edges, rating, 1, len(edges) - 1) - 1
+
+def range_fragment_indexes(ratings, edges):
+    '''
+    Vectorized range_fragment_index for a NumPy array of ratings.
+    '''
+    return np.searchsorted(np.asarray(edges[1:-1], dtype=np.float64), ratings, side='left')
+
+# estimated rows per range fragment under equal-width and under equi-depth boundaries
+SkewReport = namedtuple('SkewReport', 'equal_width equi_depth')
+
+# SkewReport of the latest equi-depth rangepartition or repartition
+range_skew_report = None
+
+def fragment_skew(sizes):
+    '''
+    Largest fragment over the mean fragment size; 1.0 is a perfectly even split.
+    '''
+    mean = sum(sizes) / len(sizes)
+    return max(sizes) / mean if mean else 1.0
+
+def sample_rating_histogram(ratings_table_name, cur, sample_percent=1.0):
+    '''
+    [(rating, estimated rows)] sorted by rating, from a TABLESAMPLE SYSTEM scan
+    of sample_percent of the table's pages. A small table can sample no page
+    at all; it is then read in full.
+    '''
+    query = SQL("SELECT rating, COUNT(*) FROM {} {} WHERE rating IS NOT NULL GROUP BY rating ORDER BY rating;")
+    if sample_percent < 100:
+        cur.execute(query.format(Identifier(ratings_table_name),
+                                 SQL("TABLESAMPLE SYSTEM ({})").format(Literal(sample_percent))))
+        histogram = cur.fetchall()
+        if histogram:
+            return [(rating, rows * 100 / sample_percent) for rating, rows in histogram]
+    cur.execute(query.format(Identifier(ratings_table_name), SQL("")))
+    return cur.fetchall()
+
+def pack_histogram(histogram, capacity, runs=None):
+    '''
+    Greedy split of a sorted histogram into runs of at most capacity rows;
+    returns the last rating of every run. With runs given, runs are also cut
+    early once every remaining rating is needed to open one of them.
+    '''
+    ends, run = [], 0
+    for k, (rating, rows) in enumerate(histogram):
+        spare = runs is not None and len(histogram) - k <= runs - len(ends) - 1
+        if run and (run + rows > capacity or spare):
+            ends.append(histogram[k - 1][0])
+            run = 0
+        run += rows
+    return ends + [histogram[-1][0]]
+
+def equi_depth_edges(histogram, numberofpartitions):
+    '''
+    Range boundaries giving the fragments about the same number of rows: the
+    sorted histogram is cut into N runs so that the largest run is as small
+    as possible. Rows of one rating never straddle two fragments, so a
+    rating holding more than 1 / N of the rows gets a larger fragment, and
+    with fewer distinct ratings than N the extra edges repeat the last one,
+    leaving empty fragments at the top.
+    '''
+    if not histogram:
+        return range_edges(range_bounds(numberofpartitions))
+    # the smallest capacity the greedy split fits in N runs, by bisection
+    low = max(rows for _, rows in histogram)
+    high = sum(rows for _, rows in histogram)
+    while high - low > max(1e-9 * high, 0.5):
+        middle = (low + high) / 2
+        if len(pack_histogram(histogram, middle)) <= numberofpartitions:
+            high = middle
+        else:
+            low = middle
+    ends = pack_histogram(histogram, high, numberofpartitions)
+    inner = ends[:-1] + [ends[-1]] * (numberofpartitions - len(ends))
+    return [min(0.0, histogram[0][0])] + inner + [max(MAX_RATING_SCALE, histogram[-1][0])]
+
+def estimated_fragment_sizes(histogram, edges):
+    sizes = [0] * (len(edges) - 1)
+    for rating, rows in histogram:
+        sizes[range_fragment_index(rating, edges)] += rows
+    return sizes
+
+def plan_equi_depth(ratings_table_name, numberofpartitions, openconnection, sample_percent=1.0):
+    '''
+    Equi-depth boundaries of ratings_table_name, picked from a sample. The
+    fragment sizes they give and those of the equal-width layout are kept as
+    a SkewReport in range_skew_report and emitted as 'range_skew' events.
+    '''
+    global range_skew_report
+    cur = openconnection.cursor()
+    try:
+        with Metrics.span('sample_boundaries', scheme='range', sample_percent=sample_percent):
+            histogram = sample_rating_histogram(ratings_table_name, cur, sample_percent)
+    finally:
+        cur.close()
+    edges = equi_depth_edges(histogram, numberofpartitions)
+    range_skew_report = SkewReport(estimated_fragment_sizes(histogram, range_edges(range_bounds(numberofpartitions))),
+                                   estimated_fragment_sizes(histogram, edges))
+    for layout, sizes in range_skew_report._asdict().items():
+        for i, rows in enumerate(sizes):
+            Metrics.emit('range_skew', rows=round(rows), boundaries=layout, fragment=f"{RANGE_TABLE_PREFIX}{i}")
+    return edges
+
 def insert_partition(args):
     '''
     Helper func for rangepartition 
+    Returns (seconds, rows inserted, EXPLAIN plan or None) for the caller's metrics.
     '''
-    i, delta, ratings_table_name = args
-    conn = getopenconnection(dbname=os.getenv("DATABASE_NAME"))
-    cur = conn.cursor()
+    i, minRange, maxRange, ratings_table_name, dbname, explain = args
+    start = time.perf_counter()
 
-    minRange = i * delta
-    maxRange = minRange + delta
-    table_name = f"range_part{i}"
+    table_name = f"{RANGE_TABLE_PREFIX}{i}"
     if i == 0:
         query = f"INSERT INTO {table_name} SELECT userid, movieid, rating FROM {ratings_table_name} WHERE rating >= {minRange} AND rating <= {maxRange};"
     else:
         query = f"INSERT INTO {table_name} SELECT userid, movieid, rating FROM {ratings_table_name} WHERE rating > {minRange} AND rating <= {maxRange};"
 
-    cur.execute(query)
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_connection_pool(dbname).connection() as conn:
+        cur = conn.cursor()
+        plan = Metrics.execute(cur, query, explain=explain)
+        rows = cur.rowcount if plan is None else None
+        conn.commit()
+        cur.close()
+    return time.perf_counter() - start, rows, plan
+
+def range_bounds(number_of_partitions):
+    '''
+    (min, max) rating of every range partition: partition 0 is [0, delta],
+    the others (min, max].
+    '''
+    delta = MAX_RATING_SCALE / number_of_partitions
+    edges = [i * delta for i in range(number_of_partitions)] + [MAX_RATING_SCALE]
+    return list(zip(edges, edges[1:]))
+
+def route_range_single_pass(ratings_table_name, bounds, cur):
+    '''
+    Fill range_part0..N-1 with one scan of the ratings table.
+    The fragments are attached to a throwaway PARTITION BY RANGE parent so the
+    server routes every row in C; a default partition swallows out-of-range
+    ratings, which the per-partition queries would skip as well. Range
+    partitions are [from, to), so each (min, max] is shifted up by one ulp;
+    fragments whose bounds are empty (repeated equi-depth edges) are not attached.
+    '''
+    router = f"{ratings_table_name}_range_router"
+    cur.execute(SQL("CREATE TABLE {} (userid INTEGER, movieid INTEGER, rating FLOAT) PARTITION BY RANGE (rating);")
+                .format(Identifier(router)))
+    attached = []
+    for i, (minRange, maxRange) in enumerate(bounds):
+        lower = minRange if i == 0 else math.nextafter(minRange, math.inf)
+        upper = math.nextafter(maxRange, math.inf)
+        if lower >= upper:
+            continue
+        cur.execute(SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({});").format(
+            Identifier(router), Identifier(f"{RANGE_TABLE_PREFIX}{i}"), Literal(lower), Literal(upper)))
+        attached.append(i)
+    cur.execute(SQL("CREATE TABLE {} PARTITION OF {} DEFAULT;").format(
+        Identifier(f"{router}_default"), Identifier(router)))
+
+    cur.execute(SQL("INSERT INTO {} (userid, movieid, rating) SELECT userid, movieid, rating FROM {};")
+                .format(Identifier(router), Identifier(ratings_table_name)))
+
+    for i in attached:
+        cur.execute(SQL("ALTER TABLE {} DETACH PARTITION {};").format(
+            Identifier(router), Identifier(f"{RANGE_TABLE_PREFIX}{i}")))
+    cur.execute(SQL("DROP TABLE {};").format(Identifier(router)))
+
+def partition_natively(ratings_table_name, numberofpartitions, scheme, cur):
+    '''
+    Rebuild ratings_table_name as a declaratively partitioned parent and move its rows in.
+    'range' gives PARTITION BY RANGE (rating) with children range_part0..N-1;
+    the first and last are open-ended, like rangeinsert's clamping.
+    'roundrobin' gives PARTITION BY HASH (userid, movieid) with children
+    rrobin_part0..N-1: an even spread, but not exact round robin order.
+    A table can only have one native layout at a time.
+    '''
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (ratings_table_name,))
+    row = cur.fetchone()
+    if row and row[0] == 'p':
+        raise ValueError(f"{ratings_table_name} is already natively partitioned")
+
+    parent = Identifier(ratings_table_name)
+    old = Identifier(f"{ratings_table_name}_unpartitioned")
+    cur.execute(SQL("ALTER TABLE {} RENAME TO {};").format(parent, old))
+
+    if scheme == 'range':
+        cur.execute(SQL("CREATE TABLE {} (userid INTEGER, movieid INTEGER, rating FLOAT) PARTITION BY RANGE (rating);")
+                    .format(parent))
+        for i, (minRange, maxRange) in enumerate(range_bounds(numberofpartitions)):
+            lower = SQL("MINVALUE") if i == 0 else Literal(math.nextafter(minRange, math.inf))
+            upper = SQL("MAXVALUE") if i == numberofpartitions - 1 else Literal(math.nextafter(maxRange, math.inf))
+            cur.execute(SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({});").format(
+                Identifier(f"{RANGE_TABLE_PREFIX}{i}"), parent, lower, upper))
+    else:
+        cur.execute(SQL("CREATE TABLE {} (userid INTEGER, movieid INTEGER, rating FLOAT) PARTITION BY HASH (userid, movieid);")
+                    .format(parent))
+        for i in range(numberofpartitions):
+            cur.execute(SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES WITH (MODULUS {}, REMAINDER {});").format(
+                Identifier(f"{RROBIN_TABLE_PREFIX}{i}"), parent, Literal(numberofpartitions), Literal(i)))
+
+    cur.execute(SQL("INSERT INTO {} (userid, movieid, rating) SELECT userid, movieid, rating FROM {};")
+                .format(parent, old))
+    cur.execute(SQL("DROP TABLE {};").format(old))
+
+def build_native(ratings_table_name, numberofpartitions, scheme, open_connection):
+    cur = open_connection.cursor()
+    try:
+        partition_natively(ratings_table_name, numberofpartitions, scheme, cur)
+        boundaries = range_edges(range_bounds(numberofpartitions)) if scheme == 'range' else None
+        save_partition_metadata(cur, scheme, numberofpartitions, boundaries, backend='native')
+        open_connection.commit()
+    except Exception:
+        open_connection.rollback()
+        raise
+    finally:
+        cur.close()
+        invalidate_partition_metadata(open_connection)
 
 # 8.33s
-def rangepartition(ratings_table_name, number_of_partitions, open_connection):
+def rangepartition(ratings_table_name, number_of_partitions, open_connection, single_pass=False, backend='tables',
+                   indexes=False, maintenance_work_mem='256MB', unlogged=False, set_logged=True,
+                   equi_depth=False, sample_percent=1.0):
+    '''
+    Split ratings_table_name into range_part0..N-1 by rating.
+    By default every partition is filled by its own worker with its own scan of
+    the table; single_pass=True reads the table once and routes each row
+    server-side, so the scan cost no longer grows with N.
+    backend='native' instead makes ratings_table_name a PARTITION BY RANGE
+    parent of the range_part tables, so inserts are routed by the server and
+    range queries on it get partition pruning.
+    indexes=True indexes every range_part table once it is filled and returns
+    the per-table build seconds; see build_indexes.
+    unlogged=True creates the range_part tables UNLOGGED and passes them to
+    finish_fast_load once filled (tables backend only).
+    equi_depth=True replaces the 5 / N wide intervals with boundaries that
+    give every fragment about the same number of rows, picked from a
+    sample_percent TABLESAMPLE of the table (tables backend only); see
+    plan_equi_depth for the before / after size report.
+    '''
+    if backend not in PARTITION_BACKENDS:
+        raise ValueError(f"Unknown partition backend: {backend}")
+    with Metrics.span('rangepartition', backend=backend, partitions=number_of_partitions):
+        if backend == 'native':
+            if unlogged:
+                raise ValueError("unlogged fast load is only supported by the 'tables' backend")
+            if equi_depth:
+                raise ValueError("equi-depth boundaries are only supported by the 'tables' backend")
+            with Metrics.span('build_native', scheme='range'):
+                build_native(ratings_table_name, number_of_partitions, 'range', open_connection)
+        else:
+            edges = None
+            if equi_depth:
+                edges = plan_equi_depth(ratings_table_name, number_of_partitions, open_connection, sample_percent)
+            fill_range_partitions(ratings_table_name, number_of_partitions, open_connection, single_pass, unlogged, edges)
+            if unlogged:
+                with Metrics.span('finish_fast_load'):
+                    finish_fast_load([f"{RANGE_TABLE_PREFIX}{i}" for i in range(number_of_partitions)],
+                                     open_connection, set_logged)
+        if indexes:
+            return build_partition_indexes(RANGE_TABLE_PREFIX, number_of_partitions, open_connection,
+                                           maintenance_work_mem)
+
+def fill_range_partitions(ratings_table_name, number_of_partitions, open_connection, single_pass, unlogged=False,
+                          edges=None):
     cur = open_connection.cursor()
-    delta = 5 / number_of_partitions
-    for i in range(number_of_partitions):
-        table_name = f"range_part{i}"
-        cur.execute(f"CREATE TABLE {table_name} (userid INTEGER, movieid INTEGER, rating FLOAT);")
+    bounds = range_bounds(number_of_partitions) if edges is None else list(zip(edges, edges[1:]))
+    persistence = "UNLOGGED " if unlogged else ""
+    with Metrics.span('create_partitions', scheme='range'):
+        drop_partition_tables(cur, RANGE_TABLE_PREFIX)
+        for i in range(number_of_partitions):
+            table_name = f"{RANGE_TABLE_PREFIX}{i}"
+            cur.execute(f"CREATE {persistence}TABLE {table_name} (userid INTEGER, movieid INTEGER, rating FLOAT);")
+        save_partition_metadata(cur, 'range', number_of_partitions, range_edges(bounds))
+
+    if single_pass:
+        try:
+            with Metrics.span('route_single_pass', scheme='range'):
+                route_range_single_pass(ratings_table_name, bounds, cur)
+                open_connection.commit()
+        except Exception:
+            open_connection.rollback()
+            raise
+        finally:
+            cur.close()
+            invalidate_partition_metadata(open_connection)
+        return
+
     open_connection.commit()
     cur.close()
+    invalidate_partition_metadata(open_connection)
+
+    dbname = open_connection.info.dbname
+    args = [(i, minRange, maxRange, ratings_table_name, dbname, Metrics.sample_explain())
+            for i, (minRange, maxRange) in enumerate(bounds)]
+    with Metrics.span('pool_startup'):
+        pool = get_worker_pool()
+    for i, (seconds, rows, plan) in enumerate(pool.map(insert_partition, args)):
+        Metrics.emit('insert_partition', seconds, rows, plan=plan, fragment=f"{RANGE_TABLE_PREFIX}{i}")
+
+
+
+class RoundRobinWriter:
+    '''
+    File-like target for COPY ... TO STDOUT that deals rows out round robin to
+    one queue per partition. psycopg2 writes one row per call; rows are
+    collected into batches of batch_rows and split with stride slices.
+    '''
+    def __init__(self, buffers, stop, batch_rows=100_000):
+        self.buffers = buffers
+        self.stop = stop
+        self.batch_rows = batch_rows
+        self.batch = []
+        self.rows = 0
+
+    def write(self, data):
+        self.batch.append(data)
+        if len(self.batch) >= self.batch_rows:
+            self.flush()
 
-    args = [(i, delta, ratings_table_name) for i in range(number_of_partitions)]
-    with multiprocessing.Pool() as pool:
-        pool.map(insert_partition, args)
+    def flush(self):
+        n = len(self.buffers)
+        offset = self.rows % n
+        for j in range(min(n, len(self.batch))):
+            # row k of the table (k = self.rows + j + m*n) goes to partition k % n
+            if not put_until_stopped(self.buffers[(offset + j) % n], b''.join(self.batch[j::n]), self.stop):
+                raise RuntimeError("round robin partition writer stopped")
+        self.rows += len(self.batch)
+        self.batch = []
 
+class RangeWriter(RoundRobinWriter):
+    '''
+    File-like target for COPY ... TO STDOUT that routes rows to one queue per
+    range partition of edges, batch by batch with split_block_by_range.
+    '''
+    def __init__(self, buffers, stop, edges, batch_rows=100_000):
+        super().__init__(buffers, stop, batch_rows)
+        self.edges = edges
 
+    def flush(self):
+        for partition_buffers, part in zip(self.buffers, split_block_by_range(b''.join(self.batch), self.edges)):
+            if part and not put_until_stopped(partition_buffers, part, self.stop):
+                raise RuntimeError("range partition writer stopped")
+        self.rows += len(self.batch)
+        self.batch = []
+
+def copy_from_queue(dbname, table_name, buffers, stop, errors, host=None, port=None):
+    '''
+    Consumer thread: COPY everything put on buffers into table_name over its own connection.
+    '''
+    conn = getopenconnection(dbname, host, port)
+    cur = conn.cursor()
+    try:
+        with Metrics.span('copy', fragment=table_name) as span:
+            stream = BlockStream(iter(buffers.get, None))
+            cur.copy_expert(copy_ratings_sql(table_name), stream)
+            conn.commit()
+            span.rows, span.bytes = stream.rows, stream.bytes
+    except Exception as e:
+        conn.rollback()
+        errors.append(e)
+        stop.set()
+    finally:
+        cur.close()
+        conn.close()
 
-def roundrobinpartition(ratingstablename, numberofpartitions, openconnection):
+def roundrobin_streaming(ratingstablename, numberofpartitions, openconnection, queue_depth=4):
+    '''
+    Fill rrobin_part0..N-1 from a single COPY TO STDOUT of the ratings table,
+    without sorting or a temp table. Each partition is written by its own
+    COPY FROM STDIN on its own connection, so partitions commit independently.
+    '''
+    stream_partitions(ratingstablename, [f"{RROBIN_TABLE_PREFIX}{i}" for i in range(numberofpartitions)],
+                      RoundRobinWriter, openconnection, queue_depth)
+
+def stream_partitions(ratingstablename, table_names, make_writer, openconnection, queue_depth=4, nodes=None):
+    '''
+    Deal a single COPY TO STDOUT of the ratings table out to table_names:
+    make_writer(buffers, stop) (e.g. RoundRobinWriter, or a RangeWriter
+    bound to its edges) puts every row on the queue of its table, and each
+    table is written by its own COPY FROM STDIN on its own connection, to the
+    (host, port, dbname) of nodes[i] when nodes is given.
+    '''
+    dbname = openconnection.info.dbname
+    stop = threading.Event()
+    errors = []
+    buffers = [queue.Queue(maxsize=queue_depth) for _ in table_names]
+    targets = nodes or [(None, None, dbname)] * len(table_names)
+    consumers = [threading.Thread(target=copy_from_queue,
+                                  args=(target_dbname, table_name, partition_buffers, stop, errors, host, port),
+                                  daemon=True)
+                 for table_name, partition_buffers, (host, port, target_dbname) in zip(table_names, buffers, targets)]
+    for consumer in consumers:
+        consumer.start()
+
+    writer = make_writer(buffers, stop)
+    cur = openconnection.cursor()
+    try:
+        cur.copy_expert(SQL("COPY {} (userid, movieid, rating) TO STDOUT").format(Identifier(ratingstablename)),
+                        writer)
+        writer.flush()
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        cur.close()
+        # None ends each COPY; after a failure an exception makes the
+        # remaining consumers roll back instead of committing part of the rows
+        end = RuntimeError("streaming partitioning aborted") if errors else None
+        for partition_buffers, consumer in zip(buffers, consumers):
+            while consumer.is_alive():
+                try:
+                    partition_buffers.put(end, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            consumer.join()
+
+    if errors:
+        raise errors[0]
+
+def roundrobinpartition(ratingstablename, numberofpartitions, openconnection, streaming=False, backend='tables',
+                        indexes=False, maintenance_work_mem='256MB', unlogged=False, set_logged=True):
     """
     Function to create partitions of main table using round robin approach.
+    With streaming=True the rows are dealt out in one pass over the table,
+    with no sort and no temporary table.
+    backend='native' makes the main table a PARTITION BY HASH parent of the
+    rrobin_part tables instead: the spread is even but partition sizes are
+    not the exact round robin counts.
+    indexes=True indexes every rrobin_part table once it is filled and returns
+    the per-table build seconds; see build_indexes.
+    unlogged=True creates the rrobin_part tables UNLOGGED and passes them to
+    finish_fast_load once filled (tables backend only).
     """
-    save_rr_index(0)
-    RROBIN_TABLE_PREFIX = 'rrobin_part'
+    if backend not in PARTITION_BACKENDS:
+        raise ValueError(f"Unknown partition backend: {backend}")
+    with Metrics.span('roundrobinpartition', backend=backend, partitions=numberofpartitions):
+        if backend == 'native':
+            if unlogged:
+                raise ValueError("unlogged fast load is only supported by the 'tables' backend")
+            with Metrics.span('build_native', scheme='roundrobin'):
+                build_native(ratingstablename, numberofpartitions, 'roundrobin', openconnection)
+        else:
+            fill_roundrobin_partitions(ratingstablename, numberofpartitions, openconnection, streaming, unlogged)
+            if unlogged:
+                with Metrics.span('finish_fast_load'):
+                    finish_fast_load([f"{RROBIN_TABLE_PREFIX}{i}" for i in range(numberofpartitions)],
+                                     openconnection, set_logged)
+        if indexes:
+            return build_partition_indexes(RROBIN_TABLE_PREFIX, numberofpartitions, openconnection,
+                                           maintenance_work_mem)
+
+def fill_roundrobin_partitions(ratingstablename, numberofpartitions, openconnection, streaming, unlogged=False):
     cur = openconnection.cursor()
+    drop_partition_tables(cur, RROBIN_TABLE_PREFIX)
 
-    # Create temporary table with row numbers
+    if streaming:
+        with Metrics.span('create_partitions', scheme='roundrobin'):
+            for i in range(numberofpartitions):
+                create_ratings_table(cur, f"{RROBIN_TABLE_PREFIX}{i}", unlogged)
+            save_partition_metadata(cur, 'roundrobin', numberofpartitions)
+        openconnection.commit()
+        cur.close()
+        invalidate_partition_metadata(openconnection)
+        roundrobin_streaming(ratingstablename, numberofpartitions, openconnection)
+        return
+
+    # Create temporary table with row numbers; pg_temp so that only an earlier
+    # run's temporary table is dropped, never a regular table named temp.
+    # Not ON COMMIT DROP: under autocommit it would be gone before the inserts.
+    cur.execute("DROP TABLE IF EXISTS pg_temp.temp;")
     temp_tb = SQL("""
         CREATE TEMPORARY TABLE temp AS 
         SELECT userid, movieid, rating, ROW_NUMBER() OVER (ORDER BY userid) AS rnum
         FROM {};
     """).format(Identifier(ratingstablename))
-    cur.execute(temp_tb)
+    with Metrics.span('temp_table'):
+        cur.execute(temp_tb)
 
     for i in range(numberofpartitions):
         table_name = f"{RROBIN_TABLE_PREFIX}{i}"
 
         # Create partition table
         cur.execute(SQL("""
-            CREATE TABLE {} (
+            CREATE {}TABLE {} (
                 userid INTEGER,
                 movieid INTEGER,
                 rating FLOAT
             );
-        """).format(Identifier(table_name)))
+        """).format(SQL("UNLOGGED ") if unlogged else SQL(""), Identifier(table_name)))
 
         # Insert into partition table using mod
         query = SQL("""
@@ -192,10 +1431,396 @@ def roundrobinpartition(ratingstablename, numberofpartitions, openconnection):
             SELECT userid, movieid, rating FROM temp
             WHERE MOD(temp.rnum - 1, %s) = %s;
         """).format(Identifier(table_name))
-        cur.execute(query, (numberofpartitions, i))
+        with Metrics.span('insert_partition', fragment=table_name) as span:
+            plan = Metrics.execute(cur, query, (numberofpartitions, i))
+            span.rows, span.plan = cur.rowcount if plan is None else None, plan
 
+    cur.execute("DROP TABLE pg_temp.temp;")
+    save_partition_metadata(cur, 'roundrobin', numberofpartitions)
     openconnection.commit()
     cur.close()
+    invalidate_partition_metadata(openconnection)
+
+
+def partition_table_indexes(cur, prefix):
+    '''
+    Sorted N of the existing prefix<N> tables.
+    '''
+    cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = current_schema() AND tablename LIKE %s",
+                (prefix + '%',))
+    return sorted(int(name[len(prefix):]) for (name,) in cur.fetchall() if name[len(prefix):].isdigit())
+
+def check_no_native_partitions(cur, prefix):
+    '''
+    Raise ValueError if a prefix<N> table is a partition of a native
+    partitioned table: it holds the only copy of its rows, so it must not be
+    dropped by a rebuild.
+    '''
+    cur.execute("""
+        SELECT p.relname FROM pg_class c
+        JOIN pg_inherits i ON i.inhrelid = c.oid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE c.relispartition AND c.relnamespace = current_schema()::regnamespace AND c.relname LIKE %s
+        LIMIT 1
+    """, (prefix + '%',))
+    parent = cur.fetchone()
+    if parent is not None:
+        raise ValueError(f"{prefix} tables are partitions of the native partitioned table {parent[0]}; "
+                         "rebuild it with backend='native'")
+
+def drop_partition_tables(cur, prefix):
+    '''
+    Drop the prefix<N> tables of an earlier run, so a rebuild replaces them
+    instead of failing on them or appending a second copy of their rows.
+    Native partitions are refused and nothing is dropped; see check_no_native_partitions.
+    '''
+    check_no_native_partitions(cur, prefix)
+    for i in partition_table_indexes(cur, prefix):
+        cur.execute(SQL("DROP TABLE {};").format(Identifier(f"{prefix}{i}")))
+
+def lock_partitions(cur, prefix, numberofpartitions):
+    # EXCLUSIVE blocks concurrent writers but not readers until the transaction ends
+    for i in range(numberofpartitions):
+        cur.execute(SQL("LOCK TABLE {} IN EXCLUSIVE MODE;").format(Identifier(f"{prefix}{i}")))
+
+def rename_fragment(cur, old_name, new_name):
+    '''
+    Rename a fragment together with its FRAGMENT_INDEXES so build_indexes still finds them.
+    '''
+    cur.execute(SQL("ALTER TABLE {} RENAME TO {};").format(Identifier(old_name), Identifier(new_name)))
+    for suffix in FRAGMENT_INDEXES:
+        cur.execute(SQL("ALTER INDEX IF EXISTS {} RENAME TO {};").format(
+            Identifier(f"{old_name}_{suffix}"), Identifier(f"{new_name}_{suffix}")))
+
+def range_fragment_condition(edges, j):
+    '''
+    SQL condition for the rows of range fragment j: (edges[j], edges[j + 1]],
+    with the first and last fragments open-ended like rangeinsert's clamping.
+    '''
+    conditions = []
+    if j > 0:
+        conditions.append(SQL("rating > {}").format(Literal(edges[j])))
+    if j < len(edges) - 2:
+        conditions.append(SQL("rating <= {}").format(Literal(edges[j + 1])))
+    return SQL(" AND ").join(conditions) if conditions else SQL("TRUE")
+
+def anchor_fragments(old_edges, new_edges):
+    '''
+    For every new range fragment, the old fragment it takes over (or None).
+    Fragments are matched in order so that the total overlap is as large as
+    possible: an anchored fragment is renamed into place and keeps its rows,
+    so only the rows outside its new range move.
+    '''
+    old_count, new_count = len(old_edges) - 1, len(new_edges) - 1
+
+    def overlap(i, j):
+        return max(0.0, min(old_edges[i + 1], new_edges[j + 1]) - max(old_edges[i], new_edges[j]))
+
+    # best[j][i]: largest total overlap matching new fragments < j with old fragments < i
+    best = [[0.0] * (old_count + 1) for _ in range(new_count + 1)]
+    for j in range(1, new_count + 1):
+        for i in range(1, old_count + 1):
+            best[j][i] = max(best[j - 1][i], best[j][i - 1], best[j - 1][i - 1] + overlap(i - 1, j - 1))
+
+    anchors = [None] * new_count
+    j, i = new_count, old_count
+    while j > 0 and i > 0:
+        if best[j][i] == best[j - 1][i]:
+            j -= 1
+        elif best[j][i] == best[j][i - 1]:
+            i -= 1
+        else:
+            anchors[j - 1] = i - 1
+            j, i = j - 1, i - 1
+    return anchors
+
+def repartition_range(ratings_table_name, numberofpartitions, openconnection, equi_depth=False, sample_percent=1.0):
+    '''
+    Change the number of range partitions in place. Every new fragment takes
+    over the old fragment it overlaps most; only rows outside its new bounds
+    are moved (DELETE ... RETURNING into a staging table, then routed to
+    their new fragments), and old fragments left without a new one are
+    drained and dropped. Runs in one transaction with the fragments locked
+    against writers. Returns the number of rows moved.
+    The new boundaries are equal-width, or equi-depth ones from
+    plan_equi_depth when equi_depth is true.
+    '''
+    metadata = get_partition_metadata('range', openconnection)
+    if metadata is not None and metadata.backend != 'tables':
+        raise ValueError(f"repartition does not support the '{metadata.backend}' backend; rebuild it with rangepartition")
+    old_count = get_partition_count('range', openconnection)
+    if old_count <= 0:
+        raise ValueError("No range partitions found.")
+    old_edges = metadata.boundaries if metadata is not None and metadata.boundaries else range_edges(range_bounds(old_count))
+    if equi_depth:
+        new_edges = plan_equi_depth(ratings_table_name, numberofpartitions, openconnection, sample_percent)
+    else:
+        new_edges = range_edges(range_bounds(numberofpartitions))
+    anchors = anchor_fragments(old_edges, new_edges)
+
+    cur = openconnection.cursor()
+    try:
+        lock_partitions(cur, RANGE_TABLE_PREFIX, old_count)
+        staging = Identifier(f"{ratings_table_name}_repartition_moved")
+        cur.execute(SQL("CREATE TEMPORARY TABLE {} (userid INTEGER, movieid INTEGER, rating FLOAT) ON COMMIT DROP;")
+                    .format(staging))
+
+        # Two-phase rename so old and new names never collide
+        for i in range(old_count):
+            rename_fragment(cur, f"{RANGE_TABLE_PREFIX}{i}", f"{RANGE_TABLE_PREFIX}{i}_old")
+        for j, i in enumerate(anchors):
+            table_name = f"{RANGE_TABLE_PREFIX}{j}"
+            if i is None:
+                create_ratings_table(cur, table_name)
+                continue
+            rename_fragment(cur, f"{RANGE_TABLE_PREFIX}{i}_old", table_name)
+            cur.execute(SQL("""
+                WITH moved AS (
+                    DELETE FROM {} WHERE NOT ({}) RETURNING userid, movieid, rating
+                )
+                INSERT INTO {} SELECT userid, movieid, rating FROM moved;
+            """).format(Identifier(table_name), range_fragment_condition(new_edges, j), staging))
+        for i in set(range(old_count)) - set(anchors):
+            old_name = Identifier(f"{RANGE_TABLE_PREFIX}{i}_old")
+            cur.execute(SQL("INSERT INTO {} SELECT userid, movieid, rating FROM {};").format(staging, old_name))
+            cur.execute(SQL("DROP TABLE {};").format(old_name))
+
+        cur.execute(SQL("SELECT COUNT(*) FROM {};").format(staging))
+        moved = cur.fetchone()[0]
+        for j in range(numberofpartitions):
+            cur.execute(SQL("INSERT INTO {} SELECT userid, movieid, rating FROM {} WHERE {};").format(
+                Identifier(f"{RANGE_TABLE_PREFIX}{j}"), staging, range_fragment_condition(new_edges, j)))
+
+        save_partition_metadata(cur, 'range', numberofpartitions, new_edges)
+        openconnection.commit()
+    except Exception:
+        openconnection.rollback()
+        raise
+    finally:
+        cur.close()
+        invalidate_partition_metadata(openconnection)
+    return moved
+
+def repartition_roundrobin(ratingstablename, numberofpartitions, openconnection):
+    '''
+    Change the number of round robin partitions in place. Fragments end up
+    with the sizes roundrobinpartition would give them (the first
+    total % N hold one extra row) and the insert cursor starts over, as
+    after a rebuild; rows are only taken from fragments above their new size
+    (or being dropped) and moved into new or undersized ones. Runs in one
+    transaction with the fragments locked against writers. Returns the
+    number of rows moved.
+    '''
+    if is_native('roundrobin', openconnection):
+        raise ValueError("repartition does not support the 'native' backend; rebuild it with roundrobinpartition")
+    old_count = get_partition_count('roundrobin', openconnection)
+    if old_count <= 0:
+        raise ValueError("No round robin partitions found.")
+
+    cur = openconnection.cursor()
+    try:
+        lock_partitions(cur, RROBIN_TABLE_PREFIX, old_count)
+        cur.execute(SQL(" UNION ALL ").join(
+            SQL("SELECT {}, COUNT(*) FROM {}").format(Literal(i), Identifier(f"{RROBIN_TABLE_PREFIX}{i}"))
+            for i in range(old_count)))
+        counts = dict(cur.fetchall())
+        total = sum(counts.values())
+        targets = [total // numberofpartitions + (1 if j < total % numberofpartitions else 0)
+                   for j in range(numberofpartitions)]
+
+        for j in range(old_count, numberofpartitions):
+            create_ratings_table(cur, f"{RROBIN_TABLE_PREFIX}{j}")
+        surplus = [[i, counts[i] - (targets[i] if i < numberofpartitions else 0)] for i in range(old_count)]
+        deficit = [[j, targets[j] - counts.get(j, 0)] for j in range(numberofpartitions)]
+        surplus = [item for item in surplus if item[1] > 0]
+        deficit = [item for item in deficit if item[1] > 0]
+
+        moved = 0
+        while surplus and deficit:
+            (source, extra), (target, missing) = surplus[-1], deficit[-1]
+            rows = min(extra, missing)
+            source_table = Identifier(f"{RROBIN_TABLE_PREFIX}{source}")
+            cur.execute(SQL("""
+                WITH moved AS (
+                    DELETE FROM {} WHERE ctid IN (SELECT ctid FROM {} LIMIT %s)
+                    RETURNING userid, movieid, rating
+                )
+                INSERT INTO {} SELECT userid, movieid, rating FROM moved;
+            """).format(source_table, source_table, Identifier(f"{RROBIN_TABLE_PREFIX}{target}")), (rows,))
+            moved += rows
+            surplus[-1][1] -= rows
+            deficit[-1][1] -= rows
+            if surplus[-1][1] == 0:
+                surplus.pop()
+            if deficit[-1][1] == 0:
+                deficit.pop()
+
+        for i in range(numberofpartitions, old_count):
+            cur.execute(SQL("DROP TABLE {};").format(Identifier(f"{RROBIN_TABLE_PREFIX}{i}")))
+
+        save_partition_metadata(cur, 'roundrobin', numberofpartitions)
+        openconnection.commit()
+    except Exception:
+        openconnection.rollback()
+        raise
+    finally:
+        cur.close()
+        invalidate_partition_metadata(openconnection)
+    return moved
+
+def repartition(ratingstablename, numberofpartitions, openconnection, scheme='range', equi_depth=False,
+                sample_percent=1.0):
+    '''
+    Resize the range or round robin partitions of ratingstablename to
+    numberofpartitions without rebuilding them from the ratings table.
+    Returns the number of rows moved. New fragments have no indexes yet; see
+    build_partition_indexes. equi_depth applies to the range scheme only,
+    as in rangepartition.
+    '''
+    if numberofpartitions <= 0:
+        raise ValueError("numberofpartitions must be positive")
+    if scheme not in ('range', 'roundrobin'):
+        raise ValueError(f"Unknown partitioning scheme: {scheme}")
+    with Metrics.span('repartition', scheme=scheme, partitions=numberofpartitions) as span:
+        if scheme == 'range':
+            moved = repartition_range(ratingstablename, numberofpartitions, openconnection, equi_depth, sample_percent)
+        else:
+            moved = repartition_roundrobin(ratingstablename, numberofpartitions, openconnection)
+        span.rows = moved
+    return moved
+
+def split_block_by_range(block, edges):
+    '''
+    Split a tab-delimited block into one ready-to-COPY block per range partition
+    of the boundaries edges, routed with the same rules as rangeinsert.
+    '''
+    numberofpartitions = len(edges) - 1
+    lines = block.split(b'\n')[:-1]
+    if np is not None:
+        index = range_fragment_indexes(np.array(block.split(), dtype=np.float64)[2::3], edges)
+        lines = np.array(lines, dtype=object)
+        groups = [lines[index == i] for i in range(numberofpartitions)]
+    else:
+        groups = [[] for _ in range(numberofpartitions)]
+        for line in lines:
+            groups[range_fragment_index(float(line.rsplit(b'\t', 1)[1]), edges)].append(line)
+    return [b'\n'.join(group) + b'\n' if len(group) else b'' for group in groups]
+
+def split_block_by_roundrobin(block, numberofpartitions, offset):
+    '''
+    Split a tab-delimited block into one ready-to-COPY block per round robin
+    partition; offset is the number of rows already dealt out before it.
+    '''
+    lines = block.split(b'\n')[:-1]
+    groups = [b''] * numberofpartitions
+    for j in range(min(numberofpartitions, len(lines))):
+        groups[(offset + j) % numberofpartitions] = b'\n'.join(lines[j::numberofpartitions]) + b'\n'
+    return groups
+
+def loadandpartition(ratings_table_name, ratings_file_path, numberofpartitions, open_connection,
+                     schemes=('range', 'roundrobin'), block_size=BLOCK_SIZE):
+    '''
+    Load ratings.dat into ratings_table_name and the range_part* and/or
+    rrobin_part* fragments in one pass over the file and one transaction.
+    Range targets are computed client-side with rangeinsert's rules.
+    ratings_table_name must not exist yet; the fragments of an earlier
+    partitioning are replaced. Returns the number of rows loaded.
+    '''
+    unknown = set(schemes) - {'range', 'roundrobin'}
+    if unknown:
+        raise ValueError(f"Unknown partitioning scheme(s): {', '.join(sorted(unknown))}")
+
+    cur = open_connection.cursor()
+    rows = 0
+    try:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (ratings_table_name,))
+        if cur.fetchone()[0]:
+            raise ValueError(f"{ratings_table_name} already exists; load it with loadratings and partition it instead")
+        create_ratings_table(cur, ratings_table_name)
+        edges = range_edges(range_bounds(numberofpartitions))
+        for scheme, prefix in SCHEME_PREFIXES.items():
+            if scheme in schemes:
+                drop_partition_tables(cur, prefix)
+                for i in range(numberofpartitions):
+                    create_ratings_table(cur, f"{prefix}{i}")
+                save_partition_metadata(cur, scheme, numberofpartitions, edges if scheme == 'range' else None)
+
+        for block in iter_ratings_blocks(ratings_file_path, block_size=block_size):
+            targets = [(ratings_table_name, block)]
+            if 'range' in schemes:
+                targets += [(f"{RANGE_TABLE_PREFIX}{i}", part)
+                            for i, part in enumerate(split_block_by_range(block, edges))]
+            if 'roundrobin' in schemes:
+                targets += [(f"{RROBIN_TABLE_PREFIX}{i}", part)
+                            for i, part in enumerate(split_block_by_roundrobin(block, numberofpartitions, rows))]
+
+            for table_name, data in targets:
+                if data:
+                    cur.copy_expert(copy_ratings_sql(table_name), BytesIO(data))
+            rows += block.count(b'\n')
+
+        open_connection.commit()
+    except Exception as e:
+        print("Error:", e)
+        open_connection.rollback()
+        raise
+    finally:
+        cur.close()
+        invalidate_partition_metadata(open_connection)
+
+    return rows
+
+# index name suffix -> (access method, column); BRIN suits rating because the
+# range fragments are narrow bands of it and stay tiny on disk
+FRAGMENT_INDEXES = {
+    'userid_idx': ('btree', 'userid'),
+    'movieid_idx': ('btree', 'movieid'),
+    'rating_brin': ('brin', 'rating'),
+}
+
+# table name -> seconds spent building its indexes, from the latest build_indexes calls
+index_build_timings = {}
+
+def build_table_indexes(dbname, table_name, maintenance_work_mem):
+    '''
+    Create the FRAGMENT_INDEXES of one table over a pooled connection and return the seconds it took.
+    '''
+    start = time.perf_counter()
+    with get_connection_pool(dbname).connection() as conn:
+        cur = conn.cursor()
+        try:
+            # SET LOCAL so the setting does not outlive the transaction on the pooled connection
+            cur.execute("SET LOCAL maintenance_work_mem = %s", (maintenance_work_mem,))
+            for suffix, (method, column) in FRAGMENT_INDEXES.items():
+                cur.execute(SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING {} ({});").format(
+                    Identifier(f"{table_name}_{suffix}"), Identifier(table_name), SQL(method), Identifier(column)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+    return time.perf_counter() - start
+
+def build_indexes(table_names, openconnection, maintenance_work_mem='256MB', workers=4):
+    '''
+    Index (userid), (movieid) and BRIN (rating) on every table of table_names
+    after it has been bulk loaded. Tables are indexed in parallel, one pooled
+    connection each, with at most workers builds at a time; every build gets
+    maintenance_work_mem. Returns {table name: seconds}.
+    '''
+    dbname = openconnection.info.dbname
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(table_names)))) as executor:
+        seconds = executor.map(lambda table_name: build_table_indexes(dbname, table_name, maintenance_work_mem),
+                               table_names)
+        timings = dict(zip(table_names, seconds))
+    index_build_timings.update(timings)
+    for table_name, elapsed in timings.items():
+        Metrics.emit('build_indexes', elapsed, fragment=table_name)
+    return timings
+
+def build_partition_indexes(prefix, numberofpartitions, openconnection, maintenance_work_mem='256MB'):
+    return build_indexes([f"{prefix}{i}" for i in range(numberofpartitions)], openconnection, maintenance_work_mem)
 
 
 def count_partitions(prefix, openconnection):
@@ -212,65 +1837,355 @@ def count_partitions(prefix, openconnection):
         cur.close()
         return count
 
+# callables taking (ratings table name, [(userid, movieid, rating)]), called by
+# this process's inserts once they have committed; Cache.RatingsCache uses them
+insert_listeners = []
+
+def add_insert_listener(callback):
+    insert_listeners.append(callback)
+    return callback
+
+def remove_insert_listener(callback):
+    insert_listeners.remove(callback)
+
+def notify_inserted(ratingstablename, rows):
+    for callback in list(insert_listeners):
+        callback(ratingstablename, rows)
+
 def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
-    RANGE_TABLE_PREFIX = 'range_part'
-    MAX_RATING_SCALE = 5.0
+    while True:
+        metadata = get_partition_metadata('range', openconnection)
+        targets = [ratingstablename]
+        if not is_native('range', openconnection):
+            index = range_fragment_index(rating, get_range_edges(openconnection))
+            targets.append(f"{RANGE_TABLE_PREFIX}{index}")
+
+        cur = openconnection.cursor()
+        try:
+            insert_sql = SQL("INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s);")
+            with Metrics.span('rangeinsert', fragment=targets[-1]) as span:
+                for table_name in targets:
+                    plan = Metrics.execute(cur, insert_sql.format(Identifier(table_name)), (userid, itemid, rating))
+                check_partition_generation(cur, 'range', metadata)
+                openconnection.commit()
+                span.rows, span.plan = 1, plan
+            break
+        except StalePartitionMetadata:
+            # repartitioned by another process, route again with the new boundaries
+            openconnection.rollback()
+            invalidate_partition_metadata(openconnection)
+        except Exception as e:
+            openconnection.rollback()
+            if isinstance(e, UndefinedTable):
+                # partitions were dropped or rebuilt elsewhere, re-read the metadata next time
+                invalidate_partition_metadata(openconnection)
+            raise
+        finally:
+            cur.close()
+    notify_inserted(ratingstablename, [(userid, itemid, rating)])
+
 
+def reserve_rr_slots(openconnection, count=1, numberofpartitions=None):
+    '''
+    Atomically take count consecutive round robin slots from the cursor row in
+    partition_metadata; returns (first slot, partition count). The UPDATE
+    locks the row until the caller's transaction ends, so concurrent writers
+    on any host get disjoint slots, and a rollback gives the slots back. The
+    partition count comes from the same row, so slots are mapped with the
+    live count even after another process rebuilt the partitions.
+    numberofpartitions is only used to start a cursor for partitions built
+    without the registry.
+    '''
     cur = openconnection.cursor()
-    numberofpartitions = count_partitions(RANGE_TABLE_PREFIX, openconnection)
+    try:
+        # cached metadata means the registry exists; otherwise look it up
+        # first, since an UPDATE of a missing table would abort the transaction
+        registry = (openconnection.dsn, 'roundrobin') in partition_metadata_cache
+        if not registry:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (PARTITION_METADATA_TABLE,))
+            registry = cur.fetchone()[0]
+        row = None
+        if registry:
+            cur.execute(SQL("""
+                UPDATE {} SET rr_cursor = rr_cursor + %s
+                WHERE scheme = 'roundrobin'
+                RETURNING rr_cursor - %s, partition_count;
+            """).format(Identifier(PARTITION_METADATA_TABLE)), (count, count))
+            row = cur.fetchone()
+        if row is None:
+            # Partitions built without the registry: start a cursor at 0
+            if numberofpartitions is None:
+                numberofpartitions = count_partitions(RROBIN_TABLE_PREFIX, openconnection)
+            create_partition_metadata_table(cur)
+            cur.execute(SQL("""
+                INSERT INTO {} AS m (scheme, partition_count, rr_cursor)
+                VALUES ('roundrobin', %s, %s)
+                ON CONFLICT (scheme) DO UPDATE SET rr_cursor = m.rr_cursor + EXCLUDED.rr_cursor
+                RETURNING m.rr_cursor - %s, m.partition_count;
+            """).format(Identifier(PARTITION_METADATA_TABLE)), (numberofpartitions, count, count))
+            row = cur.fetchone()
+        return row
+    finally:
+        cur.close()
+
+class RoundRobinCursor:
+    '''
+    Client-side block of round robin slots for batch writers. Slots are reserved
+    block_size at a time over a separate autocommit connection, so writers
+    only touch the shared cursor row once per block and never hold its lock
+    during their own transactions. Slots left unused when the client goes
+    away are skipped, which can unbalance partitions by up to block_size rows
+    per client.
+    '''
+    def __init__(self, dbname, block_size=1000):
+        self.dbname = dbname
+        self.block_size = block_size
+        self.next = 0
+        self.end = 0
+        self.partition_count = 0
+        self.conn = None
 
+    def take(self, count=1):
+        '''
+        Return the partition indexes of count slots as a list (the slots are
+        consecutive within one block, and mapped with the partition count
+        recorded when their block was reserved).
+        '''
+        partitions = []
+        while len(partitions) < count:
+            if self.next >= self.end:
+                if self.conn is None:
+                    self.conn = getopenconnection(dbname=self.dbname)
+                    self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                size = max(self.block_size, count - len(partitions))
+                self.next, self.partition_count = reserve_rr_slots(self.conn, size)
+                self.end = self.next + size
+                if self.partition_count <= 0:
+                    raise ValueError("No round robin partitions found.")
+            taken = min(count - len(partitions), self.end - self.next)
+            partitions.extend(slot % self.partition_count for slot in range(self.next, self.next + taken))
+            self.next += taken
+        return partitions
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection, rr_cursor=None):
+    """
+    Insert one tuple into the next round robin partition. The position comes
+    from the database-side cursor (see reserve_rr_slots), or from a
+    RoundRobinCursor block when rr_cursor is given.
+    """
+    con = openconnection
+    cur = con.cursor()
+    try:
+        if is_native('roundrobin', con):
+            cur.execute(SQL("INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s);")
+                        .format(Identifier(ratingstablename)), (userid, itemid, rating))
+            con.commit()
+            notify_inserted(ratingstablename, [(userid, itemid, rating)])
+            return
+
+        numberofpartitions = get_partition_count('roundrobin', con)
+        if numberofpartitions <= 0:
+            raise ValueError("No round robin partitions found.")
+
+        if rr_cursor is not None:
+            target_partition = rr_cursor.take()[0]
+        else:
+            current_index, numberofpartitions = reserve_rr_slots(con, 1, numberofpartitions)
+            target_partition = current_index % numberofpartitions
+        
+        with Metrics.span('roundrobininsert', fragment=f"{RROBIN_TABLE_PREFIX}{target_partition}") as span:
+            insert_sql = SQL("INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s);")
+            cur.execute(insert_sql.format(Identifier(ratingstablename)), (userid, itemid, rating))
+
+            plan = Metrics.execute(cur, SQL("INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s)")
+                                   .format(Identifier("rrobin_part" + str(target_partition))),
+                                   (userid, itemid, rating))
+
+            con.commit()
+            span.rows, span.plan = 1, plan
+    except Exception as e:
+        con.rollback()
+        if isinstance(e, UndefinedTable):
+            invalidate_partition_metadata(con)
+        print("roundrobininsert failed:", e)
+        raise
+    finally:
+        cur.close()
+    notify_inserted(ratingstablename, [(userid, itemid, rating)])
+
+# rows: query result; scanned / skipped: number of fragments read / pruned
+QueryResult = namedtuple('QueryResult', 'rows scanned skipped')
+
+def overlapping_range_fragments(edges, minRating, maxRating):
+    '''
+    Indexes of the range fragments that can hold a rating in [minRating, maxRating].
+    Fragment i holds (edges[i], edges[i + 1]]; the first and last ones are
+    treated as open-ended because rangeinsert clamps out-of-scale ratings
+    into them. An empty range (minRating > maxRating) overlaps none.
+    '''
+    n = len(edges) - 1
+    overlapping = []
+    if minRating > maxRating:
+        return overlapping
+    for i in range(n):
+        above_lower = i == 0 or maxRating > edges[i]
+        below_upper = i == n - 1 or minRating <= edges[i + 1]
+        if above_lower and below_upper:
+            overlapping.append(i)
+    return overlapping
+
+def get_range_edges(openconnection):
+    '''
+    Range boundaries from the partition metadata, or the equal-width layout
+    for partitions built without it.
+    '''
+    metadata = get_partition_metadata('range', openconnection)
+    if metadata is not None and metadata.boundaries:
+        return metadata.boundaries
+    numberofpartitions = count_partitions(RANGE_TABLE_PREFIX, openconnection)
     if numberofpartitions <= 0:
         raise ValueError("No range partitions found.")
-    
-    delta = MAX_RATING_SCALE / numberofpartitions
-    index = min(numberofpartitions - 1, max(0, int(rating / delta)))
+    return range_edges(range_bounds(numberofpartitions))
 
-    if rating % delta == 0 and index > 0:
-        index -= 1
-    partition_table = f"{RANGE_TABLE_PREFIX}{index}"
+def check_local_fragments(scheme, openconnection):
+    '''
+    Fragments placed on other nodes by Placement are not local tables; reading them here is refused.
+    '''
+    metadata = get_partition_metadata(scheme, openconnection)
+    if metadata is not None and metadata.backend == 'nodes':
+        raise ValueError(f"{scheme} fragments are placed on other nodes; query them through Placement")
 
-    insert_sql = SQL("INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s);")
-    cur.execute(insert_sql.format(Identifier(ratingstablename)), (userid, itemid, rating))
-    cur.execute(insert_sql.format(Identifier(partition_table)), (userid, itemid, rating))
+def range_query_fragments(minRating, maxRating, openconnection):
+    '''
+    (indexes of the range_part tables to scan, total number of range partitions).
+    '''
+    check_local_fragments('range', openconnection)
+    edges = get_range_edges(openconnection)
+    return overlapping_range_fragments(edges, minRating, maxRating), len(edges) - 1
 
-    openconnection.commit()
-    cur.close()
+def scan_range_fragments(indexes, condition, params, openconnection):
+    selects = [SQL("SELECT userid, movieid, rating FROM {} WHERE ").format(Identifier(f"{RANGE_TABLE_PREFIX}{i}"))
+               + condition for i in indexes]
+    cur = openconnection.cursor()
+    try:
+        cur.execute(SQL(" UNION ALL ").join(selects), list(params) * len(indexes))
+        return cur.fetchall()
+    finally:
+        cur.close()
 
+def rangequery(ratingMinValue, ratingMaxValue, openconnection):
+    '''
+    Rows with ratingMinValue <= rating <= ratingMaxValue. Only the range_part
+    tables whose bounds overlap the predicate are scanned; the result reports
+    how many were skipped.
+    '''
+    indexes, numberofpartitions = range_query_fragments(ratingMinValue, ratingMaxValue, openconnection)
+    rows = []
+    if indexes:
+        rows = scan_range_fragments(indexes, SQL("rating >= %s AND rating <= %s"),
+                                    (ratingMinValue, ratingMaxValue), openconnection)
+    return QueryResult(rows, len(indexes), numberofpartitions - len(indexes))
 
-def get_rr_index():
-    try:
-        with open("rr_index.txt", 'r') as f:
-            return int(f.read())
-    except:
-        return 0
+def pointquery(ratingValue, openconnection):
+    '''
+    Rows with rating = ratingValue, read from the single range_part table that can hold it.
+    '''
+    indexes, numberofpartitions = range_query_fragments(ratingValue, ratingValue, openconnection)
+    rows = scan_range_fragments(indexes, SQL("rating = %s"), (ratingValue,), openconnection) if indexes else []
+    return QueryResult(rows, len(indexes), numberofpartitions - len(indexes))
+
+def insert_rows(cur, table_name, rows, page_size=1000):
+    execute_values(cur,
+                   SQL("INSERT INTO {} (userid, movieid, rating) VALUES %s").format(Identifier(table_name)),
+                   rows, page_size=page_size)
 
-def save_rr_index(index):
-    with open("rr_index.txt", 'w') as f:
-        f.write(str(index))
+def rangeinsert_many(ratingstablename, rows, openconnection):
+    """
+    Insert many (userid, movieid, rating) tuples with rangeinsert's routing.
+    Rows are grouped by target fragment and written with execute_values in a
+    single transaction. Returns the number of rows inserted.
+    """
+    rows = list(rows)
+    while True:
+        metadata = get_partition_metadata('range', openconnection)
+        groups = {}
+        if not is_native('range', openconnection):
+            edges = get_range_edges(openconnection)
+            for row in rows:
+                groups.setdefault(range_fragment_index(row[2], edges), []).append(row)
 
-def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
+        cur = openconnection.cursor()
+        try:
+            with Metrics.span('rangeinsert_many', fragments=len(groups)) as span:
+                insert_rows(cur, ratingstablename, rows)
+                for index, group in groups.items():
+                    insert_rows(cur, f"{RANGE_TABLE_PREFIX}{index}", group)
+                check_partition_generation(cur, 'range', metadata)
+                openconnection.commit()
+                span.rows = len(rows)
+            break
+        except StalePartitionMetadata:
+            openconnection.rollback()
+            invalidate_partition_metadata(openconnection)
+        except Exception as e:
+            openconnection.rollback()
+            if isinstance(e, UndefinedTable):
+                invalidate_partition_metadata(openconnection)
+            print("rangeinsert_many failed:", e)
+            raise
+        finally:
+            cur.close()
+    notify_inserted(ratingstablename, rows)
+    return len(rows)
+
+def roundrobininsert_many(ratingstablename, rows, openconnection, rr_cursor=None):
+    """
+    Insert many (userid, movieid, rating) tuples round robin, continuing from
+    the database-side cursor. The whole batch reserves its slots with one
+    cursor update (or from rr_cursor, a RoundRobinCursor); rows are grouped
+    by target fragment and written with execute_values in a single
+    transaction. Returns the number of rows inserted.
+    """
+    rows = list(rows)
     con = openconnection
     cur = con.cursor()
     try:
-        cur.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name LIKE 'rrobin_part%';")
-        numberofpartitions = cur.fetchone()[0]
-
-        current_index = get_rr_index()
-        target_partition = current_index % numberofpartitions
-        
-        insert_sql = SQL("INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s);")
-        cur.execute(insert_sql.format(Identifier(ratingstablename)), (userid, itemid, rating))
+        insert_rows(cur, ratingstablename, rows)
+        if is_native('roundrobin', con):
+            con.commit()
+            notify_inserted(ratingstablename, rows)
+            return len(rows)
 
-        cur.execute(SQL("INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s)")
-                    .format(Identifier("rrobin_part" + str(target_partition))),
-                    (userid, itemid, rating))
+        numberofpartitions = get_partition_count('roundrobin', con)
+        if numberofpartitions <= 0:
+            raise ValueError("No round robin partitions found.")
 
-        save_rr_index(current_index + 1)
+        if rr_cursor is not None:
+            groups = {}
+            for target_partition, row in zip(rr_cursor.take(len(rows)), rows):
+                groups.setdefault(target_partition, []).append(row)
+        else:
+            current_index, numberofpartitions = reserve_rr_slots(con, len(rows), numberofpartitions)
+            groups = {(current_index + j) % numberofpartitions: rows[j::numberofpartitions]
+                      for j in range(min(numberofpartitions, len(rows)))}
+        with Metrics.span('roundrobininsert_many', fragments=len(groups)) as span:
+            for target_partition, group in groups.items():
+                insert_rows(cur, f"{RROBIN_TABLE_PREFIX}{target_partition}", group)
 
-        con.commit()
+            con.commit()
+            span.rows = len(rows)
     except Exception as e:
         con.rollback()
-        print("roundrobininsert failed:", e)
+        if isinstance(e, UndefinedTable):
+            invalidate_partition_metadata(con)
+        print("roundrobininsert_many failed:", e)
         raise
     finally:
-        cur.close()
\ No newline at end of file
+        cur.close()
+    notify_inserted(ratingstablename, rows)
+    return len(rows)
@@ -0,0 +1,152 @@
+#
+# Instrumentation hooks for the Interface module
+#
+import random
+import threading
+import time
+from collections import namedtuple, defaultdict
+
+from psycopg2.sql import SQL
+
+# name: phase such as 'loadratings', 'copy' or 'insert_partition'; labels: e.g. {'fragment': 'range_part3'}
+# seconds / rows / bytes are None when not measured; plan is an EXPLAIN (ANALYZE, BUFFERS) JSON plan or None
+# data: per-call details such as {'offset': 4194304}; unlike labels they are not exported as series
+Event = namedtuple('Event', 'name labels seconds rows bytes plan data')
+
+# callables taking an Event; with none attached, spans and emit do no work
+listeners = []
+
+# share of Metrics.execute calls run under EXPLAIN (ANALYZE, BUFFERS) while a listener is attached
+explain_rate = 0.0
+
+
+def add_listener(callback):
+    listeners.append(callback)
+    return callback
+
+
+def remove_listener(callback):
+    listeners.remove(callback)
+
+
+def enable_explain(rate=1.0):
+    global explain_rate
+    explain_rate = rate
+
+
+def emit(name, seconds=None, rows=None, bytes=None, plan=None, data=None, **labels):
+    if not listeners:
+        return
+    event = Event(name, labels, seconds, rows, bytes, plan, data or {})
+    for callback in list(listeners):
+        callback(event)
+
+
+class Span:
+    '''
+    Times a with-block and emits it as one event; set rows, bytes or plan on
+    it inside the block. A failing block is emitted with an error label.
+    '''
+    __slots__ = ('name', 'labels', 'data', 'rows', 'bytes', 'plan', 'start')
+
+    def __init__(self, name, labels, data=None):
+        self.name = name
+        self.labels = labels
+        self.data = data
+        self.rows = None
+        self.bytes = None
+        self.plan = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = self.labels if exc_type is None else dict(self.labels, error=exc_type.__name__)
+        emit(self.name, time.perf_counter() - self.start, self.rows, self.bytes, self.plan, self.data, **labels)
+        return False
+
+
+class NullSpan:
+    '''
+    Shared stand-in for Span while no listener is attached: ignores everything.
+    '''
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, data=None, **labels):
+    return Span(name, labels, data) if listeners else NULL_SPAN
+
+
+def sample_explain():
+    return bool(listeners) and explain_rate > 0 and random.random() < explain_rate
+
+
+def execute(cur, query, params=None, explain=None):
+    '''
+    cur.execute(query, params), run as EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)
+    when explain is true (by default: sampled at explain_rate). Returns the
+    plan, or None when the statement ran as is. EXPLAIN ANALYZE executes the
+    statement, so its effects happen exactly once either way, but rowcount
+    and any result rows are replaced by the plan.
+    '''
+    if explain is None:
+        explain = sample_explain()
+    if not explain:
+        cur.execute(query, params)
+        return None
+    if isinstance(query, str):
+        query = SQL(query)
+    cur.execute(SQL("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ") + query, params)
+    return cur.fetchone()[0]
+
+
+class PrometheusExporter:
+    '''
+    Listener that sums events per (phase, labels) and renders the totals in
+    the Prometheus text exposition format; event data is not exported. The latest plan of every phase is
+    kept in plans.
+    '''
+    def __init__(self, prefix='ratings'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {name: defaultdict(float) for name in ('phase_calls', 'phase_seconds', 'rows', 'copy_bytes')}
+        self.plans = {}
+
+    def __call__(self, event):
+        key = (event.name, tuple(sorted(event.labels.items())))
+        with self.lock:
+            self.counters['phase_calls'][key] += 1
+            for name, value in (('phase_seconds', event.seconds), ('rows', event.rows), ('copy_bytes', event.bytes)):
+                if value is not None:
+                    self.counters[name][key] += value
+            if event.plan is not None:
+                self.plans[event.name] = event.plan
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, values in self.counters.items():
+                metric = f"{self.prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for (phase, labels), value in sorted(values.items()):
+                    lines.append(f"{metric}{{{format_labels((('phase', phase),) + labels)}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ",".join(f'{name}="{escape(value)}"' for name, value in labels)
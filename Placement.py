@@ -0,0 +1,346 @@
+#
+# Placement of the range_part / rrobin_part fragments on several PostgreSQL servers
+#
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.sql import SQL, Identifier
+from psycopg2.extras import execute_values
+from psycopg2.errors import UndefinedTable
+
+import Interface
+import Metrics
+
+FRAGMENT_PLACEMENT_TABLE = 'fragment_placement'
+
+# one PostgreSQL database holding fragments; host / port None means the HOST / PORT server
+Node = namedtuple('Node', 'host port dbname')
+
+
+def parse_nodes(spec=None):
+    '''
+    Nodes of a "host:port/dbname,host:port/dbname" list, by default the NODES
+    environment variable. The port and dbname may be left out, dbname then
+    being DATABASE_NAME.
+    '''
+    spec = os.getenv("NODES", "") if spec is None else spec
+    nodes = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        address, _, dbname = item.partition('/')
+        host, _, port = address.partition(':')
+        nodes.append(Node(host or None, int(port) if port else None, dbname or os.getenv("DATABASE_NAME")))
+    return nodes
+
+
+class Placement:
+    '''
+    Distributes the fragments of a partitioning over nodes: fragment i lives
+    on nodes[i % len(nodes)]. The coordinator, the database of openconnection,
+    keeps the ratings table, the partition metadata (range boundaries, round
+    robin cursor) and the fragment -> node map in fragment_placement.
+    Fragments are filled on all nodes at once from a single COPY of the
+    ratings table, and inserts go to the node that owns their fragment.
+    A fragment row is committed on its node before the coordinator commits
+    the base row, so a coordinator failure in between can leave the fragment
+    one row ahead of the ratings table.
+    '''
+    def __init__(self, nodes, openconnection, maxconn=8):
+        if not nodes:
+            raise ValueError("Placement needs at least one node")
+        self.nodes = [Node(*node) for node in nodes]
+        self.coordinator = openconnection
+        self.maxconn = maxconn
+        self.executor = ThreadPoolExecutor(max_workers=len(self.nodes))
+        # scheme -> [Node of fragment i]; dropped on rebuild or when a fragment disappears
+        self.placements = {}
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connection(self, node):
+        return Interface.get_connection_pool(node.dbname, self.maxconn, node.host, node.port).connection()
+
+    def create_databases(self):
+        '''
+        Create the database of every node that does not have it yet.
+        '''
+        for node in set(self.nodes):
+            Interface.create_db(node.dbname, node.host, node.port)
+
+    def on_nodes(self, groups, work):
+        '''
+        Run work(node, fragment indexes) for every node of groups ({node: [fragment
+        indexes]}), all nodes concurrently; returns {node: result}.
+        '''
+        results = self.executor.map(lambda node: work(node, groups[node]), groups)
+        return dict(zip(groups, results))
+
+    def replace_fragments(self, prefix, numberofpartitions):
+        '''
+        Drop the prefix<N> tables of every node and create the ones placed on it.
+        Every node is checked for native partitions before any node drops anything.
+        '''
+        groups = {node: [] for node in self.nodes}
+        for i in range(numberofpartitions):
+            groups[self.nodes[i % len(self.nodes)]].append(i)
+
+        def check(node, indexes):
+            with self.connection(node) as conn:
+                cur = conn.cursor()
+                try:
+                    Interface.check_no_native_partitions(cur, prefix)
+                    conn.commit()
+                finally:
+                    cur.close()
+
+        def replace(node, indexes):
+            with self.connection(node) as conn:
+                cur = conn.cursor()
+                try:
+                    Interface.drop_partition_tables(cur, prefix)
+                    for i in indexes:
+                        Interface.create_ratings_table(cur, f"{prefix}{i}")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    cur.close()
+
+        self.on_nodes(groups, check)
+        self.on_nodes(groups, replace)
+
+    def save_placement(self, cur, scheme, numberofpartitions, boundaries=None):
+        cur.execute(SQL("""
+            CREATE TABLE IF NOT EXISTS {} (
+                scheme TEXT NOT NULL,
+                fragment_index INTEGER NOT NULL,
+                host TEXT,
+                port INTEGER,
+                dbname TEXT NOT NULL,
+                PRIMARY KEY (scheme, fragment_index)
+            );
+        """).format(Identifier(FRAGMENT_PLACEMENT_TABLE)))
+        cur.execute(SQL("DELETE FROM {} WHERE scheme = %s;").format(Identifier(FRAGMENT_PLACEMENT_TABLE)), (scheme,))
+        execute_values(cur, SQL("INSERT INTO {} (scheme, fragment_index, host, port, dbname) VALUES %s")
+                       .format(Identifier(FRAGMENT_PLACEMENT_TABLE)),
+                       [(scheme, i) + tuple(self.nodes[i % len(self.nodes)]) for i in range(numberofpartitions)])
+        Interface.save_partition_metadata(cur, scheme, numberofpartitions, boundaries, backend='nodes')
+
+    def placement(self, scheme):
+        '''
+        Node of every fragment of scheme, as recorded on the coordinator.
+        '''
+        if scheme not in self.placements:
+            cur = self.coordinator.cursor()
+            try:
+                cur.execute("SELECT to_regclass(%s) IS NOT NULL", (FRAGMENT_PLACEMENT_TABLE,))
+                rows = []
+                if cur.fetchone()[0]:
+                    cur.execute(SQL("SELECT host, port, dbname FROM {} WHERE scheme = %s ORDER BY fragment_index")
+                                .format(Identifier(FRAGMENT_PLACEMENT_TABLE)), (scheme,))
+                    rows = cur.fetchall()
+            finally:
+                cur.close()
+            if not rows:
+                raise ValueError(f"No {scheme} fragments are placed on nodes.")
+            self.placements[scheme] = [Node(*row) for row in rows]
+        return self.placements[scheme]
+
+    def check_coordinator_table(self, ratingstablename):
+        '''
+        Refuse a natively partitioned ratings table: it cannot be streamed out
+        with COPY, and its partitions may be the fragment tables of a node.
+        '''
+        cur = self.coordinator.cursor()
+        try:
+            cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (ratingstablename,))
+            row = cur.fetchone()
+            self.coordinator.commit()
+        finally:
+            cur.close()
+        if row is not None and row[0]:
+            raise ValueError(f"{ratingstablename} is natively partitioned; place a plain ratings table on nodes")
+
+    def build(self, scheme, ratingstablename, numberofpartitions, make_writer, boundaries=None):
+        self.check_coordinator_table(ratingstablename)
+        prefix = Interface.SCHEME_PREFIXES[scheme]
+        table_names = [f"{prefix}{i}" for i in range(numberofpartitions)]
+        with Metrics.span('create_partitions', scheme=scheme, backend='nodes'):
+            self.replace_fragments(prefix, numberofpartitions)
+        nodes = [self.nodes[i % len(self.nodes)] for i in range(numberofpartitions)]
+        Interface.stream_partitions(ratingstablename, table_names, make_writer, self.coordinator, nodes=nodes)
+
+        cur = self.coordinator.cursor()
+        try:
+            self.save_placement(cur, scheme, numberofpartitions, boundaries)
+            self.coordinator.commit()
+        except Exception:
+            self.coordinator.rollback()
+            raise
+        finally:
+            cur.close()
+            self.placements.pop(scheme, None)
+            Interface.invalidate_partition_metadata(self.coordinator)
+
+    def rangepartition(self, ratingstablename, numberofpartitions, equi_depth=False, sample_percent=1.0):
+        '''
+        Interface.rangepartition onto the nodes: one scan of the ratings table
+        on the coordinator, rows routed client-side to one COPY per fragment.
+        equi_depth picks the boundaries as in Interface.rangepartition.
+        '''
+        with Metrics.span('rangepartition', backend='nodes', partitions=numberofpartitions):
+            if equi_depth:
+                edges = Interface.plan_equi_depth(ratingstablename, numberofpartitions, self.coordinator, sample_percent)
+            else:
+                edges = Interface.range_edges(Interface.range_bounds(numberofpartitions))
+            self.build('range', ratingstablename, numberofpartitions,
+                       lambda buffers, stop: Interface.RangeWriter(buffers, stop, edges), edges)
+
+    def roundrobinpartition(self, ratingstablename, numberofpartitions):
+        '''
+        Interface.roundrobinpartition(streaming=True) onto the nodes.
+        '''
+        with Metrics.span('roundrobinpartition', backend='nodes', partitions=numberofpartitions):
+            self.build('roundrobin', ratingstablename, numberofpartitions, Interface.RoundRobinWriter)
+
+    def insert_fragment(self, scheme, index, row):
+        node = self.placement(scheme)[index]
+        with self.connection(node) as conn:
+            cur = conn.cursor()
+            try:
+                plan = Metrics.execute(cur, SQL("INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s)")
+                                       .format(Identifier(f"{Interface.SCHEME_PREFIXES[scheme]}{index}")), row)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+        return plan
+
+    def insert(self, scheme, ratingstablename, row, index=None):
+        '''
+        Write row to the coordinator's ratings table and to fragment index of
+        scheme on its node; a round robin index is reserved from the
+        coordinator's cursor inside the same transaction.
+        '''
+        con = self.coordinator
+        cur = con.cursor()
+        try:
+            if index is None:
+                slot, numberofpartitions = Interface.reserve_rr_slots(con, 1, len(self.placement(scheme)))
+                if numberofpartitions != len(self.placement(scheme)):
+                    # rebuilt by another coordinator client since the placement was read
+                    self.placements.pop(scheme, None)
+                index = slot % numberofpartitions
+            node = self.placement(scheme)[index]
+            with Metrics.span(f"{scheme}insert", backend='nodes',
+                              fragment=f"{Interface.SCHEME_PREFIXES[scheme]}{index}",
+                              node=f"{node.host}:{node.port}/{node.dbname}") as span:
+                cur.execute(SQL("INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s);")
+                            .format(Identifier(ratingstablename)), row)
+                plan = self.insert_fragment(scheme, index, row)
+                con.commit()
+                span.rows, span.plan = 1, plan
+        except Exception as e:
+            con.rollback()
+            if isinstance(e, UndefinedTable):
+                self.placements.pop(scheme, None)
+                Interface.invalidate_partition_metadata(con)
+            raise
+        finally:
+            cur.close()
+        Interface.notify_inserted(ratingstablename, [row])
+
+    def rangeinsert(self, ratingstablename, userid, itemid, rating):
+        index = Interface.range_fragment_index(rating, Interface.get_range_edges(self.coordinator))
+        self.insert('range', ratingstablename, (userid, itemid, rating), index)
+
+    def roundrobininsert(self, ratingstablename, userid, itemid, rating):
+        self.insert('roundrobin', ratingstablename, (userid, itemid, rating))
+
+    def scatter(self, scheme, query, params=(), fragments=None):
+        '''
+        Run query (an SQL with a {table} placeholder) on every fragment of
+        scheme, or on the given fragment indexes, one transaction per node and
+        all nodes concurrently. Returns the per-fragment row lists in order.
+        '''
+        placement = self.placement(scheme)
+        fragments = range(len(placement)) if fragments is None else fragments
+        groups = {}
+        for i in fragments:
+            groups.setdefault(placement[i], []).append(i)
+
+        def run(node, indexes):
+            results = {}
+            with self.connection(node) as conn:
+                cur = conn.cursor()
+                try:
+                    for i in indexes:
+                        cur.execute(query.format(table=Identifier(f"{Interface.SCHEME_PREFIXES[scheme]}{i}")), params)
+                        results[i] = cur.fetchall()
+                    conn.commit()
+                finally:
+                    cur.close()
+            return results
+
+        merged = {}
+        for results in self.on_nodes(groups, run).values():
+            merged.update(results)
+        return [merged[i] for i in fragments]
+
+    def rangequery(self, ratingMinValue, ratingMaxValue):
+        '''
+        Interface.rangequery over the nodes: only the nodes holding an
+        overlapping fragment are queried.
+        '''
+        edges = Interface.get_range_edges(self.coordinator)
+        indexes = Interface.overlapping_range_fragments(edges, ratingMinValue, ratingMaxValue)
+        rows = []
+        if indexes:
+            parts = self.scatter('range', SQL("SELECT userid, movieid, rating FROM {table} "
+                                              "WHERE rating >= %s AND rating <= %s"),
+                                 (ratingMinValue, ratingMaxValue), indexes)
+            rows = [row for part in parts for row in part]
+        return Interface.QueryResult(rows, len(indexes), len(edges) - 1 - len(indexes))
+
+    def drop(self, scheme):
+        '''
+        Drop the fragments of scheme from their nodes and forget their placement.
+        '''
+        prefix = Interface.SCHEME_PREFIXES[scheme]
+
+        def drop_fragments(node, indexes):
+            with self.connection(node) as conn:
+                cur = conn.cursor()
+                try:
+                    for i in indexes:
+                        cur.execute(SQL("DROP TABLE IF EXISTS {};").format(Identifier(f"{prefix}{i}")))
+                    conn.commit()
+                finally:
+                    cur.close()
+
+        groups = {}
+        for i, node in enumerate(self.placement(scheme)):
+            groups.setdefault(node, []).append(i)
+        self.on_nodes(groups, drop_fragments)
+        cur = self.coordinator.cursor()
+        try:
+            for table_name in (FRAGMENT_PLACEMENT_TABLE, Interface.PARTITION_METADATA_TABLE):
+                cur.execute(SQL("DELETE FROM {} WHERE scheme = %s;").format(Identifier(table_name)), (scheme,))
+            self.coordinator.commit()
+        finally:
+            cur.close()
+            self.placements.pop(scheme, None)
+            Interface.invalidate_partition_metadata(self.coordinator)
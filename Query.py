@@ -0,0 +1,132 @@
+#
+# Scatter-gather queries over the range_part / rrobin_part fragments
+#
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.sql import SQL, Identifier
+
+import Interface
+
+# rows: merged result; scanned / skipped: number of fragments queried / pruned
+QueryResult = Interface.QueryResult
+
+
+class FragmentQueryEngine:
+    '''
+    Runs one subquery per fragment on a thread pool, each over its own pooled
+    connection, and merges the partial results on the client.
+    '''
+    def __init__(self, dbname, workers=8):
+        self.dbname = dbname
+        self.pool = Interface.get_connection_pool(dbname, maxconn=workers)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fragments(self, scheme):
+        '''
+        Table names of every fragment of scheme.
+        '''
+        with self.pool.connection() as conn:
+            Interface.check_local_fragments(scheme, conn)
+            count = Interface.get_partition_count(scheme, conn)
+            conn.commit()
+        return [f"{Interface.SCHEME_PREFIXES[scheme]}{i}" for i in range(count)]
+
+    def range_fragments(self, minRating, maxRating):
+        '''
+        (table names to scan, number skipped) for a rating range, pruned with the
+        boundaries recorded in the partition metadata (see Interface.rangequery).
+        '''
+        with self.pool.connection() as conn:
+            indexes, numberofpartitions = Interface.range_query_fragments(minRating, maxRating, conn)
+            conn.commit()
+        return [f"{Interface.RANGE_TABLE_PREFIX}{i}" for i in indexes], numberofpartitions - len(indexes)
+
+    def run(self, table_name, query, params, composables):
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(query.format(table=Identifier(table_name), **composables), params)
+                rows = cur.fetchall()
+                conn.commit()
+            finally:
+                cur.close()
+        return rows
+
+    def scatter(self, tables, query, params=(), **composables):
+        '''
+        Run query (an SQL with a {table} placeholder, plus any other named
+        composables) on every table concurrently; returns the per-table row
+        lists in the order of tables.
+        '''
+        return list(self.executor.map(lambda table_name: self.run(table_name, query, params, composables), tables))
+
+    def rangescan(self, minRating, maxRating):
+        '''
+        All rows with minRating <= rating <= maxRating.
+        '''
+        tables, skipped = self.range_fragments(minRating, maxRating)
+        parts = self.scatter(tables, SQL("SELECT userid, movieid, rating FROM {table} WHERE rating >= %s AND rating <= %s"),
+                             (minRating, maxRating))
+        return QueryResult([row for part in parts for row in part], len(tables), skipped)
+
+    def lookup(self, userid=None, movieid=None, scheme='range'):
+        '''
+        Point lookup by userid and/or movieid; every fragment of scheme is searched.
+        '''
+        conditions, params = [], []
+        for column, value in (('userid', userid), ('movieid', movieid)):
+            if value is not None:
+                conditions.append(SQL("{} = %s").format(Identifier(column)))
+                params.append(value)
+        if not conditions:
+            raise ValueError("lookup needs a userid or a movieid")
+
+        tables = self.fragments(scheme)
+        parts = self.scatter(tables, SQL("SELECT userid, movieid, rating FROM {table} WHERE {conditions}"), params,
+                             conditions=SQL(" AND ").join(conditions))
+        return QueryResult([row for part in parts for row in part], len(tables), 0)
+
+    def movie_stats(self, scheme='range', minRating=None, maxRating=None):
+        '''
+        {movieid: (count, average rating)}, optionally for ratings in [minRating, maxRating].
+        Each fragment returns (movieid, count, sum) and the client merges them.
+        '''
+        if minRating is None and maxRating is None:
+            tables, skipped = self.fragments(scheme), 0
+            query, params = SQL("SELECT movieid, COUNT(*), SUM(rating) FROM {table} GROUP BY movieid"), ()
+        else:
+            minRating = float('-inf') if minRating is None else minRating
+            maxRating = float('inf') if maxRating is None else maxRating
+            if scheme == 'range':
+                tables, skipped = self.range_fragments(minRating, maxRating)
+            else:
+                tables, skipped = self.fragments(scheme), 0
+            query = SQL("SELECT movieid, COUNT(*), SUM(rating) FROM {table} "
+                        "WHERE rating >= %s AND rating <= %s GROUP BY movieid")
+            params = (minRating, maxRating)
+
+        totals = {}
+        for part in self.scatter(tables, query, params):
+            for movieid, count, total in part:
+                merged = totals.setdefault(movieid, [0, 0.0])
+                merged[0] += count
+                merged[1] += total
+        stats = {movieid: (count, total / count) for movieid, (count, total) in totals.items()}
+        return QueryResult(stats, len(tables), skipped)
+
+    def count(self, scheme='range'):
+        '''
+        Total number of rows over all fragments of scheme.
+        '''
+        tables = self.fragments(scheme)
+        parts = self.scatter(tables, SQL("SELECT COUNT(*) FROM {table}"))
+        return QueryResult(sum(part[0][0] for part in parts), len(tables), 0)
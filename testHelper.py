@@ -1,6 +1,14 @@
 import traceback
 import psycopg2
 import os
+import importlib
+import multiprocessing
+import tempfile
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.sql import SQL
 
 RANGE_TABLE_PREFIX = 'range_part'
 RROBIN_TABLE_PREFIX = 'rrobin_part'
@@ -63,6 +71,93 @@ def getopenconnection(dbname='postgres'):
 
 
 ####### Tester support
+# 64-bit hash of a row; partitions and base tables are compared by (row count, sum of row hashes),
+# which matches only if they hold the same multiset of rows
+ROW_HASH = "hashtextextended(concat_ws(':', {0}, {1}, {2}), 0)".format(USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME)
+
+
+def runqueries(openconnection, queries):
+    """
+    Run every query on its own connection concurrently and return their fetchall() results in order.
+    When openconnection has an open transaction, other connections could not see its uncommitted
+    rows, so the queries run one after the other on openconnection instead.
+    :param queries: SQL strings
+    :return:
+    """
+    def run(query, conn):
+        with conn.cursor() as cur:
+            cur.execute(query)
+            return cur.fetchall()
+
+    if openconnection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return [run(query, openconnection) for query in queries]
+
+    def runonnewconnection(query):
+        conn = getopenconnection(dbname=openconnection.info.dbname)
+        try:
+            return run(query, conn)
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        return list(executor.map(runonnewconnection, queries))
+
+
+def rangepartitionfilters(numberofpartitions, edges=None):
+    """
+    WHERE conditions of every range partition, with the bounds accumulated exactly like the original
+    per-partition queries did
+    :param numberofpartitions:
+    :param edges: Boundaries of the partitions, e.g. equi-depth ones; equal-width intervals if None
+    :return:
+    """
+    if edges is not None:
+        filters = ["rating >= {0} and rating <= {1}".format(edges[0], edges[1])]
+        for i in range(1, numberofpartitions):
+            filters.append("rating > {0} and rating <= {1}".format(edges[i], edges[i + 1]))
+        return filters
+    interval = 5.0 / numberofpartitions
+    filters = ["rating >= {0} and rating <= {1}".format(0, interval)]
+    lowerbound = interval
+    for i in range(1, numberofpartitions):
+        filters.append("rating > {0} and rating <= {1}".format(lowerbound, lowerbound + interval))
+        lowerbound += interval
+    return filters
+
+
+def rangepartitionexpectedquery(ratingstablename, numberofpartitions, edges=None):
+    """
+    One scan of the ratings table giving the (count, hash sum) every range partition should have,
+    followed by the (count, hash sum) of the whole table
+    """
+    columns = []
+    for condition in rangepartitionfilters(numberofpartitions, edges):
+        columns.append("count(*) filter (where {0})".format(condition))
+        columns.append("coalesce(sum({0}) filter (where {1}), 0)".format(ROW_HASH, condition))
+    columns.append("count(*)")
+    columns.append("coalesce(sum({0}), 0)".format(ROW_HASH))
+    return "select {0} from {1}".format(", ".join(columns), ratingstablename)
+
+
+def tablefingerprintquery(tablename):
+    return "select count(*), coalesce(sum({0}), 0) from {1}".format(ROW_HASH, tablename)
+
+
+def partitionfingerprintquery(n, prefix, partitionstartindex):
+    """
+    One pass over every partition giving (partition index, count, hash sum)
+    """
+    selects = []
+    for i in range(partitionstartindex, n + partitionstartindex):
+        selects.append('SELECT {0} AS part, {1} AS h FROM {2}{0}'.format(i, ROW_HASH, prefix))
+    return 'SELECT part, COUNT(*), COALESCE(SUM(h), 0) FROM ({0}) AS T GROUP BY part'.format(' UNION ALL '.join(selects))
+
+
+def partitionfingerprints(rows, n, partitionstartindex):
+    found = dict((part, (int(count), int(hashsum))) for part, count, hashsum in rows)
+    return [found.get(i, (0, 0)) for i in range(partitionstartindex, n + partitionstartindex)]
+
+
 def getCountrangepartition(ratingstablename, numberofpartitions, openconnection):
     """
     Get number of rows for each partition
@@ -72,18 +167,10 @@ def getCountrangepartition(ratingstablename, numberofpartitions, openconnection)
     :return:
     """
     cur = openconnection.cursor()
-    countList = []
-    interval = 5.0 / numberofpartitions
-    cur.execute("select count(*) from {0} where rating >= {1} and rating <= {2}".format(ratingstablename,0, interval))
-    countList.append(int(cur.fetchone()[0]))
-
-    lowerbound = interval
-    for i in range(1, numberofpartitions):
-        cur.execute("select count(*) from {0} where rating > {1} and rating <= {2}".format(ratingstablename,
-                                                                                          lowerbound,
-                                                                                          lowerbound + interval))
-        lowerbound += interval
-        countList.append(int(cur.fetchone()[0]))
+    cur.execute("select {0} from {1}".format(
+        ", ".join("count(*) filter (where {0})".format(condition) for condition in rangepartitionfilters(numberofpartitions)),
+        ratingstablename))
+    countList = [int(count) for count in cur.fetchone()]
 
     cur.close()
     return countList
@@ -91,22 +178,23 @@ def getCountrangepartition(ratingstablename, numberofpartitions, openconnection)
 
 def getCountroundrobinpartition(ratingstablename, numberofpartitions, openconnection):
     '''
-    Get number of rows for each partition
+    Get number of rows for each partition: row k goes to partition k % numberofpartitions,
+    so the counts only depend on the number of rows
     :param ratingstablename:
     :param numberofpartitions:
     :param openconnection:
     :return:
     '''
     cur = openconnection.cursor()
-    countList = []
-    for i in range(0, numberofpartitions):
-        cur.execute(
-            "select count(*) from (select *, row_number() over () from {0}) as temp where (row_number-1)%{1}= {2}".format(
-                ratingstablename, numberofpartitions, i))
-        countList.append(int(cur.fetchone()[0]))
+    cur.execute("select count(*) from {0}".format(ratingstablename))
+    total = int(cur.fetchone()[0])
 
     cur.close()
-    return countList
+    return roundrobincounts(total, numberofpartitions)
+
+
+def roundrobincounts(total, numberofpartitions):
+    return [total // numberofpartitions + (1 if i < total % numberofpartitions else 0) for i in range(numberofpartitions)]
 
 # Helpers for Tester functions
 def checkpartitioncount(cursor, expectedpartitions, prefix):
@@ -129,7 +217,13 @@ def totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartin
     return count
 
 
-def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE,
+                                  fingerprints=None, expectedfingerprint=None):
+    """
+    :param fingerprints: (count, hash sum) of every partition, from partitionfingerprintquery; counted here if None
+    :param expectedfingerprint: (count, hash sum) of the ratings table; when given, the partitions must hold
+    exactly its rows, so a row copied into two partitions fails Disjointness even if another one is missing
+    """
     with openconnection.cursor() as cur:
         if not isinstance(n, int) or n < 0:
             # Test 1: Check the number of tables created, if 'n' is invalid
@@ -138,20 +232,27 @@ def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix,
             # Test 2: Check the number of tables created, if all args are correct
             checkpartitioncount(cur, n, rangepartitiontableprefix)
 
+            # Every row is counted once, for Tests 3-5
+            if fingerprints is None:
+                count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
+            else:
+                count = sum(partcount for partcount, _ in fingerprints)
+
             # Test 3: Test Completeness by SQL UNION ALL Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
             if count < ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Completeness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
 
-            # Test 4: Test Disjointness by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
+            # Test 4: Test Disjointness by SQL UNION Magic, and by row hashes when the ratings table is known
             if count > ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Dijointness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
+            if fingerprints is not None and expectedfingerprint is not None:
+                hashsum = sum(parthash for _, parthash in fingerprints)
+                if (count, hashsum) != tuple(expectedfingerprint): raise Exception(
+                    "Dijointness property of Partitioning failed. The partitions do not hold exactly the rows of the ratings table")
 
             # Test 5: Test Reconstruction by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
             if count != ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Rescontruction property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
@@ -169,41 +270,98 @@ def testrangerobininsert(expectedtablename, itemid, openconnection, rating, user
         if count != 1:  return False
         return True
 
-def testEachRangePartition(ratingstablename, n, openconnection, rangepartitiontableprefix):
-    countList = getCountrangepartition(ratingstablename, n, openconnection)
-    cur = openconnection.cursor()
+def testEachRangePartition(ratingstablename, n, openconnection, rangepartitiontableprefix, fingerprints=None, expected=None):
+    """
+    :param fingerprints: (count, hash sum) of every partition; counted here if None
+    :param expected: (count, hash sum) every partition should have, from rangepartitionexpectedquery;
+    when given, each partition must hold exactly the rows of its range, not just as many of them
+    """
+    if fingerprints is None:
+        fingerprints = partitionfingerprints(
+            runqueries(openconnection, [partitionfingerprintquery(n, rangepartitiontableprefix, 0)])[0], n, 0)
+    if expected is None:
+        expected = [(count, None) for count in getCountrangepartition(ratingstablename, n, openconnection)]
     for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(rangepartitiontableprefix, i))
-        count = int(cur.fetchone()[0])
-        if count != countList[i]:
+        count, hashsum = fingerprints[i]
+        if count != expected[i][0]:
             raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
-                rangepartitiontableprefix, i, count, countList[i]
+                rangepartitiontableprefix, i, count, expected[i][0]
+            ))
+        if expected[i][1] is not None and hashsum != expected[i][1]:
+            raise Exception("{0}{1} has the right number of rows but not the rows of its range".format(
+                rangepartitiontableprefix, i
             ))
 
-def testEachRoundrobinPartition(ratingstablename, n, openconnection, roundrobinpartitiontableprefix):
-    countList = getCountroundrobinpartition(ratingstablename, n, openconnection)
-    cur = openconnection.cursor()
+def testEachRoundrobinPartition(ratingstablename, n, openconnection, roundrobinpartitiontableprefix, fingerprints=None, total=None):
+    """
+    :param fingerprints: (count, hash sum) of every partition; counted here if None
+    :param total: Number of rows of the ratings table; counted here if None
+    """
+    if fingerprints is None:
+        fingerprints = partitionfingerprints(
+            runqueries(openconnection, [partitionfingerprintquery(n, roundrobinpartitiontableprefix, 0)])[0], n, 0)
+    if total is None:
+        countList = getCountroundrobinpartition(ratingstablename, n, openconnection)
+    else:
+        countList = roundrobincounts(total, n)
     for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(roundrobinpartitiontableprefix, i))
-        count = cur.fetchone()[0]
+        count = fingerprints[i][0]
         if count != countList[i]:
             raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
                 roundrobinpartitiontableprefix, i, count, countList[i]
             ))
 
+def verifyrangepartitions(ratingstablename, n, openconnection, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE, edges=None):
+    """
+    Completeness, Disjointness and Reconstruction of the range partitions, and the exact rows of every one of them
+    :param edges: Boundaries the partitions were built with; equal-width intervals if None
+    """
+    if not isinstance(n, int) or n < 0:
+        testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
+        return
+    # expected and actual contents are computed concurrently, one scan each
+    expectedrow, actualrows = runqueries(openconnection, [rangepartitionexpectedquery(ratingstablename, n, edges),
+                                                          partitionfingerprintquery(n, RANGE_TABLE_PREFIX, 0)])
+    expectedrow = [int(value) for value in expectedrow[0]]
+    expected = list(zip(expectedrow[0:-2:2], expectedrow[1:-2:2]))
+    fingerprints = partitionfingerprints(actualrows, n, 0)
+    testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE,
+                                  fingerprints, expectedrow[-2:])
+    testEachRangePartition(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX, fingerprints, expected)
+
+
+def verifyroundrobinpartitions(ratingstablename, numberofpartitions, openconnection, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+    """
+    Completeness, Disjointness and Reconstruction of the round robin partitions, and the size of every one of them
+    """
+    if not isinstance(numberofpartitions, int) or numberofpartitions < 0:
+        testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
+        return
+    # expected and actual contents are computed concurrently, one scan each
+    expectedrow, actualrows = runqueries(openconnection, [tablefingerprintquery(ratingstablename),
+                                                          partitionfingerprintquery(numberofpartitions, RROBIN_TABLE_PREFIX, 0)])
+    expectedfingerprint = [int(value) for value in expectedrow[0]]
+    fingerprints = partitionfingerprints(actualrows, numberofpartitions, 0)
+    testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE,
+                                  fingerprints, expectedfingerprint)
+    testEachRoundrobinPartition(ratingstablename, numberofpartitions, openconnection, RROBIN_TABLE_PREFIX,
+                                fingerprints, expectedfingerprint[0])
+
 # ##########
 
-def testloadratings(MyAssignment, ratingstablename, filepath, openconnection, rowsininpfile):
+def testloadratings(MyAssignment, ratingstablename, filepath, openconnection, rowsininpfile, **loadoptions):
     """
     Tests the load ratings function
     :param ratingstablename: Argument for function to be tested
     :param filepath: Argument for function to be tested
     :param openconnection: Argument for function to be tested
     :param rowsininpfile: Number of rows in the input file provided for assertion
+    :param loadoptions: Extra keyword arguments for loadratings, e.g. workers=4. With any, the table must
+                        also hold the same rows as a plain load of filepath, and both are dropped afterwards
     :return:Raises exception if any test fails
     """
     try:
-        MyAssignment.loadratings(ratingstablename,filepath,openconnection)
+        MyAssignment.loadratings(ratingstablename,filepath,openconnection, **loadoptions)
         # Test 1: Count the number of rows inserted
         with openconnection.cursor() as cur:
             cur.execute('SELECT COUNT(*) from {0}'.format(ratingstablename))
@@ -211,51 +369,528 @@ def testloadratings(MyAssignment, ratingstablename, filepath, openconnection, ro
             if count != rowsininpfile:
                 raise Exception(
                     'Expected {0} rows, but {1} rows in \'{2}\' table'.format(rowsininpfile, count, ratingstablename))
+
+            # Test 2: Same rows as a plain load
+            if loadoptions:
+                referencetablename = ratingstablename + '_reference'
+                cur.execute('DROP TABLE IF EXISTS {0}'.format(referencetablename))
+                MyAssignment.loadratings(referencetablename, filepath, openconnection)
+                expectedrow, actualrow = runqueries(openconnection, [tablefingerprintquery(referencetablename),
+                                                                     tablefingerprintquery(ratingstablename)])
+                if [int(value) for value in actualrow[0]] != [int(value) for value in expectedrow[0]]:
+                    raise Exception('Loading with {0} gave different rows than a plain load in \'{1}\' table'.format(
+                        loadoptions, ratingstablename))
+                cur.execute('DROP TABLE {0}'.format(referencetablename))
+                cur.execute('DROP TABLE {0}'.format(ratingstablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testconnectionpoolstats(MyAssignment, dbname):
+    """
+    Tests the connection pool stats: after a parallel load the worker processes must report their own pools
+    of dbname, and asking for an existing pool with a larger maxconn must grow it instead of ignoring it
+    :param dbname: Database the parallel load used
+    :return:Raises exception if any test fails
+    """
+    try:
+        workerstats = [stats for stats in MyAssignment.connection_pool_stats(workers=True)
+                       if stats['pid'] != os.getpid() and stats['dbname'] == dbname]
+        if not workerstats or sum(stats['acquired'] for stats in workerstats) == 0:
+            raise Exception('No worker connection pool of {0} reported any connection: {1}'.format(dbname, workerstats))
+
+        pool = MyAssignment.get_connection_pool(dbname)
+        grown = MyAssignment.get_connection_pool(dbname, maxconn=pool.maxconn + 4)
+        if grown is not pool or pool.maxconn != grown.maxconn:
+            raise Exception('A larger maxconn did not grow the existing pool of {0}'.format(dbname))
+        held = [pool.getconn() for _ in range(pool.maxconn)]
+        for conn in held:
+            pool.putconn(conn)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testtransformequivalence(MyAssignment, filepath, blocksizes=(1, 64, 1 << 20)):
+    """
+    Tests that the mmap block transform produces exactly the bytes of the preprocess_line loop
+    :param filepath: '::' delimited ratings file, e.g. test_data.dat
+    :param blocksizes: Block sizes to try, small ones force a cut at every line
+    :return:Raises exception if any test fails
+    """
+    try:
+        with open(filepath, 'r') as f:
+            expected = ''.join(MyAssignment.preprocess_line(line) for line in f).encode()
+        for blocksize in blocksizes:
+            actual = b''.join(MyAssignment.iter_ratings_blocks(filepath, block_size=blocksize))
+            if actual != expected:
+                raise Exception(
+                    'Block transform with block_size={0} differs from preprocess_line on {1}'.format(blocksize, filepath))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testloadratingsformats(MyAssignment, filepath, openconnection, rowsininpfile):
+    """
+    Tests that loading with format='text' and format='binary' gives identical table contents
+    :param filepath: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :param rowsininpfile: Number of rows in the input file provided for assertion
+    :return:Raises exception if any test fails
+    """
+    tables = {'text': 'ratings_text_copy', 'binary': 'ratings_binary_copy'}
+    try:
+        with openconnection.cursor() as cur:
+            for fmt, tablename in tables.items():
+                cur.execute('DROP TABLE IF EXISTS {0}'.format(tablename))
+                MyAssignment.loadratings(tablename, filepath, openconnection, format=fmt)
+                cur.execute('SELECT COUNT(*) FROM {0}'.format(tablename))
+                count = int(cur.fetchone()[0])
+                if count != rowsininpfile:
+                    raise Exception('Expected {0} rows, but {1} rows in \'{2}\' table'.format(rowsininpfile, count, tablename))
+
+            for left, right in ((tables['text'], tables['binary']), (tables['binary'], tables['text'])):
+                cur.execute('SELECT COUNT(*) FROM (SELECT userid, movieid, rating FROM {0} '
+                            'EXCEPT ALL SELECT userid, movieid, rating FROM {1}) AS T'.format(left, right))
+                count = int(cur.fetchone()[0])
+                if count != 0:
+                    raise Exception('{0} rows of {1} are missing from {2}'.format(count, left, right))
+
+            for tablename in tables.values():
+                cur.execute('DROP TABLE {0}'.format(tablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testunloggedload(MyAssignment, filepath, openconnection, rowsininpfile):
+    """
+    Tests that an unlogged fast load leaves the table UNLOGGED with set_logged=False and LOGGED
+    after finish_fast_load, without losing rows
+    :param filepath: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :param rowsininpfile: Number of rows in the input file provided for assertion
+    :return:Raises exception if any test fails
+    """
+    tablename = 'ratings_unlogged_copy'
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(tablename))
+            MyAssignment.loadratings(tablename, filepath, openconnection, unlogged=True, set_logged=False)
+            for expected in ('u', 'p'):
+                cur.execute("SELECT relpersistence FROM pg_class WHERE oid = to_regclass(%s)", (tablename,))
+                persistence = cur.fetchone()[0]
+                if persistence != expected:
+                    raise Exception('Expected relpersistence {0} for {1}, got {2}'.format(expected, tablename, persistence))
+                cur.execute('SELECT COUNT(*) FROM {0}'.format(tablename))
+                count = int(cur.fetchone()[0])
+                if count != rowsininpfile:
+                    raise Exception('Expected {0} rows, but {1} rows in \'{2}\' table'.format(rowsininpfile, count, tablename))
+                MyAssignment.finish_fast_load([tablename], openconnection)
+            cur.execute('DROP TABLE {0}'.format(tablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testresumableload(MyAssignment, filepath, openconnection, rowsininpfile):
+    """
+    Tests that an append-mode load of a growing file only ingests the new tail, that a resumed load of
+    a completed file (also through a symlink) does not duplicate rows, that a second file is added next
+    to the first, and that a table of a plain load is only truncated with replace=True
+    :param filepath: Input file, copied in two halves into a temporary file
+    :param openconnection: Argument for function to be tested
+    :param rowsininpfile: Number of rows in the input file provided for assertion
+    :return:Raises exception if any test fails
+    """
+    tablename = 'ratings_resumable_copy'
+    with open(filepath, 'rb') as f:
+        lines = f.read().splitlines(True)
+    lines[-1] = lines[-1].rstrip(b'\r\n') + b'\n'
+    half = len(lines) // 2
+    fd, growingpath = tempfile.mkstemp(suffix='.dat')
+    linkpath = growingpath + '.link'
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(tablename))
+            for part, expected in ((lines[:half], half), (lines[half:], rowsininpfile)):
+                with open(growingpath, 'ab') as f:
+                    f.write(b''.join(part))
+                MyAssignment.loadratings(tablename, growingpath, openconnection, append=True)
+                cur.execute('SELECT COUNT(*) FROM {0}'.format(tablename))
+                count = int(cur.fetchone()[0])
+                if count != expected:
+                    raise Exception('Expected {0} rows after appending, but {1} rows in \'{2}\' table'.format(expected, count, tablename))
+
+            rows = MyAssignment.loadratings(tablename, growingpath, openconnection, resume=True)
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(tablename))
+            count = int(cur.fetchone()[0])
+            if rows != 0 or count != rowsininpfile:
+                raise Exception('Resuming a completed load added {0} rows, {1} rows in \'{2}\' table'.format(rows, count, tablename))
+
+            # the same file through a symlink is the same checkpoint, not a new file
+            os.symlink(growingpath, linkpath)
+            rows = MyAssignment.loadratings(tablename, linkpath, openconnection, resume=True)
+            if rows != 0:
+                raise Exception('Loading the file again through a symlink added {0} rows'.format(rows))
+
+            # a second file goes next to the first one instead of replacing it
+            MyAssignment.loadratings(tablename, filepath, openconnection, resume=True)
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(tablename))
+            count = int(cur.fetchone()[0])
+            if count != 2 * rowsininpfile:
+                raise Exception('Expected {0} rows after loading a second file, but {1} rows in \'{2}\' table'.format(2 * rowsininpfile, count, tablename))
+
+            # rows of a plain load are only replaced on request
+            cur.execute('DROP TABLE {0}'.format(tablename))
+            openconnection.commit()
+            MyAssignment.loadratings(tablename, filepath, openconnection)
+            cur.execute('DELETE FROM load_progress WHERE table_name = %s', (tablename,))
+            openconnection.commit()
+            try:
+                MyAssignment.loadratings(tablename, growingpath, openconnection, resume=True)
+            except ValueError:
+                pass
+            else:
+                raise Exception('A resumable load into a table of a plain load must be refused without replace=True')
+            MyAssignment.loadratings(tablename, growingpath, openconnection, resume=True, replace=True)
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(tablename))
+            count = int(cur.fetchone()[0])
+            if count != rowsininpfile:
+                raise Exception('Expected {0} rows after replace=True, but {1} rows in \'{2}\' table'.format(rowsininpfile, count, tablename))
+
+            try:
+                MyAssignment.loadratings(tablename, growingpath, openconnection, resume=True, workers=2)
+            except ValueError:
+                pass
+            else:
+                raise Exception('resume=True with workers must be refused')
+            cur.execute('DROP TABLE {0}'.format(tablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        os.close(fd)
+        os.remove(growingpath)
+        if os.path.lexists(linkpath):
+            os.remove(linkpath)
+    return [True, None]
+
+
+def testpipelinefailures(MyAssignment, filepath, openconnection):
+    """
+    Tests the failure paths of the pipeline=True load: a reader error must fail the load without leaving
+    its reader thread behind, and a reader blocked on a full queue must give up once stop is set
+    :param filepath: Input file for the reader
+    :param openconnection: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    tablename = 'ratings_pipeline_copy'
+    try:
+        threads = threading.active_count()
+        try:
+            MyAssignment.loadratings(tablename, filepath + '.missing', openconnection, pipeline=True, queue_depth=1,
+                                     block_size=16)
+        except Exception:
+            pass
+        else:
+            raise Exception('A pipeline load of a missing file did not fail')
+        if threading.active_count() != threads:
+            raise Exception('The reader thread of a failed pipeline load is still running')
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(tablename))
+
+        # nobody drains the queue, so the reader blocks after its first block until stopped
+        buffers = queue.Queue(maxsize=1)
+        stop = threading.Event()
+        reader = threading.Thread(target=MyAssignment.produce_ratings_buffers, args=(filepath, buffers, 16, stop),
+                                  daemon=True)
+        reader.start()
+        reader.join(0.5)
+        if not reader.is_alive() or not buffers.full():
+            raise Exception('The reader did not block on a full queue')
+        stop.set()
+        reader.join(5)
+        if reader.is_alive():
+            raise Exception('The reader did not give up after stop was set')
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testloadandpartition(MyAssignment, filepath, numberofpartitions, openconnection, rowsininpfile):
+    """
+    Tests the partition-at-ingest path: after loadandpartition the range and round robin partitions must
+    pass the same checks as after rangepartition / roundrobinpartition, and a second run into the now
+    existing table must be refused instead of duplicating its rows. The tables are dropped afterwards
+    :param filepath: Argument for function to be tested
+    :param numberofpartitions: Argument for function to be tested
+    :param rowsininpfile: Number of rows in the input file provided for assertion
+    :return:Raises exception if any test fails
+    """
+    tablename = 'ratings_ingest_copy'
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(tablename))
+            rows = MyAssignment.loadandpartition(tablename, filepath, numberofpartitions, openconnection)
+            if rows != rowsininpfile:
+                raise Exception('loadandpartition reported {0} rows, expected {1}'.format(rows, rowsininpfile))
+            verifyrangepartitions(tablename, numberofpartitions, openconnection, 0, rowsininpfile)
+            verifyroundrobinpartitions(tablename, numberofpartitions, openconnection, 0, rowsininpfile)
+
+            try:
+                MyAssignment.loadandpartition(tablename, filepath, numberofpartitions, openconnection)
+            except ValueError:
+                pass
+            else:
+                raise Exception('loadandpartition into the existing {0} table was not refused'.format(tablename))
+            verifyrangepartitions(tablename, numberofpartitions, openconnection, 0, rowsininpfile)
+
+            cur.execute('DROP TABLE {0}'.format(tablename))
+            for i in range(numberofpartitions):
+                for prefix in (RANGE_TABLE_PREFIX, RROBIN_TABLE_PREFIX):
+                    cur.execute('DROP TABLE {0}{1}'.format(prefix, i))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testroundrobinrebuild(MyAssignment, filepath, numberofpartitions, openconnection, rowsininpfile):
+    """
+    Tests that roundrobinpartition can run twice on the same connection: the second run must replace the
+    partitions of the first instead of failing on its leftovers. The tables are dropped afterwards
+    :param filepath: Input file for the scratch table
+    :param numberofpartitions: Argument for function to be tested
+    :param rowsininpfile: Number of rows in the input file provided for assertion
+    :return:Raises exception if any test fails
+    """
+    tablename = 'ratings_rebuild_copy'
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(tablename))
+            MyAssignment.loadratings(tablename, filepath, openconnection)
+            for _ in range(2):
+                MyAssignment.roundrobinpartition(tablename, numberofpartitions, openconnection)
+                verifyroundrobinpartitions(tablename, numberofpartitions, openconnection, 0, rowsininpfile)
+
+            cur.execute('DROP TABLE {0}'.format(tablename))
+            for i in range(numberofpartitions):
+                cur.execute('DROP TABLE {0}{1}'.format(RROBIN_TABLE_PREFIX, i))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testnativepartition(MyAssignment, scheme, filepath, numberofpartitions, openconnection, rowsininpfile,
+                        userid=100, itemid=1, rating=3, expectedtableindex='2'):
+    """
+    Tests backend='native': filepath is loaded into a scratch table that is then declaratively partitioned.
+    Range partitions must hold exactly the rows of their ranges and hash partitions exactly the rows of the
+    table, and an insert through rangeinsert / roundrobininsert must be stored once, in the range partition
+    of its rating for range. A rebuild with the 'tables' backend must then be refused without losing rows.
+    The scratch table and its partitions are dropped afterwards
+    :param scheme: 'range' or 'roundrobin'
+    :param filepath: Input file for the scratch table
+    :param numberofpartitions: Argument for function to be tested
+    :param rowsininpfile: Number of rows in the input file provided for assertion
+    :param userid, itemid, rating: Tuple inserted
+    :param expectedtableindex: The range partition the tuple belongs to
+    :return:Raises exception if any test fails
+    """
+    tablename = 'ratings_native_copy'
+    prefix = RANGE_TABLE_PREFIX if scheme == 'range' else RROBIN_TABLE_PREFIX
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(tablename))
+            MyAssignment.loadratings(tablename, filepath, openconnection)
+            if scheme == 'range':
+                MyAssignment.rangepartition(tablename, numberofpartitions, openconnection, backend='native')
+                verifyrangepartitions(tablename, numberofpartitions, openconnection, 0, rowsininpfile)
+                MyAssignment.rangeinsert(tablename, userid, itemid, rating, openconnection)
+                expectedtables = [RANGE_TABLE_PREFIX + expectedtableindex]
+            else:
+                MyAssignment.roundrobinpartition(tablename, numberofpartitions, openconnection, backend='native')
+                expectedrow, actualrows = runqueries(openconnection, [tablefingerprintquery(tablename),
+                                                                      partitionfingerprintquery(numberofpartitions, prefix, 0)])
+                testrangeandrobinpartitioning(numberofpartitions, openconnection, prefix, 0, rowsininpfile,
+                                              partitionfingerprints(actualrows, numberofpartitions, 0),
+                                              [int(value) for value in expectedrow[0]])
+                MyAssignment.roundrobininsert(tablename, userid, itemid, rating, openconnection)
+                expectedtables = ['{0}{1}'.format(prefix, i) for i in range(numberofpartitions)]
+
+            if not testrangerobininsert(tablename, itemid, openconnection, rating, userid):
+                raise Exception('{0}insert of ({1}, {2}, {3}) is not stored exactly once in {4}'.format(
+                    scheme, userid, itemid, rating, tablename))
+            found = [expectedtablename for expectedtablename in expectedtables
+                     if testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid)]
+            if len(found) != 1:
+                raise Exception('{0}insert of ({1}, {2}, {3}) is in {4} instead of one of {5}'.format(
+                    scheme, userid, itemid, rating, found, expectedtables))
+
+            # a 'tables' rebuild would drop the native partitions and the rows in them
+            try:
+                if scheme == 'range':
+                    MyAssignment.rangepartition(tablename, numberofpartitions, openconnection)
+                else:
+                    MyAssignment.roundrobinpartition(tablename, numberofpartitions, openconnection)
+            except ValueError:
+                openconnection.rollback()
+            else:
+                raise Exception('A \'tables\' {0} partitioning over native partitions must be refused'.format(scheme))
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(tablename))
+            count = int(cur.fetchone()[0])
+            if count != rowsininpfile + 1:
+                raise Exception('Expected {0} rows after the refused rebuild, but {1} rows in \'{2}\' table'.format(rowsininpfile + 1, count, tablename))
+            cur.execute('DROP TABLE {0}'.format(tablename))
     except Exception as e:
         traceback.print_exc()
         return [False, e]
     return [True, None]
 
 
-def testrangepartition(MyAssignment, ratingstablename, n, openconnection, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+def testrangepartition(MyAssignment, ratingstablename, n, openconnection, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE, **partitionoptions):
     """
     Tests the range partition function for Completness, Disjointness and Reconstruction
     :param ratingstablename: Argument for function to be tested
     :param n: Argument for function to be tested
     :param openconnection: Argument for function to be tested
     :param partitionstartindex: Indicates how the table names are indexed. Do they start as rangepart1, 2 ... or rangepart0, 1, 2...
+    :param partitionoptions: Extra keyword arguments for rangepartition, e.g. single_pass=True
     :return:Raises exception if any test fails
     """
 
     try:
-        MyAssignment.rangepartition(ratingstablename, n, openconnection)
-        testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
-        testEachRangePartition(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX)
+        MyAssignment.rangepartition(ratingstablename, n, openconnection, **partitionoptions)
+        verifyrangepartitions(ratingstablename, n, openconnection, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
         return [True, None]
     except Exception as e:
         traceback.print_exc()
         return [False, e]
 
 
+def testequidepthpartition(MyAssignment, ratingstablename, n, openconnection, ACTUAL_ROWS_IN_INPUT_FILE):
+    """
+    Tests rangepartition with equi-depth boundaries: the partitions must hold exactly the rows of the
+    boundaries recorded in the metadata, every rating in them must be routed back to its partition the
+    way rangeinsert does, and the sampled fragment sizes must be no more skewed than equal-width ones
+    :param n: Number of partitions
+    :return:Raises exception if any test fails
+    """
+    try:
+        MyAssignment.rangepartition(ratingstablename, n, openconnection, equi_depth=True)
+        edges = MyAssignment.get_partition_metadata('range', openconnection).boundaries
+        if len(edges) != n + 1 or edges != sorted(edges):
+            raise Exception('Equi-depth boundaries {0} are not {1} sorted edges'.format(edges, n + 1))
+        verifyrangepartitions(ratingstablename, n, openconnection, 0, ACTUAL_ROWS_IN_INPUT_FILE, edges)
+
+        selects = ['SELECT {0} AS part, rating FROM {1}{0} GROUP BY rating'.format(i, RANGE_TABLE_PREFIX) for i in range(n)]
+        for part, rating in runqueries(openconnection, [' UNION ALL '.join(selects)])[0]:
+            index = MyAssignment.range_fragment_index(rating, edges)
+            if index != part:
+                raise Exception('Rating {0} is stored in {1}{2} but rangeinsert routes it to {1}{3}'.format(
+                    rating, RANGE_TABLE_PREFIX, part, index))
+
+        report = MyAssignment.range_skew_report
+        before, after = MyAssignment.fragment_skew(report.equal_width), MyAssignment.fragment_skew(report.equi_depth)
+        if after > before:
+            raise Exception('Equi-depth fragments are more skewed ({0:.2f}) than equal-width ones ({1:.2f})'.format(
+                after, before))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
 def testroundrobinpartition(MyAssignment, ratingstablename, numberofpartitions, openconnection,
-                            partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+                            partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE, **partitionoptions):
     """
     Tests the round robin partitioning for Completness, Disjointness and Reconstruction
     :param ratingstablename: Argument for function to be tested
     :param numberofpartitions: Argument for function to be tested
     :param openconnection: Argument for function to be tested
     :param robinpartitiontableprefix: This function assumes that you tables are named in an order. Eg: robinpart1, robinpart2...
+    :param partitionoptions: Extra keyword arguments for roundrobinpartition, e.g. streaming=True
     :return:Raises exception if any test fails
     """
     try:
-        MyAssignment.roundrobinpartition(ratingstablename, numberofpartitions, openconnection)
-        testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
-        testEachRoundrobinPartition(ratingstablename, numberofpartitions, openconnection, RROBIN_TABLE_PREFIX)
+        MyAssignment.roundrobinpartition(ratingstablename, numberofpartitions, openconnection, **partitionoptions)
+        verifyroundrobinpartitions(ratingstablename, numberofpartitions, openconnection, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+def testrepartition(MyAssignment, ratingstablename, scheme, fromn, ton, openconnection, ACTUAL_ROWS_IN_INPUT_FILE):
+    """
+    Tests repartition by resizing the partitions from fromn to ton and back, verifying them like a
+    fresh rangepartition / roundrobinpartition after each step
+    :param scheme: 'range' or 'roundrobin'
+    :param fromn: Current number of partitions
+    :param ton: Number of partitions to resize to
+    :return:Raises exception if any test fails
+    """
+    verify = verifyrangepartitions if scheme == 'range' else verifyroundrobinpartitions
+    try:
+        for n in (ton, fromn):
+            moved = MyAssignment.repartition(ratingstablename, n, openconnection, scheme=scheme)
+            if moved > ACTUAL_ROWS_IN_INPUT_FILE:
+                raise Exception('repartition to {0} moved {1} rows, more than the {2} rows there are'.format(
+                    n, moved, ACTUAL_ROWS_IN_INPUT_FILE))
+            verify(ratingstablename, n, openconnection, 0, ACTUAL_ROWS_IN_INPUT_FILE)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def repartitionworker(args):
+    modulename, dbname, ratingstablename, scheme, numberofpartitions = args
+    MyAssignment = importlib.import_module(modulename)
+    con = getopenconnection(dbname=dbname)
+    try:
+        MyAssignment.repartition(ratingstablename, numberofpartitions, con, scheme=scheme)
+    finally:
+        con.close()
+
+
+def testrepartitionelsewhere(MyAssignment, ratingstablename, fromn, ton, openconnection, userid=103, itemid=3, rating=1):
+    """
+    Tests that rangeinsert notices a repartition made by another process: with the boundaries of fromn
+    partitions cached here, another process resizes them to ton, and the next rangeinsert must still put
+    its row in the partition of its range. The partitions are resized back to fromn afterwards
+    :param fromn: Current number of range partitions
+    :param ton: Number of partitions the other process resizes to
+    :param userid, itemid, rating: Tuple inserted before and after the resize (itemid + 1 the second time)
+    :return:Raises exception if any test fails
+    """
+    try:
+        MyAssignment.rangeinsert(ratingstablename, userid, itemid, rating, openconnection)
+        with multiprocessing.Pool(1) as pool:
+            pool.apply(repartitionworker, ((MyAssignment.__name__, openconnection.info.dbname, ratingstablename, 'range', ton),))
+        MyAssignment.rangeinsert(ratingstablename, userid, itemid + 1, rating, openconnection)
+        for n in (ton, fromn):
+            with openconnection.cursor() as cur:
+                cur.execute('SELECT COUNT(*) FROM {0}'.format(ratingstablename))
+                count = int(cur.fetchone()[0])
+            verifyrangepartitions(ratingstablename, n, openconnection, 0, count)
+            if n == ton:
+                MyAssignment.repartition(ratingstablename, fromn, openconnection, scheme='range')
     except Exception as e:
         traceback.print_exc()
         return [False, e]
     return [True, None]
 
+
 def testroundrobininsert(MyAssignment, ratingstablename, userid, itemid, rating, openconnection, expectedtableindex):
     """
     Tests the roundrobin insert function by checking whether the tuple is inserted in he Expected table you provide
@@ -280,6 +915,451 @@ def testroundrobininsert(MyAssignment, ratingstablename, userid, itemid, rating,
     return [True, None]
 
 
+def concurrentroundrobinworker(args):
+    modulename, dbname, ratingstablename, workerid, rowsperworker = args
+    MyAssignment = importlib.import_module(modulename)
+    con = getopenconnection(dbname=dbname)
+    try:
+        for i in range(rowsperworker):
+            MyAssignment.roundrobininsert(ratingstablename, 100000 + workerid, i + 1, 3, con)
+    finally:
+        con.close()
+
+
+def testconcurrentroundrobininsert(MyAssignment, ratingstablename, numberofpartitions, openconnection, processes=4, rowsperprocess=50):
+    """
+    Tests that roundrobininsert called from several processes at once still spreads rows evenly
+    :param ratingstablename: Argument for function to be tested
+    :param numberofpartitions: Number of round robin partitions that already exist
+    :param openconnection: Used to read the counts before and after
+    :param processes: Number of concurrent inserting processes, each with its own connection
+    :param rowsperprocess: Number of roundrobininsert calls per process
+    :return:Raises exception if any test fails
+    """
+    def partitioncounts(cur):
+        counts = []
+        for i in range(numberofpartitions):
+            cur.execute('SELECT COUNT(*) FROM {0}{1}'.format(RROBIN_TABLE_PREFIX, i))
+            counts.append(int(cur.fetchone()[0]))
+        return counts
+
+    try:
+        with openconnection.cursor() as cur:
+            before = partitioncounts(cur)
+            cur.execute("SELECT rr_cursor FROM partition_metadata WHERE scheme = 'roundrobin'")
+            start = int(cur.fetchone()[0])
+        openconnection.commit()
+
+        args = [(MyAssignment.__name__, openconnection.info.dbname, ratingstablename, w, rowsperprocess)
+                for w in range(processes)]
+        with multiprocessing.Pool(processes) as pool:
+            pool.map(concurrentroundrobinworker, args)
+
+        with openconnection.cursor() as cur:
+            after = partitioncounts(cur)
+        openconnection.commit()
+
+        total = processes * rowsperprocess
+        for i in range(numberofpartitions):
+            # slots start..start+total-1 were taken, slot k belongs to partition k % n
+            expected = sum(1 for k in range(start, start + total) if k % numberofpartitions == i)
+            if after[i] - before[i] != expected:
+                raise Exception('{0}{1} received {2} rows but {3} were expected'.format(
+                    RROBIN_TABLE_PREFIX, i, after[i] - before[i], expected))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testinsertmany(MyAssignment, ratingstablename, scheme, numberofpartitions, openconnection, inserts=110, firstuserid=300000,
+                   rrblocksize=None, batchsize=7):
+    """
+    Tests rangeinsert_many / roundrobininsert_many: range partitions must still hold exactly the rows of
+    their ranges afterwards, and round robin partitions must receive the rows of the slots the batch took
+    :param scheme: 'range' or 'roundrobin'
+    :param numberofpartitions: Number of partitions that already exist
+    :param inserts: Number of rows in the batch, with ratings 0, 0.5, ... 5 including every boundary
+    :param rrblocksize: With roundrobin, write the rows batchsize at a time through a RoundRobinCursor reserving
+                        rrblocksize slots at once; the slots must stay contiguous, so the partitions stay balanced
+    :return:Raises exception if any test fails
+    """
+    rows = [(firstuserid + k, k, (k % 11) / 2.0) for k in range(inserts)]
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(ratingstablename))
+            total = int(cur.fetchone()[0])
+            if scheme == 'range':
+                inserted = MyAssignment.rangeinsert_many(ratingstablename, rows, openconnection)
+            else:
+                cur.execute(partitionfingerprintquery(numberofpartitions, RROBIN_TABLE_PREFIX, 0))
+                before = partitionfingerprints(cur.fetchall(), numberofpartitions, 0)
+                cur.execute("SELECT rr_cursor FROM partition_metadata WHERE scheme = 'roundrobin'")
+                start = int(cur.fetchone()[0])
+                if rrblocksize is None:
+                    inserted = MyAssignment.roundrobininsert_many(ratingstablename, rows, openconnection)
+                else:
+                    rrcursor = MyAssignment.RoundRobinCursor(openconnection.info.dbname, block_size=rrblocksize)
+                    try:
+                        inserted = sum(MyAssignment.roundrobininsert_many(ratingstablename, rows[k:k + batchsize],
+                                                                          openconnection, rr_cursor=rrcursor)
+                                       for k in range(0, inserts, batchsize))
+                    finally:
+                        rrcursor.close()
+                    # whole blocks are reserved, the unused rest of the last one is skipped
+                    cur.execute("SELECT rr_cursor FROM partition_metadata WHERE scheme = 'roundrobin'")
+                    reserved = int(cur.fetchone()[0]) - start
+                    if reserved != -(-inserts // rrblocksize) * rrblocksize:
+                        raise Exception('RoundRobinCursor reserved {0} slots for {1} rows in blocks of {2}'.format(
+                            reserved, inserts, rrblocksize))
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(ratingstablename))
+            count = int(cur.fetchone()[0])
+            if inserted != inserts or count != total + inserts:
+                raise Exception('{0}insert_many reported {1} rows and added {2}, expected {3}'.format(
+                    scheme, inserted, count - total, inserts))
+
+            if scheme == 'range':
+                verifyrangepartitions(ratingstablename, numberofpartitions, openconnection, 0, count)
+            else:
+                cur.execute(partitionfingerprintquery(numberofpartitions, RROBIN_TABLE_PREFIX, 0))
+                after = partitionfingerprints(cur.fetchall(), numberofpartitions, 0)
+                for i in range(numberofpartitions):
+                    # slots start..start+inserts-1 were taken, slot k belongs to partition k % n
+                    expected = sum(1 for k in range(start, start + inserts) if k % numberofpartitions == i)
+                    if after[i][0] - before[i][0] != expected:
+                        raise Exception('{0}{1} received {2} rows but {3} were expected'.format(
+                            RROBIN_TABLE_PREFIX, i, after[i][0] - before[i][0], expected))
+                received = [after[i][0] - before[i][0] for i in range(numberofpartitions)]
+                if max(received) - min(received) > 1:
+                    raise Exception('Round robin partitions received unbalanced rows: {0}'.format(received))
+                cur.execute(tablefingerprintquery(ratingstablename))
+                if sum(hashsum for _, hashsum in after) != int(cur.fetchone()[1]):
+                    raise Exception('Round robin partitions do not hold exactly the rows of {0}'.format(ratingstablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testlegacyroundrobininsert(MyAssignment, ratingstablename, numberofpartitions, openconnection, userid=104, itemid=4, rating=3):
+    """
+    Tests roundrobininsert on round robin partitions built without the partition_metadata registry: the
+    registry must be created on first use with a cursor starting at partition 0
+    :param numberofpartitions: Number of round robin partitions that already exist
+    :param userid, itemid, rating: Tuple inserted, expected in partition 0
+    :return:Raises exception if any test fails
+    """
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE partition_metadata')
+        MyAssignment.invalidate_partition_metadata(openconnection)
+        MyAssignment.roundrobininsert(ratingstablename, userid, itemid, rating, openconnection)
+        expectedtablename = RROBIN_TABLE_PREFIX + '0'
+        if not testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
+            raise Exception('Round robin insert without a registry did not put ({0}, {1}, {2}) in {3}'.format(
+                userid, itemid, rating, expectedtablename))
+        with openconnection.cursor() as cur:
+            cur.execute("SELECT partition_count, rr_cursor FROM partition_metadata WHERE scheme = 'roundrobin'")
+            row = cur.fetchone()
+        if row is None or tuple(row) != (numberofpartitions, 1):
+            raise Exception('Expected a round robin cursor row ({0}, 1), found {1}'.format(numberofpartitions, row))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testfragmentqueries(QueryEngine, ratingstablename, openconnection, minrating=4.5, maxrating=5):
+    """
+    Tests the scatter-gather queries over the range fragments against the same queries on the base table
+    :param QueryEngine: A FragmentQueryEngine connected to the same database
+    :param ratingstablename: Base table the fragments were built from
+    :param openconnection: Used to run the reference queries
+    :return:Raises exception if any test fails
+    """
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(ratingstablename))
+            expectedcount = int(cur.fetchone()[0])
+            cur.execute('SELECT COUNT(*) FROM {0} WHERE {1} >= {2} AND {1} <= {3}'.format(
+                ratingstablename, RATING_COLNAME, minrating, maxrating))
+            expectedrange = int(cur.fetchone()[0])
+            cur.execute('SELECT COUNT(DISTINCT {0}) FROM {1}'.format(MOVIE_ID_COLNAME, ratingstablename))
+            expectedmovies = int(cur.fetchone()[0])
+
+        count = QueryEngine.count('range').rows
+        if count != expectedcount:
+            raise Exception('Fragments hold {0} rows but {1} has {2}'.format(count, ratingstablename, expectedcount))
+        result = QueryEngine.rangescan(minrating, maxrating)
+        if len(result.rows) != expectedrange:
+            raise Exception('Range scan [{0}, {1}] returned {2} rows, expected {3}'.format(
+                minrating, maxrating, len(result.rows), expectedrange))
+        stats = QueryEngine.movie_stats('range').rows
+        if len(stats) != expectedmovies or sum(c for c, _ in stats.values()) != expectedcount:
+            raise Exception('Per-movie aggregates do not add up to the base table')
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testrangequery(MyAssignment, ratingstablename, numberofpartitions, openconnection, minrating=4.5, maxrating=5):
+    """
+    Tests that rangequery / pointquery return the same rows as the base table while skipping the
+    range partitions that cannot overlap the predicate
+    :param ratingstablename: Base table the range partitions were built from
+    :param numberofpartitions: Number of range partitions
+    :param openconnection: Used to run the reference queries
+    :return:Raises exception if any test fails
+    """
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM {0} WHERE {1} >= {2} AND {1} <= {3}'.format(
+                ratingstablename, RATING_COLNAME, minrating, maxrating))
+            expectedrange = int(cur.fetchone()[0])
+            cur.execute('SELECT COUNT(*) FROM {0} WHERE {1} = {2}'.format(ratingstablename, RATING_COLNAME, maxrating))
+            expectedpoint = int(cur.fetchone()[0])
+
+        result = MyAssignment.rangequery(minrating, maxrating, openconnection)
+        if len(result.rows) != expectedrange:
+            raise Exception('rangequery [{0}, {1}] returned {2} rows, expected {3}'.format(
+                minrating, maxrating, len(result.rows), expectedrange))
+        if result.scanned + result.skipped != numberofpartitions or result.scanned >= numberofpartitions:
+            raise Exception('rangequery scanned {0} and skipped {1} of {2} partitions'.format(
+                result.scanned, result.skipped, numberofpartitions))
+        result = MyAssignment.rangequery(maxrating, minrating, openconnection)
+        if result.rows or result.scanned != 0 or result.skipped != numberofpartitions:
+            raise Exception('Empty rangequery [{0}, {1}] returned {2} rows and scanned {3} partitions'.format(
+                maxrating, minrating, len(result.rows), result.scanned))
+        result = MyAssignment.pointquery(maxrating, openconnection)
+        if len(result.rows) != expectedpoint or result.scanned != 1:
+            raise Exception('pointquery({0}) returned {1} rows from {2} partitions, expected {3} rows from 1'.format(
+                maxrating, len(result.rows), result.scanned, expectedpoint))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testasyncinterface(AsyncInterface, MyAssignment, ratingstablename, filepath, openconnection, rowsininpfile,
+                       inserts=100, firstuserid=200000):
+    """
+    Tests the asyncio API: COPY of filepath into a scratch table, concurrent rangeinsert calls landing in the
+    fragments the blocking rangeinsert would pick, and rangequery matching the blocking one
+    :param AsyncInterface: The AsyncInterface class
+    :param ratingstablename: Range partitioned table to insert into and query
+    :param filepath: Input file for the async load
+    :param rowsininpfile: Number of rows in the input file provided for assertion
+    :param inserts: Number of concurrent rangeinsert calls, with userids from firstuserid up
+    :return:Raises exception if any test fails
+    """
+    tablename = 'ratings_async_copy'
+    rows = [(firstuserid + k, k, (k % 10 + 1) / 2.0) for k in range(inserts)]
+
+    async def run(dbname):
+        async with AsyncInterface(dbname) as db:
+            loaded = await db.loadratings(tablename, filepath)
+            await asyncio.gather(*(db.rangeinsert(ratingstablename, *row) for row in rows))
+            result = await db.rangequery(4.5, 5)
+        return loaded, result
+
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(tablename))
+            loaded, result = asyncio.run(run(openconnection.info.dbname))
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(tablename))
+            count = int(cur.fetchone()[0])
+            if loaded != rowsininpfile or count != rowsininpfile:
+                raise Exception('Async load reported {0} rows and stored {1}, expected {2}'.format(loaded, count, rowsininpfile))
+            cur.execute('DROP TABLE {0}'.format(tablename))
+
+            edges = MyAssignment.get_range_edges(openconnection)
+            for userid, itemid, rating in rows:
+                index = MyAssignment.range_fragment_index(rating, edges)
+                for expectedtablename in (ratingstablename, '{0}{1}'.format(RANGE_TABLE_PREFIX, index)):
+                    if not testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
+                        raise Exception('Async rangeinsert of ({0}, {1}, {2}) not found in {3}'.format(
+                            userid, itemid, rating, expectedtablename))
+
+            expected = MyAssignment.rangequery(4.5, 5, openconnection)
+            if len(result.rows) != len(expected.rows) or result.skipped != expected.skipped:
+                raise Exception('Async rangequery returned {0} rows skipping {1} fragments, expected {2} rows skipping {3}'.format(
+                    len(result.rows), result.skipped, len(expected.rows), expected.skipped))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testpartitionindexes(MyAssignment, prefix, numberofpartitions, openconnection):
+    """
+    Tests that build_partition_indexes creates the (userid), (movieid) and BRIN (rating) indexes
+    on every partition and reports a build time for each of them
+    :param prefix: Prefix of the partition tables
+    :param numberofpartitions: Number of partitions
+    :param openconnection: Open connection to the database
+    :return:Raises exception if any test fails
+    """
+    try:
+        timings = MyAssignment.build_partition_indexes(prefix, numberofpartitions, openconnection)
+        for i in range(numberofpartitions):
+            tablename = '{0}{1}'.format(prefix, i)
+            if tablename not in timings:
+                raise Exception('No index build time recorded for {0}'.format(tablename))
+            with openconnection.cursor() as cur:
+                cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = 'public' AND tablename = %s",
+                            (tablename,))
+                indexnames = set(row[0] for row in cur.fetchall())
+            missing = ['{0}_{1}'.format(tablename, suffix) for suffix in MyAssignment.FRAGMENT_INDEXES
+                       if '{0}_{1}'.format(tablename, suffix) not in indexnames]
+            if missing:
+                raise Exception('Missing indexes on {0}: {1}'.format(tablename, ', '.join(missing)))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testinsertmetrics(MyAssignment, Metrics, ratingstablename, userid, itemid, rating, openconnection):
+    """
+    Tests that rangeinsert reports its fragment, rows and a sampled EXPLAIN plan to a Metrics
+    listener, and that the Prometheus exporter renders it
+    :param Metrics: The instrumentation module
+    :param ratingstablename: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    events = []
+    exporter = Metrics.PrometheusExporter()
+    Metrics.add_listener(events.append)
+    Metrics.add_listener(exporter)
+    Metrics.enable_explain(1.0)
+    try:
+        MyAssignment.rangeinsert(ratingstablename, userid, itemid, rating, openconnection)
+        inserts = [event for event in events if event.name == 'rangeinsert']
+        if len(inserts) != 1 or inserts[0].rows != 1 or inserts[0].plan is None:
+            raise Exception('Expected one rangeinsert event with a plan, got {0}'.format(inserts))
+        if 'phase="rangeinsert"' not in exporter.render():
+            raise Exception('rangeinsert missing from the Prometheus export')
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        Metrics.enable_explain(0.0)
+        Metrics.remove_listener(exporter)
+        Metrics.remove_listener(events.append)
+    return [True, None]
+
+
+def testratingscache(Cache, MyAssignment, ratingstablename, openconnection, userid=102, itemid=2, rating=4):
+    """
+    Tests the columnar ratings cache: loaded from the ratings table and from the range partitions it must
+    hold every row with the per-movie counts and averages and the per-user counts of the database, and a
+    rangeinsert must show up in both caches without a reload
+    :param userid, itemid, rating: Tuple inserted with rangeinsert
+    :return:Raises exception if any test fails
+    """
+    try:
+        with Cache.RatingsCache() as cache, Cache.RatingsCache() as fragmentcache:
+            rows = cache.load(openconnection, ratingstablename)
+            fragmentrows = fragmentcache.load(openconnection, ratingstablename, scheme='range')
+            with openconnection.cursor() as cur:
+                cur.execute('SELECT movieid, COUNT(*), AVG(rating) FROM {0} GROUP BY movieid ORDER BY movieid'.format(ratingstablename))
+                expected = cur.fetchall()
+                cur.execute('SELECT COUNT(*) FROM {0} WHERE userid = {1}'.format(ratingstablename, userid))
+                usercount = int(cur.fetchone()[0])
+
+            total = sum(count for _, count, _ in expected)
+            if rows != total or fragmentrows != total:
+                raise Exception('Cache holds {0} rows from the table and {1} from the partitions, expected {2}'.format(
+                    rows, fragmentrows, total))
+            movieids, counts, averages = cache.movie_stats()
+            if movieids.tolist() != [movieid for movieid, _, _ in expected] or \
+                    counts.tolist() != [count for _, count, _ in expected] or \
+                    any(abs(average - float(expectedaverage)) > 1e-6 for average, (_, _, expectedaverage) in zip(averages, expected)):
+                raise Exception('Cached per-movie counts and averages do not match the ratings table')
+            if cache.user_count(userid) != usercount:
+                raise Exception('Cache counts {0} ratings of user {1}, expected {2}'.format(cache.user_count(userid), userid, usercount))
+
+            MyAssignment.rangeinsert(ratingstablename, userid, itemid, rating, openconnection)
+            for cached in (cache, fragmentcache):
+                userids, ratings = cached.movie_ratings(itemid)
+                if cached.user_count(userid) != usercount + 1 or (userid, rating) not in zip(userids.tolist(), ratings.tolist()):
+                    raise Exception('rangeinsert of ({0}, {1}, {2}) is missing from the cache'.format(userid, itemid, rating))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testplacement(MyAssignment, Placement, Cache, ratingstablename, nodes, openconnection, numberofpartitions=5):
+    """
+    Tests range and round robin partitioning onto several nodes: fragment i must be placed on
+    nodes[i % len(nodes)] and hold exactly the rows of a local partitioning, and rangeinsert /
+    roundrobininsert must reach the fragment on its owning node, while the local rangequery and
+    RatingsCache must refuse the placed fragments. The fragments are dropped afterwards
+    :param nodes: (host, port, dbname) of every node, e.g. Placement.parse_nodes()
+    :param numberofpartitions: Number of fragments of each scheme
+    :return:Raises exception if any test fails
+    """
+    fingerprintquery = SQL("SELECT COUNT(*), COALESCE(SUM({0}), 0) FROM {{table}}".format(ROW_HASH))
+    findquery = SQL("SELECT COUNT(*) FROM {table} WHERE userid = %s AND movieid = %s AND rating = %s")
+    try:
+        with Placement.Placement(nodes, openconnection) as placement:
+            placement.create_databases()
+            expectedrow = [int(value) for value in
+                           runqueries(openconnection, [rangepartitionexpectedquery(ratingstablename, numberofpartitions)])[0][0]]
+            total, totalhash = expectedrow[-2:]
+            for scheme in ('range', 'roundrobin'):
+                if scheme == 'range':
+                    placement.rangepartition(ratingstablename, numberofpartitions)
+                    expected = list(zip(expectedrow[0:-2:2], expectedrow[1:-2:2]))
+                else:
+                    placement.roundrobinpartition(ratingstablename, numberofpartitions)
+                    expected = [(count, None) for count in roundrobincounts(total, numberofpartitions)]
+
+                placed = placement.placement(scheme)
+                for i in range(numberofpartitions):
+                    if tuple(placed[i]) != tuple(nodes[i % len(nodes)]):
+                        raise Exception('{0} fragment {1} is placed on {2} instead of {3}'.format(
+                            scheme, i, tuple(placed[i]), tuple(nodes[i % len(nodes)])))
+
+                fingerprints = [(int(part[0][0]), int(part[0][1])) for part in placement.scatter(scheme, fingerprintquery)]
+                for i, ((count, hashsum), (expectedcount, expectedhash)) in enumerate(zip(fingerprints, expected)):
+                    if count != expectedcount or (expectedhash is not None and hashsum != expectedhash):
+                        raise Exception('{0} fragment {1} holds {2} rows, expected {3} rows of its own'.format(
+                            scheme, i, count, expectedcount))
+                if sum(count for count, _ in fingerprints) != total or sum(hashsum for _, hashsum in fingerprints) != totalhash:
+                    raise Exception('{0} fragments on the nodes do not reconstruct the ratings table'.format(scheme))
+
+            # range: rating 3 belongs to fragment 2 of 5; round robin: the cursor restarts at fragment 0
+            for scheme, insert, index in (('range', placement.rangeinsert, 2), ('roundrobin', placement.roundrobininsert, 0)):
+                insert(ratingstablename, 100, 1, 3)
+                found = placement.scatter(scheme, findquery, (100, 1, 3), [index])[0][0][0]
+                if not found:
+                    raise Exception('{0}insert of (100, 1, 3) not found in fragment {1} on {2}'.format(
+                        scheme, index, tuple(placement.placement(scheme)[index])))
+
+            try:
+                MyAssignment.rangequery(0, 5, openconnection)
+            except ValueError:
+                pass
+            else:
+                raise Exception('rangequery read local range_part tables while the fragments are placed on nodes')
+            try:
+                Cache.RatingsCache().load(openconnection, ratingstablename, scheme='range')
+            except ValueError:
+                pass
+            else:
+                raise Exception('RatingsCache loaded local range_part tables while the fragments are placed on nodes')
+            for scheme in ('range', 'roundrobin'):
+                placement.drop(scheme)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
 def testrangeinsert(MyAssignment, ratingstablename, userid, itemid, rating, openconnection, expectedtableindex):
     """
     Tests the range insert function by checking whether the tuple is inserted in he Expected table you provide